@@ -10,20 +10,48 @@
 #  affiliates.
 
 import base64
+import fcntl
+import hashlib
 import hmac
 import httplib
+import json
+import os
 import re
-import sha
+import socket
 import sys
+import threading
 import time
 import urllib
 import urlparse
 import xml.sax
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 METADATA_PREFIX = 'x-amz-meta-'
 AMAZON_HEADER_PREFIX = 'x-amz-'
+# max number of idle keep-alive connections kept around per host
+DEFAULT_POOL_SIZE = 10
+# errors meaning an idle keep-alive connection was dropped by the server
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                           httplib.ResponseNotReady, socket.error)
+# bucket listings are parsed while they are read, in blocks of this size
+LIST_CHUNK_SIZE = 16 * 1024
+# most keys a single multi-object delete request may carry
+MAX_DELETE_KEYS = 1000
+# multipart uploads: every part but the last must be at least MIN_PART_SIZE
+# bytes, and there can't be more than MAX_PARTS of them
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+# parts uploaded at the same time, and extra attempts for each failed part
+DEFAULT_PART_THREADS = 4
+PART_RETRIES = 3
+# downloads are read in blocks of this size, and split in segments of
+# DEFAULT_SEGMENT_SIZE bytes when fetched by many threads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
 
 # generates the aws canonical string for the given parameters
 def canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
@@ -75,13 +103,22 @@ def canonical_string(method, bucket="", key="", query_args={}, headers={}, expir
         buf += "?logging"
     elif query_args.has_key("location"):
         buf += "?location"
+    elif query_args.has_key("delete"):
+        buf += "?delete"
+    elif query_args.has_key("uploads"):
+        buf += "?uploads"
+    elif query_args.has_key("uploadId"):
+        # these sub-resources are signed with their values, sorted by name
+        buf += "?" + '&'.join(["%s=%s" % (k, query_args[k])
+                               for k in ("partNumber", "uploadId")
+                               if query_args.has_key(k)])
 
     return buf
 
 # computes the base64'ed hmac-sha hash of the canonical string and the secret
 # access key, optionally urlencoding the result
 def encode(aws_secret_access_key, str, urlencode=False):
-    b64_hmac = base64.encodestring(hmac.new(aws_secret_access_key, str, sha).digest()).strip()
+    b64_hmac = base64.b64encode(hmac.new(aws_secret_access_key, str, hashlib.sha1).digest())
     if urlencode:
         return urllib.quote_plus(b64_hmac)
     else:
@@ -141,9 +178,75 @@ class Location:
 
 
 
+# httplib sends the headers and a file body in separate writes.  with
+# Nagle's algorithm on, the body would then wait for the ACK of the headers,
+# which the server delays: ~40ms lost on every such request.
+class NoDelayHTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class NoDelayHTTPSConnection(httplib.HTTPSConnection):
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+# keeps idle HTTP/1.1 keep-alive connections around, per (is_secure, host),
+# so that consecutive requests skip the TCP and TLS handshakes.
+# at most max_per_host idle connections are kept for each host; extra ones
+# are closed when released.  safe to share between threads, since a
+# connection is owned by a single request from get() until put().
+class ConnectionPool:
+    def __init__(self, max_per_host=DEFAULT_POOL_SIZE):
+        self.max_per_host = max_per_host
+        self.created = 0
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    # returns a (connection, is_reused) tuple
+    def get(self, is_secure, host):
+        self.__lock.acquire()
+        try:
+            idle = self.__idle.get((is_secure, host))
+            if idle:
+                return idle.pop(), True
+            self.created += 1
+        finally:
+            self.__lock.release()
+
+        if is_secure:
+            return NoDelayHTTPSConnection(host), False
+        else:
+            return NoDelayHTTPConnection(host), False
+
+    def put(self, is_secure, host, connection):
+        self.__lock.acquire()
+        try:
+            idle = self.__idle.setdefault((is_secure, host), [])
+            if len(idle) < self.max_per_host:
+                idle.append(connection)
+                return
+        finally:
+            self.__lock.release()
+        connection.close()
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            connections = [c for idle in self.__idle.values() for c in idle]
+            self.__idle = {}
+        finally:
+            self.__lock.release()
+        for connection in connections:
+            connection.close()
+
+
+
 class AWSAuthConnection:
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN,
+            pool_size=DEFAULT_POOL_SIZE):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
@@ -154,6 +257,11 @@ class AWSAuthConnection:
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        # pool_size=0 disables keep-alive: one connection per request
+        self.pool = ConnectionPool(pool_size)
+
+    def close(self):
+        self.pool.close()
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -168,11 +276,60 @@ class AWSAuthConnection:
         return Response(self._make_request('PUT', bucket, '', {}, headers, body))
 
     def check_bucket_exists(self, bucket):
-        return self._make_request('HEAD', bucket, '', {}, {})
+        resp = self._make_request('HEAD', bucket, '', {}, {})
+        resp.read()
+        resp.release_connection()
+        return resp
 
     def list_bucket(self, bucket, options={}, headers={}):
         return ListBucketResponse(self._make_request('GET', bucket, '', options, headers))
 
+    # yields a ListEntry for every key in the bucket (starting with prefix),
+    # following the listing pages (marker/is_truncated) as needed.  each page
+    # is parsed while it is read from the socket, and entries are handed out
+    # as soon as they are parsed, so memory use does not grow with the
+    # number of keys.  raises S3ResponseError if a page can't be fetched.
+    def iter_bucket(self, bucket, prefix='', options={}, headers={}):
+        options = options.copy()
+        if prefix:
+            options['prefix'] = prefix
+
+        while True:
+            http_response = self._make_request('GET', bucket, '', options, headers)
+            if http_response.status >= 300:
+                raise S3ResponseError(Response(http_response))
+
+            handler = ListBucketHandler()
+            parser = xml.sax.make_parser()
+            parser.setContentHandler(handler)
+            last_key = None
+            is_read = False
+            try:
+                while not is_read:
+                    chunk = http_response.read(LIST_CHUNK_SIZE)
+                    if chunk:
+                        parser.feed(chunk)
+                    else:
+                        parser.close()
+                        is_read = True
+                    for entry in handler.entries:
+                        last_key = entry.key
+                        yield entry
+                    del handler.entries[:]
+            finally:
+                if is_read:
+                    http_response.release_connection()
+                else:
+                    # given up halfway: the connection can't be reused
+                    http_response.close()
+
+            # NextMarker is only sent when a delimiter is used, and then a
+            # page may hold nothing but CommonPrefixes (no last_key)
+            marker = handler.next_marker or last_key
+            if not handler.is_truncated or not marker:
+                return
+            options['marker'] = marker
+
     def delete_bucket(self, bucket, headers={}):
         return Response(self._make_request('DELETE', bucket, '', {}, headers))
 
@@ -190,14 +347,216 @@ class AWSAuthConnection:
                     object.data,
                     object.metadata))
 
+    # uploads a file (a path or a file object) as key, without reading it
+    # all in memory.  files bigger than part_size are sent as a multipart
+    # upload (see MultipartUpload), threads parts at a time, so memory use
+    # stays under part_size * threads.  if journal (a local path) is given,
+    # an interrupted upload of the same file resumes from the parts recorded
+    # there.  raises S3ResponseError if a multipart upload fails.
+    def put_file(self, bucket, key, file, headers={}, metadata={},
+            part_size=DEFAULT_PART_SIZE, threads=DEFAULT_PART_THREADS,
+            journal=None):
+        if isinstance(file, basestring):
+            f = open(file, 'rb')
+        else:
+            f = file
+        try:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            part_size = max(part_size, MIN_PART_SIZE)
+            if size <= part_size:
+                final_headers = headers.copy()
+                final_headers['Content-Length'] = str(size)
+                return Response(
+                        self._make_request('PUT', bucket, key, {}, final_headers, f, metadata))
+            upload = MultipartUpload(self, bucket, key, f, size, part_size, journal)
+            return upload.run(headers, metadata, threads)
+        finally:
+            if f is not file:
+                f.close()
+
+    def initiate_multipart_upload(self, bucket, key, headers={}, metadata={}):
+        return InitiateMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploads': None }, headers, '', metadata))
+
+    # the etag of an uploaded part is in the ETag header of the response
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        final_headers = headers.copy()
+        final_headers['Content-MD5'] = base64.b64encode(hashlib.md5(data).digest())
+        return Response(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    final_headers,
+                    data))
+
+    # parts is a list of (part_number, etag) tuples, sorted by part number
+    def complete_multipart_upload(self, bucket, key, upload_id, parts, headers={}):
+        body = "<CompleteMultipartUpload>" + \
+               ''.join(["<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" %
+                        (number, escape(etag)) for number, etag in parts]) + \
+               "</CompleteMultipartUpload>"
+        return CompleteMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploadId': upload_id }, headers, body))
+
+    def abort_multipart_upload(self, bucket, key, upload_id, headers={}):
+        return Response(
+                self._make_request('DELETE', bucket, key, { 'uploadId': upload_id }, headers))
+
     def get(self, bucket, key, headers={}):
         return GetResponse(
                 self._make_request('GET', bucket, key, {}, headers))
 
+    # like get, but the body is not read: the returned StreamingGetResponse
+    # hands it out chunk by chunk.  if start is given, only bytes start to
+    # end (included, or up to the end of the object) are fetched.
+    def get_stream(self, bucket, key, headers={}, start=None, end=None):
+        final_headers = headers.copy()
+        if start is not None:
+            final_headers['Range'] = 'bytes=%d-%s' % (start, end is not None and end or '')
+        return StreamingGetResponse(
+                self._make_request('GET', bucket, key, {}, final_headers), key)
+
+    # downloads key into the local file filename, in constant memory, and
+    # returns its size.  the content is checked against the ETag (unless
+    # it is the ETag of a multipart upload), raising ChecksumError if it
+    # doesn't match.  raises S3ResponseError if the download fails.
+    #
+    # the download goes to filename.<etag>.part first, and is renamed once
+    # complete.  if resume is True, a download of the same object version
+    # which was interrupted carries on where it stopped.  the .part file is
+    # locked meanwhile: another download of the same version raises IOError,
+    # and the .part files of other versions are removed unless in use.
+    # with threads > 1, objects bigger than segment_size are fetched as
+    # that many segments (range requests) at once; those don't resume.
+    def get_file(self, bucket, key, filename, headers={}, resume=True,
+            threads=1, segment_size=DEFAULT_SEGMENT_SIZE):
+        head = self.head(bucket, key, headers)
+        if head.http_response.status >= 300:
+            raise S3ResponseError(head)
+        size = int(head.http_response.getheader('content-length', 0))
+        etag = head.http_response.getheader('etag', '').strip('"')
+
+        partial = '%s.%s.part' % (filename, etag)
+        lock = _lock_partial(partial)
+        try:
+            # partial downloads of other versions are of no use
+            _remove_stale_partials(filename, partial)
+
+            final_headers = headers.copy()
+            # fail, instead of mixing versions, if the object changes meanwhile
+            final_headers['If-Match'] = '"%s"' % etag
+            if threads > 1 and size > segment_size:
+                self._get_segments(bucket, key, partial, size, final_headers, threads, segment_size)
+                md5 = _is_md5_etag(etag) and _file_md5(partial)
+            else:
+                md5 = self._get_stream_to_file(bucket, key, partial, size, etag, final_headers, resume)
+            if md5 and md5 != etag:
+                os.remove(partial)
+                raise ChecksumError(key, etag, md5)
+            os.rename(partial, filename)
+        finally:
+            lock.close()
+        return size
+
+    # appends the object from the current size of the file filename on.
+    # returns the md5 of the whole file, if etag is one
+    def _get_stream_to_file(self, bucket, key, filename, size, etag, headers, resume):
+        offset = 0
+        if resume and os.path.exists(filename):
+            offset = min(os.path.getsize(filename), size)
+        md5 = None
+        if _is_md5_etag(etag):
+            md5 = hashlib.md5()
+            if offset:
+                _file_md5(filename, md5, offset)
+
+        f = open(filename, offset and 'r+b' or 'wb')
+        try:
+            f.seek(offset)
+            f.truncate()
+            if offset < size:
+                resp = self.get_stream(bucket, key, headers, offset)
+                if resp.http_response.status >= 300:
+                    raise S3ResponseError(resp)
+                if offset and resp.http_response.status != 206:
+                    resp.close()
+                    raise IOError("Range not honored, can't resume %s" % key)
+                for chunk in resp.iter_chunks():
+                    if md5:
+                        md5.update(chunk)
+                    f.write(chunk)
+        finally:
+            f.close()
+        return md5 and md5.hexdigest()
+
+    # fetches the object as segments of segment_size bytes, threads at a
+    # time, each one written in place into filename.  a failed segment is
+    # tried again up to PART_RETRIES times.
+    def _get_segments(self, bucket, key, filename, size, headers, threads, segment_size):
+        f = open(filename, 'wb')
+        f.truncate(size)
+        f.close()
+
+        def get_segment(start):
+            end = min(start + segment_size, size) - 1
+            error = None
+            for attempt in range(PART_RETRIES + 1):
+                f = open(filename, 'r+b')
+                try:
+                    f.seek(start)
+                    resp = self.get_stream(bucket, key, headers, start, end)
+                    if resp.http_response.status != 206:
+                        error = S3ResponseError(resp)
+                        if resp.http_response.status < 500:
+                            break
+                        continue
+                    for chunk in resp.iter_chunks():
+                        f.write(chunk)
+                    if f.tell() == end + 1:
+                        return None
+                    error = IOError('Short read of bytes %d-%d of %s' % (start, end, key))
+                except Exception as e:
+                    error = e
+                finally:
+                    f.close()
+            return error
+
+        pool = ThreadPool(threads)
+        try:
+            errors = [e for e in pool.imap_unordered(get_segment, range(0, size, segment_size)) if e]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+
+    def head(self, bucket, key, headers={}):
+        return Response(self._make_request('HEAD', bucket, key, {}, headers))
+
     def delete(self, bucket, key, headers={}):
         return Response(
                 self._make_request('DELETE', bucket, key, {}, headers))
 
+    # deletes up to MAX_DELETE_KEYS keys with a single request.  in quiet
+    # mode only the keys which failed to be deleted are reported, in the
+    # errors of the response.
+    def delete_multiple(self, bucket, keys, quiet=True, headers={}):
+        if len(keys) > MAX_DELETE_KEYS:
+            raise ValueError("Can't delete more than %d keys at once" % MAX_DELETE_KEYS)
+
+        body = "<Delete><Quiet>%s</Quiet>" % (quiet and 'true' or 'false') + \
+               ''.join(["<Object><Key>%s</Key></Object>" % escape(key) for key in keys]) + \
+               "</Delete>"
+        final_headers = headers.copy()
+        final_headers['Content-MD5'] = base64.b64encode(hashlib.md5(body).digest())
+        final_headers['Content-Type'] = 'application/xml'
+        return DeleteMultipleResponse(
+                self._make_request('POST', bucket, '', { 'delete': None }, final_headers, body))
+
     def get_bucket_logging(self, bucket, headers={}):
         return GetResponse(self._make_request('GET', bucket, '', { 'logging': None }, headers))
 
@@ -230,10 +589,17 @@ class AWSAuthConnection:
     def get_bucket_location(self, bucket):
         return LocationResponse(self._make_request('GET', bucket, '', {'location' : None}))
 
-    # end public methods
+    # returns the (host, path, headers) of a signed request, for transports
+    # other than httplib (see async_s3.py)
+    def prepare_request(self, method, bucket='', key='', query_args={}, headers={}, metadata={}):
+        server, path = self._get_server_and_path(bucket, key, query_args)
+        final_headers = merge_meta(headers, metadata)
+        self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
+        return "%s:%d" % (server, self.port), path, final_headers
 
-    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+    # end public methods
 
+    def _get_server_and_path(self, bucket, key, query_args):
         server = ''
         if bucket == '':
             server = self.server
@@ -260,36 +626,77 @@ class AWSAuthConnection:
         if len(query_args):
             path += "?" + query_args_hash_to_string(query_args)
 
+        return server, path
+
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        server, path = self._get_server_and_path(bucket, key, query_args)
         is_secure = self.is_secure
         host = "%s:%d" % (server, self.port)
+        # a file object body is sent again from where it started on a redirect
+        offset = data.tell() if hasattr(data, 'tell') else None
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
-            else:
-                connection = httplib.HTTPConnection(host)
-
+            if offset is not None:
+                data.seek(offset)
             final_headers = merge_meta(headers, metadata);
             # add auth header
             self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
 
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
+            connection, resp = self._send(is_secure, host, method, path, data, final_headers)
             if resp.status < 300 or resp.status >= 400:
+                # the connection goes back to the pool once the body is read
+                resp.release_connection = \
+                    lambda: self._release(is_secure, host, connection, resp)
                 return resp
             # handle redirect
             location = resp.getheader('location')
             if not location:
+                resp.release_connection = \
+                    lambda: self._release(is_secure, host, connection, resp)
                 return resp
-            # (close connection)
+            # drain the body so the connection can be reused
             resp.read()
+            self._release(is_secure, host, connection, resp)
             scheme, host, path, params, query, fragment \
                     = urlparse.urlparse(location)
-            if scheme == "http":    is_secure = True
-            elif scheme == "https": is_secure = False
-            else: raise invalidURL("Not http/https: " + location)
+            if scheme == "http":    is_secure = False
+            elif scheme == "https": is_secure = True
+            else: raise httplib.InvalidURL("Not http/https: " + location)
             if query: path += "?" + query
             # retry with redirect
 
+    # sends the request over a pooled connection.  a reused keep-alive
+    # connection may have been closed by the server while idle, in which
+    # case the request is retried once over a fresh connection (a file
+    # object body from where it was at first, not from its start).
+    def _send(self, is_secure, host, method, path, data, headers):
+        offset = data.tell() if hasattr(data, 'tell') else None
+        connection, is_reused = self.pool.get(is_secure, host)
+        try:
+            connection.request(method, path, data, headers)
+            return connection, connection.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if not is_reused:
+                raise
+
+        # a stale connection is likely not the only one idling in the pool
+        self.pool.close()
+        if offset is not None:
+            data.seek(offset)
+        connection, is_reused = self.pool.get(is_secure, host)
+        try:
+            connection.request(method, path, data, headers)
+            return connection, connection.getresponse()
+        except:
+            connection.close()
+            raise
+
+    def _release(self, is_secure, host, connection, resp):
+        if resp.will_close:
+            connection.close()
+        else:
+            self.pool.put(is_secure, host, connection)
+
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
         if not headers.has_key('Date'):
             headers['Date'] = time.strftime("%a, %d %b %Y %X GMT", time.gmtime())
@@ -299,9 +706,19 @@ class AWSAuthConnection:
             "AWS %s:%s" % (self.aws_access_key_id, encode(self.aws_secret_access_key, c_string))
 
 
+# generates signed urls, which can be handed out to give access to private
+# keys for a while.
+#
+# many urls can be signed at once with generate_urls, which shares all the
+# work but the hmac of each key (itself started from a precomputed hmac
+# state).  generated urls are cached, and the same url is handed out again
+# for as long as it stays valid for at least half of the expires_in time
+# (so pages rendered meanwhile link to the same, browser cached, urls).
 class QueryStringAuthGenerator:
     # by default, expire in 1 minute
     DEFAULT_EXPIRES_IN = 60
+    # the url cache is emptied when it grows beyond this many urls
+    URL_CACHE_SIZE = 10000
 
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
                  server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
@@ -322,6 +739,9 @@ class QueryStringAuthGenerator:
         self.calling_format = calling_format
         self.__expires_in = QueryStringAuthGenerator.DEFAULT_EXPIRES_IN
         self.__expires = None
+        # copied for every signature, instead of hashing the key again
+        self.__hmac = hmac.new(aws_secret_access_key, digestmod=hashlib.sha1)
+        self.__url_cache = {}
 
         # for backwards compatibility with older versions
         self.server_name = "%s:%s" % (self.server, self.port)
@@ -329,10 +749,12 @@ class QueryStringAuthGenerator:
     def set_expires_in(self, expires_in):
         self.__expires_in = expires_in
         self.__expires = None
+        self.__url_cache = {}
 
     def set_expires(self, expires):
         self.__expires = expires
         self.__expires_in = None
+        self.__url_cache = {}
 
     def create_bucket(self, bucket, headers={}):
         return self.generate_url('PUT', bucket, '', {}, headers)
@@ -383,45 +805,298 @@ class QueryStringAuthGenerator:
         return self.generate_url('GET', '', '', {}, headers)
 
     def make_bare_url(self, bucket, key=''):
-        full_url = self.generate_url(self, bucket, key)
+        full_url = self.generate_url('GET', bucket, key)
         return full_url[:full_url.index('?')]
 
+    # signed urls for many keys of a bucket (in the same order)
+    def get_many(self, bucket, keys, headers={}):
+        return self.generate_urls('GET', bucket, keys, {}, headers)
+
     def generate_url(self, method, bucket='', key='', query_args={}, headers={}):
-        expires = 0
+        return self.generate_urls(method, bucket, [key], query_args, headers)[0]
+
+    def generate_urls(self, method, bucket='', keys=[], query_args={}, headers={}):
+        now = time.time()
         if self.__expires_in != None:
-            expires = int(time.time() + self.__expires_in)
+            expires = int(now + self.__expires_in)
+            min_ttl = self.__expires_in / 2.0
         elif self.__expires != None:
             expires = int(self.__expires)
+            min_ttl = 0
         else:
-            raise "Invalid expires state"
-
-        canonical_str = canonical_string(method, bucket, key, query_args, headers, expires)
-        encoded_canonical = encode(self.aws_secret_access_key, canonical_str)
-
-        url = CallingFormat.build_url_base(self.protocol, self.server, self.port, bucket, self.calling_format)
-
-        url += "/%s" % urllib.quote_plus(key)
-
-        query_args['Signature'] = encoded_canonical
-        query_args['Expires'] = expires
-        query_args['AWSAccessKeyId'] = self.aws_access_key_id
-
-        url += "?%s" % query_args_hash_to_string(query_args)
-
-        return url
-
+            raise ValueError("Invalid expires state")
+
+        cache_key = (method, bucket, tuple(sorted(query_args.items())),
+                     tuple(sorted(headers.items())))
+        urls = []
+        missing = []
+        for key in keys:
+            cached = self.__url_cache.get(cache_key + (key,))
+            if cached and cached[1] - now >= min_ttl \
+                    and (self.__expires == None or cached[1] == expires):
+                urls.append(cached[0])
+            else:
+                urls.append(None)
+                missing.append(len(urls) - 1)
+        if not missing:
+            return urls
+
+        # everything in the canonical string but the key is the same for all:
+        # it goes between the bucket path and the sub-resource, if any
+        bare = canonical_string(method, bucket, '', {}, headers, expires)
+        sub_resource = canonical_string(method, bucket, '', query_args, headers, expires)[len(bare):]
+        url_base = CallingFormat.build_url_base(
+                self.protocol, self.server, self.port, bucket, self.calling_format) + "/"
+        final_query_args = query_args.copy()
+        final_query_args['Expires'] = expires
+        final_query_args['AWSAccessKeyId'] = self.aws_access_key_id
+        url_query = "?%s&Signature=" % query_args_hash_to_string(final_query_args)
+
+        if len(self.__url_cache) + len(missing) > self.URL_CACHE_SIZE:
+            self.__url_cache = {}
+        for i in missing:
+            quoted_key = urllib.quote_plus(keys[i])
+            signature = self.__hmac.copy()
+            signature.update(bare + quoted_key + sub_resource)
+            urls[i] = url_base + quoted_key + url_query + \
+                    _quote_base64(base64.b64encode(signature.digest()))
+            self.__url_cache[cache_key + (keys[i],)] = (urls[i], expires)
+        return urls
+
+
+# same as urllib.quote_plus, for the few characters base64 uses, but faster
+def _quote_base64(s):
+    return s.replace('+', '%2B').replace('/', '%2F').replace('=', '%3D')
+
+# opens the partial download partial (creating it if missing) and locks it,
+# so that no other download writes to it, or removes it, meanwhile.  raises
+# IOError if another download holds it.  closing the file unlocks it.
+def _lock_partial(partial):
+    while True:
+        f = open(partial, 'ab')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            raise IOError('%s is in use by another download' % partial)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(partial)):
+                return f
+        except OSError:
+            pass
+        # removed (as stale) before locked: lock the new one
+        f.close()
+
+# the .part files get_file names after the ETag (md5, or md5-count)
+def _partial_pattern(name):
+    return re.compile(re.escape(name) + r'\.[0-9a-f]{32}(?:-[0-9]+)?\.part$')
+
+# removes the partial downloads of filename but partial, leaving alone the
+# ones locked by a download (see _lock_partial)
+def _remove_stale_partials(filename, partial):
+    folder, name = os.path.split(filename)
+    pattern = _partial_pattern(name)
+    for other in os.listdir(folder or '.'):
+        path = os.path.join(folder, other)
+        if not pattern.match(other) or path == partial:
+            continue
+        try:
+            f = open(path, 'rb')
+        except IOError:  # removed meanwhile
+            continue
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(path)
+        except (IOError, OSError):  # in use, or removed meanwhile
+            pass
+        finally:
+            f.close()
+
+# the ETags of multipart uploads (md5-count) are not the md5 of the object
+def _is_md5_etag(etag):
+    return re.match('^[0-9a-f]{32}$', etag) is not None
+
+# returns the hex md5 of the first length bytes (or all) of filename,
+# or just updates md5, if given
+def _file_md5(filename, md5=None, length=None):
+    digest = md5 or hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        left = length
+        while left is None or left > 0:
+            chunk = f.read(left is None and DOWNLOAD_CHUNK_SIZE or min(left, DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
 
 class S3Object:
     def __init__(self, data, metadata={}):
         self.data = data
         self.metadata = metadata
 
-class Owner:
+# the multipart upload of size bytes of the file object f, as key, in parts
+# of part_size bytes (grown if there would be more than MAX_PARTS of them).
+# parts are uploaded by a pool of threads, each holding a single part in
+# memory, and a failed part is tried again up to PART_RETRIES times.
+#
+# if journal is given, the upload id and the etag of every uploaded part are
+# saved there, and a later upload of the same file (same size and mtime)
+# only sends the missing parts.  the journal is removed once the upload is
+# complete.  without a journal, a failed upload is aborted.
+class MultipartUpload:
+    def __init__(self, connection, bucket, key, f, size, part_size=DEFAULT_PART_SIZE, journal=None):
+        self.connection = connection
+        self.bucket = bucket
+        self.key = key
+        self.f = f
+        self.size = size
+        self.part_size = max(part_size, -(-size // MAX_PARTS))
+        self.part_count = max(1, -(-size // self.part_size))
+        self.journal = journal
+        self.upload_id = None
+        self.etags = {}
+        self.parts_sent = 0
+        try:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+        except (AttributeError, IOError, OSError):
+            self.mtime = None
+        self.__lock = threading.Lock()
+
+    # returns the CompleteMultipartUploadResponse, or raises S3ResponseError
+    def run(self, headers={}, metadata={}, threads=DEFAULT_PART_THREADS):
+        resumed = self._load_journal()
+        try:
+            return self._run(headers, metadata, threads)
+        except S3ResponseError as e:
+            # the journaled upload may have expired or been aborted
+            if not resumed or e.response.http_response.status != 404:
+                raise
+        self.upload_id = None
+        self.etags = {}
+        return self._run(headers, metadata, threads)
+
+    def _run(self, headers, metadata, threads):
+        if self.upload_id is None:
+            resp = self.connection.initiate_multipart_upload(self.bucket, self.key, headers, metadata)
+            if resp.http_response.status >= 300:
+                raise S3ResponseError(resp)
+            self.upload_id = resp.upload_id
+            self._save_journal()
+
+        missing = [n for n in range(1, self.part_count + 1) if not self.etags.has_key(n)]
+        pool = ThreadPool(max(1, min(threads, len(missing))))
+        try:
+            errors = [e for e in pool.imap_unordered(self._upload_part, missing) if e]
+        finally:
+            pool.close()
+            pool.join()
+
+        if not errors:
+            resp = self.connection.complete_multipart_upload(
+                    self.bucket, self.key, self.upload_id, sorted(self.etags.items()))
+            if resp.http_response.status < 300 and not resp.error_code:
+                self._remove_journal()
+                return resp
+            errors.append(S3ResponseError(resp))
+
+        if not self.journal:
+            self.connection.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+        raise errors[0]
+
+    # uploads a part, and returns None or the error it last failed with
+    def _upload_part(self, number):
+        self.__lock.acquire()
+        try:
+            # all threads share the file position
+            self.f.seek((number - 1) * self.part_size)
+            data = self.f.read(self.part_size)
+        finally:
+            self.__lock.release()
+
+        error = None
+        for attempt in range(PART_RETRIES + 1):
+            try:
+                resp = self.connection.upload_part(self.bucket, self.key, self.upload_id, number, data)
+            except Exception as e:
+                error = e
+                continue
+            status = resp.http_response.status
+            etag = resp.http_response.getheader('etag', '')
+            if status < 300 and etag.strip('"') == hashlib.md5(data).hexdigest():
+                self._part_done(number, etag)
+                return None
+            error = S3ResponseError(resp)
+            # client errors (but a bad digest) won't go away by trying again
+            if 400 <= status < 500 and 'BadDigest' not in resp.body:
+                break
+        return error
+
+    def _part_done(self, number, etag):
+        self.__lock.acquire()
+        try:
+            self.etags[number] = etag
+            self.parts_sent += 1
+            self._save_journal()
+        finally:
+            self.__lock.release()
+
+    def _journal_state(self):
+        return { 'bucket': self.bucket, 'key': self.key, 'size': self.size,
+                 'mtime': self.mtime, 'part_size': self.part_size }
+
+    # returns True if a journaled upload of this same file was found
+    def _load_journal(self):
+        if not self.journal:
+            return False
+        try:
+            f = open(self.journal)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        if dict((k, state.get(k)) for k in self._journal_state()) != self._journal_state():
+            return False
+        self.upload_id = state['upload_id']
+        self.etags = dict((int(n), etag) for n, etag in state['parts'].items())
+        return True
+
+    def _save_journal(self):
+        if not self.journal:
+            return
+        state = self._journal_state()
+        state['upload_id'] = self.upload_id
+        state['parts'] = self.etags
+        # write and rename: an interruption never leaves half a journal
+        tmp = self.journal + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.journal)
+
+    def _remove_journal(self):
+        if self.journal and os.path.exists(self.journal):
+            os.remove(self.journal)
+
+class Owner(object):
+    __slots__ = ('id', 'display_name')
+
     def __init__(self, id='', display_name=''):
         self.id = id
         self.display_name = display_name
 
-class ListEntry:
+# there may be hundreds of thousands of these: no per-instance __dict__
+class ListEntry(object):
+    __slots__ = ('key', 'last_modified', 'etag', 'size', 'storage_class', 'owner')
+
     def __init__(self, key='', last_modified=None, etag='', size=0, storage_class='', owner=None):
         self.key = key
         self.last_modified = last_modified
@@ -439,12 +1114,27 @@ class Bucket:
         self.name = name
         self.creation_date = creation_date
 
+class S3ResponseError(Exception):
+    def __init__(self, response):
+        Exception.__init__(self, response.message)
+        self.response = response
+
+class ChecksumError(Exception):
+    def __init__(self, key, etag, md5):
+        Exception.__init__(self, "%s: got md5 %s, expected %s" % (key, md5, etag))
+        self.key = key
+        self.etag = etag
+        self.md5 = md5
+
 class Response:
     def __init__(self, http_response):
         self.http_response = http_response
         # you have to do this read, even if you don't expect a body.
         # otherwise, the next request fails.
         self.body = http_response.read()
+        # hand the keep-alive connection back to the pool
+        if hasattr(http_response, 'release_connection'):
+            http_response.release_connection()
         if http_response.status >= 300 and self.body:
             self.message = self.body
         else:
@@ -496,6 +1186,110 @@ class GetResponse(Response):
 
         return metadata
 
+# a get whose body is left on the socket, to be read with iter_chunks
+# (or write_to), in constant memory.  error responses are read at once,
+# like any other Response.
+#
+# if the whole object is read and its ETag is an md5, the content is
+# checked while it is read, and iter_chunks raises ChecksumError at the
+# end if it doesn't match.
+class StreamingGetResponse:
+    def __init__(self, http_response, key='', verify=True):
+        self.http_response = http_response
+        self.key = key
+        self.etag = http_response.getheader('etag', '').strip('"')
+        self.size = int(http_response.getheader('content-length', 0))
+        self.metadata = {}
+        for hkey in http_response.msg.keys():
+            if hkey.lower().startswith(METADATA_PREFIX):
+                self.metadata[hkey[len(METADATA_PREFIX):]] = http_response.msg[hkey]
+        if http_response.status >= 300:
+            self.body = http_response.read()
+            http_response.release_connection()
+            self.message = self.body or \
+                    "%03d %s" % (http_response.status, http_response.reason)
+            self.is_read = True
+        else:
+            self.message = "%03d %s" % (http_response.status, http_response.reason)
+            self.is_read = False
+        self.__md5 = None
+        if verify and http_response.status == 200 and _is_md5_etag(self.etag):
+            self.__md5 = hashlib.md5()
+
+    def iter_chunks(self, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        if self.is_read:
+            return
+        try:
+            while True:
+                chunk = self.http_response.read(chunk_size)
+                if not chunk:
+                    break
+                if self.__md5:
+                    self.__md5.update(chunk)
+                yield chunk
+            self.is_read = True
+        finally:
+            if self.is_read:
+                self.http_response.release_connection()
+            else:
+                # given up halfway: the connection can't be reused
+                self.http_response.close()
+        if self.__md5 and self.__md5.hexdigest() != self.etag:
+            raise ChecksumError(self.key, self.etag, self.__md5.hexdigest())
+
+    # writes the body into the file object f, and returns its size
+    def write_to(self, f, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        size = 0
+        for chunk in self.iter_chunks(chunk_size):
+            f.write(chunk)
+            size += len(chunk)
+        return size
+
+    # stops reading the body, dropping the connection
+    def close(self):
+        if not self.is_read:
+            self.http_response.close()
+            self.is_read = True
+
+class DeleteMultipleResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = DeleteResultHandler()
+            xml.sax.parseString(self.body, handler)
+            self.deleted = handler.deleted
+            self.errors = handler.errors
+        else:
+            self.deleted = []
+            self.errors = []
+
+class InitiateMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.upload_id = None
+        if http_response.status < 300:
+            handler = MultipartResultHandler()
+            xml.sax.parseString(self.body, handler)
+            self.upload_id = handler.values.get('UploadId')
+
+# completing an upload may fail after a 200 status has been sent: in that
+# case error_code is set
+class CompleteMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.etag = None
+        self.location = None
+        self.error_code = None
+        if http_response.status < 300:
+            handler = MultipartResultHandler()
+            xml.sax.parseString(self.body, handler)
+            if handler.root == 'Error':
+                self.error_code = handler.values.get('Code', '')
+                self.message = self.body
+            else:
+                self.etag = handler.values.get('ETag')
+                self.location = handler.values.get('Location')
+
 class LocationResponse(Response):
     def __init__(self, http_response):
         Response.__init__(self, http_response)
@@ -509,6 +1303,8 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.entries = []
         self.curr_entry = None
         self.curr_text = ''
+        # text may come in many pieces: join them once, at the end tag
+        self.curr_text_parts = []
         self.common_prefixes = []
         self.curr_common_prefix = None
         self.name = ''
@@ -521,6 +1317,7 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.is_echoed_prefix_set = False
 
     def startElement(self, name, attrs):
+        self.curr_text_parts = []
         if name == 'Contents':
             self.curr_entry = ListEntry()
         elif name == 'Owner':
@@ -530,6 +1327,8 @@ class ListBucketHandler(xml.sax.ContentHandler):
 
 
     def endElement(self, name):
+        self.curr_text = ''.join(self.curr_text_parts)
+        self.curr_text_parts = []
         if name == 'Contents':
             self.entries.append(self.curr_entry)
         elif name == 'CommonPrefixes':
@@ -569,7 +1368,7 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.curr_text = ''
 
     def characters(self, content):
-        self.curr_text += content
+        self.curr_text_parts.append(content)
 
 
 class ListAllMyBucketsHandler(xml.sax.ContentHandler):
@@ -594,6 +1393,58 @@ class ListAllMyBucketsHandler(xml.sax.ContentHandler):
         self.curr_text = content
 
 
+# collects the deleted keys, and a (key, code, message) tuple per error
+class DeleteResultHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+        self.curr_error = None
+        self.curr_key = ''
+        self.curr_text_parts = []
+
+    def startElement(self, name, attrs):
+        self.curr_text_parts = []
+        if name == 'Error':
+            self.curr_error = {}
+
+    def endElement(self, name):
+        text = ''.join(self.curr_text_parts)
+        if name == 'Key':
+            self.curr_key = text
+        elif name == 'Deleted':
+            self.deleted.append(self.curr_key)
+        elif name in ('Code', 'Message') and self.curr_error is not None:
+            self.curr_error[name] = text
+        elif name == 'Error':
+            self.errors.append((self.curr_key,
+                                self.curr_error.get('Code', ''),
+                                self.curr_error.get('Message', '')))
+            self.curr_error = None
+
+    def characters(self, content):
+        self.curr_text_parts.append(content)
+
+
+# collects the text of the elements of the (flat) multipart upload results,
+# and the name of the root element
+class MultipartResultHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.root = None
+        self.values = {}
+        self.curr_text_parts = []
+
+    def startElement(self, name, attrs):
+        if self.root is None:
+            self.root = name
+        self.curr_text_parts = []
+
+    def endElement(self, name):
+        self.values[name] = ''.join(self.curr_text_parts)
+
+    def characters(self, content):
+        self.curr_text_parts.append(content)
+
+
 class LocationHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.location = None
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+A non-blocking variant of S3.AWSAuthConnection: many requests in flight
+over a few keep-alive connections, all driven by a single thread.
+
+Requests are signed by S3.py (AWSAuthConnection.prepare_request) and
+replies are parsed by the same S3.Response classes: only the transport
+differs. At most `concurrency` connections are open at once, so at most
+that many requests are in flight, and the rest wait in a queue. A request
+body (a string or a file object) is sent in SEND_CHUNK_SIZE blocks,
+so a connection only holds one block of it in memory at a time.
+
+Python 2 has no asyncio: the event loop is the standard asyncore one,
+plus timers (call_later), e.g. to retry a request after a while.
+
+Usage:
+    conn = AsyncS3Connection(key, secret, concurrency=64)
+    conn.put(bucket, key, open(filename, 'rb'), headers, callback=done)
+    conn.run()  # returns when every request (and timer) is done
+
+callback(response, error) gets the S3.Response of the request (or the
+response_class given to request) and None or, if the request could not
+be completed, None and the exception. An exception raised by a callback
+stops run(), which raises it.
+
+"""
+import asyncore
+import errno
+import heapq
+import httplib
+import itertools
+import socket
+import ssl
+import sys
+import time
+from collections import deque
+from cStringIO import StringIO
+
+import S3
+
+DEFAULT_CONCURRENCY = 32  # connections (so, requests in flight)
+SEND_CHUNK_SIZE = 64 * 1024
+RECV_CHUNK_SIZE = 64 * 1024
+IDLE_TIMEOUT = 60  # seconds without progress before a request fails
+LOOP_TIMEOUT = 1.0  # most seconds to wait for events, between timer checks
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR)
+
+
+class AsyncRequest(object):
+    """ A request waiting in the queue of an AsyncS3Connection """
+    def __init__(self, method, bucket, key, query_args, headers, body,
+                 metadata, callback, response_class):
+        self.method = method
+        self.bucket = bucket
+        self.key = key
+        self.query_args = query_args
+        self.headers = headers
+        self.body = body
+        self.metadata = metadata
+        self.callback = callback
+        self.response_class = response_class
+        self.retried_stale = False
+
+
+class _HTTPResponse(object):
+    """ What S3.Response needs from an httplib.HTTPResponse, once read """
+    def __init__(self, status, reason, msg, body):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self._body = StringIO(body)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def release_connection(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Connection(asyncore.dispatcher):
+    """
+    A keep-alive HTTP/1.1 connection to host (server:port),
+    running one request at a time.
+
+    """
+    def __init__(self, client, host):
+        asyncore.dispatcher.__init__(self, map=client._map)
+        self.client = client
+        self.host = host
+        self.is_secure = client.is_secure
+        self.server, port = host.rsplit(':', 1)
+        self.host_header = host
+        if int(port) == S3.PORTS_BY_SECURITY[self.is_secure]:
+            self.host_header = self.server
+        self.request = None
+        self.requests_done = 0
+        self.last_activity = time.time()
+        self._handshaking = False
+        self._want_write = True
+        self._out = ''
+        self._body = None
+        self._reset_response()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((self.server, int(port)))
+
+    def _reset_response(self):
+        self._in = ''
+        self._response_started = False
+        self._status = None
+        self._msg = None
+        self._body_mode = None  # 'length', 'chunked' or 'close'
+        self._body_left = 0
+        self._body_parts = []
+        self._last_chunk = False
+
+    # sending
+
+    def start(self, request, path, headers):
+        self.request = request
+        self.last_activity = time.time()
+        body = request.body
+        if isinstance(body, basestring):
+            size = len(body)
+            body = StringIO(body)
+        else:
+            body.seek(0, 2)
+            size = body.tell()
+            body.seek(0)
+        head = ['%s %s HTTP/1.1' % (request.method, path),
+                'Host: %s' % self.host_header]
+        for name, value in headers.items():
+            if name.lower() != 'content-length':  # set from the body
+                head.append('%s: %s' % (name, value))
+        if size or request.method in ('PUT', 'POST'):
+            head.append('Content-Length: %d' % size)
+        self._out = '\r\n'.join(head) + '\r\n\r\n'
+        self._body = body if size else None
+
+    def writable(self):
+        if not self.connected or self._handshaking:
+            return self._want_write
+        return bool(self._out) or self._body is not None
+
+    def handle_connect(self):
+        if self.is_secure:
+            self.del_channel()
+            self.set_socket(self.client.ssl_context.wrap_socket(
+                self.socket, server_hostname=self.server,
+                do_handshake_on_connect=False))
+            self._handshaking = True
+            self._do_handshake()
+
+    def _do_handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._want_write = False
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._want_write = True
+                return
+            raise
+        self._handshaking = False
+
+    def handle_write(self):
+        if self._handshaking:
+            return self._do_handshake()
+        if not self._out and self._body is not None:
+            self._out = self._body.read(SEND_CHUNK_SIZE)
+            if not self._out:
+                self._body = None
+                return
+        try:
+            sent = self.socket.send(self._out)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            raise
+        if sent:
+            self._out = self._out[sent:]
+            self.last_activity = time.time()
+
+    # receiving
+
+    def handle_read(self):
+        if self._handshaking:
+            return self._do_handshake()
+        while True:
+            try:
+                data = self.socket.recv(RECV_CHUNK_SIZE)
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return
+                raise
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if not data:
+                return self.handle_close()
+            self.last_activity = time.time()
+            self._feed(data)
+            if not self.connected:
+                return
+            # decrypted data may be left in the ssl buffer, unseen by poll
+            if not self.is_secure or not self.socket.pending():
+                return
+
+    def _feed(self, data):
+        if self.request is None:
+            # nothing was asked: the server is dropping the connection
+            return self._close()
+        self._response_started = True
+        self._in += data
+        if self._status is None and not self._parse_head():
+            return
+        if self._body_mode == 'length':
+            taken = self._in[:self._body_left]
+            self._body_parts.append(taken)
+            self._body_left -= len(taken)
+            self._in = self._in[len(taken):]
+            if not self._body_left:
+                self._complete()
+        elif self._body_mode == 'chunked':
+            self._parse_chunks()
+        else:
+            self._body_parts.append(self._in)
+            self._in = ''
+
+    def _parse_head(self):
+        end = self._in.find('\r\n\r\n')
+        if end < 0:
+            return False
+        head, self._in = self._in[:end + 2], self._in[end + 4:]
+        status_line, headers = head.split('\r\n', 1)
+        try:
+            version, status, reason = (status_line.split(' ', 2) + [''])[:3]
+            self._status = (version, int(status), reason.strip())
+        except ValueError:
+            raise httplib.BadStatusLine(status_line)
+        self._msg = httplib.HTTPMessage(StringIO(headers))
+
+        status = self._status[1]
+        if self.request.method == 'HEAD' or status in (204, 304) \
+                or 100 <= status < 200:
+            self._body_mode = 'length'
+            self._body_left = 0
+        elif 'chunked' in self._msg.getheader('transfer-encoding', ''):
+            self._body_mode = 'chunked'
+        elif self._msg.getheader('content-length') is not None:
+            self._body_mode = 'length'
+            self._body_left = int(self._msg.getheader('content-length'))
+        else:
+            self._body_mode = 'close'
+        if self._body_mode == 'length' and not self._body_left:
+            self._complete()
+            return False
+        return True
+
+    def _parse_chunks(self):
+        while self.request is not None:
+            if self._body_left:
+                taken = self._in[:self._body_left]
+                self._body_parts.append(taken)
+                self._body_left -= len(taken)
+                self._in = self._in[len(taken):]
+                if self._body_left:
+                    return
+            line_end = self._in.find('\r\n')
+            if line_end < 0:
+                return
+            line = self._in[:line_end].strip()
+            self._in = self._in[line_end + 2:]
+            if self._last_chunk:
+                if not line:  # end of the (ignored) trailers
+                    self._complete()
+            elif line:  # else, the CRLF after the data of a chunk
+                self._body_left = int(line.split(';', 1)[0], 16)
+                self._last_chunk = not self._body_left
+
+    def _complete(self):
+        request = self.request
+        version, status, reason = self._status
+        body = ''.join(self._body_parts)
+        will_close = self._body_mode == 'close' or version == 'HTTP/1.0' \
+            or self._msg.getheader('connection', '').lower() == 'close'
+        http_response = _HTTPResponse(status, reason, self._msg, body)
+
+        self.request = None
+        self.requests_done += 1
+        self._reset_response()
+        if will_close:
+            self._close()
+        else:
+            self.client._connection_idle(self)
+        try:
+            response = request.response_class(http_response)
+        except Exception as e:
+            return self.client._callback(request, None, e)
+        self.client._callback(request, response, None)
+
+    # closing and errors
+
+    def handle_close(self):
+        if self.request is not None and self._body_mode == 'close':
+            return self._complete()
+        self._fail(httplib.BadStatusLine('connection closed') if
+                   not self._response_started else
+                   httplib.IncompleteRead(''.join(self._body_parts)))
+
+    def handle_error(self):
+        self._fail(sys.exc_info()[1])
+
+    def handle_expt(self):
+        self._fail(socket.error('connection error'))
+
+    def _fail(self, error):
+        request = self.request
+        self.request = None
+        reused = self.requests_done > 0
+        self._close()
+        if request is None:
+            return
+        if reused and not self._response_started and \
+                not request.retried_stale:
+            # the server closed the idle keep-alive connection meanwhile
+            request.retried_stale = True
+            self.client._requeue(request)
+        else:
+            self.client._callback(request, None, error)
+
+    def _close(self):
+        self.close()
+        self.client._connection_closed(self)
+
+
+class AsyncS3Connection(object):
+    """
+    Queues S3 requests, and runs them over up to concurrency
+    keep-alive connections at once, when run() is called.
+
+    """
+    def __init__(self, aws_access_key_id, aws_secret_access_key,
+                 is_secure=True, server=S3.DEFAULT_HOST, port=None,
+                 calling_format=S3.CallingFormat.SUBDOMAIN,
+                 concurrency=DEFAULT_CONCURRENCY, ssl_context=None):
+        self.auth = S3.AWSAuthConnection(aws_access_key_id,
+                                         aws_secret_access_key, is_secure,
+                                         server, port, calling_format,
+                                         pool_size=0)
+        self.is_secure = is_secure
+        self.concurrency = concurrency
+        self.ssl_context = ssl_context
+        if is_secure and ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        self.created = 0  # connections opened, i.e. handshakes
+        self._map = {}
+        self._queue = deque()
+        self._connections = set()
+        self._idle = {}  # host -> idle connections
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._callback_error = None
+
+    def request(self, method, bucket='', key='', query_args={}, headers={},
+                body='', metadata={}, callback=None,
+                response_class=S3.Response):
+        self._queue.append(AsyncRequest(method, bucket, key, query_args,
+                                        headers, body, metadata, callback,
+                                        response_class))
+        self._dispatch()
+
+    def put(self, bucket, key, body, headers={}, metadata={},
+            callback=None):
+        self.request('PUT', bucket, key, {}, headers, body, metadata,
+                     callback)
+
+    def get(self, bucket, key, headers={}, callback=None):
+        self.request('GET', bucket, key, {}, headers, callback=callback,
+                     response_class=S3.GetResponse)
+
+    def delete(self, bucket, key, headers={}, callback=None):
+        self.request('DELETE', bucket, key, {}, headers, callback=callback)
+
+    def call_later(self, delay, function):
+        """ Calls function() from run(), in delay seconds """
+        heapq.heappush(self._timers, (time.time() + delay,
+                                      next(self._timer_ids), function))
+
+    def run(self):
+        """
+        Runs the queued requests (and the ones queued meanwhile, by
+        callbacks and timers) and returns once they are all done.
+
+        """
+        while self._queue or self._timers or self._is_busy():
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                function = heapq.heappop(self._timers)[2]
+                self._call(function)
+            self._check_errors()
+            timeout = LOOP_TIMEOUT
+            if self._timers:
+                timeout = max(0, min(timeout, self._timers[0][0] - now))
+            if self._map:
+                asyncore.loop(timeout, use_poll=True, map=self._map, count=1)
+            elif timeout:
+                time.sleep(timeout)
+            self._check_timeouts()
+            self._check_errors()
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.close()
+        self._connections.clear()
+        self._idle.clear()
+
+    def _dispatch(self):
+        while self._queue:
+            request = self._queue[0]
+            host, path, headers = self.auth.prepare_request(
+                request.method, request.bucket, request.key,
+                request.query_args, request.headers, request.metadata)
+            idle = self._idle.get(host)
+            if idle:
+                connection = idle.pop()
+            elif len(self._connections) < self.concurrency:
+                connection = _Connection(self, host)
+                self._connections.add(connection)
+                self.created += 1
+            elif any(self._idle.values()):
+                # make room, closing a connection idle to another host
+                other = [c for c in self._idle.values() if c][0].pop()
+                other._close()
+                continue
+            else:
+                return
+            self._queue.popleft()
+            connection.start(request, path, headers)
+
+    def _is_busy(self):
+        return any(c.request is not None for c in self._connections)
+
+    def _requeue(self, request):
+        self._queue.appendleft(request)
+        self._dispatch()
+
+    def _connection_idle(self, connection):
+        self._idle.setdefault(connection.host, []).append(connection)
+        self._dispatch()
+
+    def _connection_closed(self, connection):
+        if connection not in self._connections:
+            return
+        self._connections.discard(connection)
+        idle = self._idle.get(connection.host, [])
+        if connection in idle:
+            idle.remove(connection)
+        self._dispatch()
+
+    def _callback(self, request, response, error):
+        if request.callback:
+            self._call(lambda: request.callback(response, error))
+
+    def _call(self, function):
+        try:
+            function()
+        except Exception:
+            if self._callback_error is None:
+                self._callback_error = sys.exc_info()
+
+    def _check_errors(self):
+        if self._callback_error:
+            error, self._callback_error = self._callback_error, None
+            raise error[0], error[1], error[2]
+
+    def _check_timeouts(self):
+        now = time.time()
+        for connection in list(self._connections):
+            if now - connection.last_activity < IDLE_TIMEOUT:
+                continue
+            if connection.request is not None:
+                connection._fail(socket.timeout('timed out'))
+            else:
+                connection._close()
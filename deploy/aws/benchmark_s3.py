@@ -0,0 +1,386 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the deploy/aws tools against the local fake_s3 server
+(no AWS account, nor network access, needed).
+
+    pool      requests per second of small PUTs, which is what a static
+              deploy mostly does, with a fresh connection per request
+              (pool disabled) and with the keep-alive connection pool
+    upload    upload_all_to_s3 on synthetic static trees of 1k, 10k and
+              100k files: a first (cold) run uploading everything,
+              then a run with nothing to upload (with --async, over
+              the non-blocking connections of async_s3.py)
+    list      streaming listing of the bucket uploaded above
+    get       streaming download of a big object, in one stream and in
+              parallel segments, against GetResponse (all in memory)
+    sign      presigned urls of many keys: one by one, as generate_url
+              used to (a canonical string and a new hmac per url), in a
+              batch with QueryStringAuthGenerator.generate_urls, and
+              from its url cache
+
+Every run reports seconds, throughput (files/s, MB/s, keys/s, req/s or urls/s),
+requests and TCP handshakes.
+    E.g.: python benchmark_s3.py
+          python benchmark_s3.py --sizes 1000 --latency 0.005 pool upload
+
+The fake server can be made slower and less reliable (--latency and
+--error-rate), which is closer to what a deploy sees.
+
+To catch performance regressions (e.g. in CI), save the results of a
+known good version with --save, and compare later runs to them with
+--baseline: the exit status is 1 if any throughput dropped (or the
+number of handshakes grew) by more than --tolerance.
+    E.g.: python benchmark_s3.py --sizes 1000,10000 --save bench.json
+          python benchmark_s3.py --sizes 1000,10000 --baseline bench.json
+
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import time
+import urllib
+
+import S3
+from fake_s3 import FakeS3Server
+
+BUCKET_NAME = 'benchmark'
+PAYLOAD = 'x' * 4096
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_GET_SIZE = 64  # MB
+FILES_PER_FOLDER = 100
+# extension, share of the files, min and max size of a synthetic static file
+TREE_FILES = (('.css', 0.2, 2 * 1024, 40 * 1024),
+              ('.js', 0.3, 1 * 1024, 120 * 1024),
+              ('.png', 0.4, 512, 30 * 1024),
+              ('.svg', 0.1, 256, 8 * 1024))
+DEFAULT_URLS = 10000
+BENCHMARKS = ('pool', 'upload', 'list', 'get', 'sign')
+THROUGHPUTS = ('files/s', 'MB/s', 'keys/s', 'req/s', 'urls/s')
+DEFAULT_TOLERANCE = 0.25
+
+
+class Stats(object):
+    """ Counts the requests and handshakes done while it is open """
+    def __init__(self, server):
+        self.server = server
+
+    def __enter__(self):
+        self.requests = self.server.requests
+        self.connections = self.server.connections
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = max(time.time() - self.start_time, 0.001)
+        self.requests = self.server.requests - self.requests
+        self.connections = self.server.connections - self.connections
+
+    def result(self, name, **throughputs):
+        result = {'name': name, 'seconds': round(self.seconds, 3),
+                  'requests': self.requests, 'handshakes': self.connections}
+        for label, amount in throughputs.items():
+            result[label] = round(amount / self.seconds, 1)
+        return result
+
+
+def _get_connection(server, pool_size=S3.DEFAULT_POOL_SIZE):
+    return S3.AWSAuthConnection('key', 'secret', is_secure=False,
+                                server='localhost', port=server.port,
+                                calling_format=S3.CallingFormat.PATH,
+                                pool_size=pool_size)
+
+
+def _print_result(result):
+    throughputs = ', '.join('%.1f %s' % (result[t], t)
+                            for t in THROUGHPUTS if t in result)
+    print '%-32s %8.3f s  %-32s %7d requests %6d handshakes' % (
+        result['name'], result['seconds'], throughputs,
+        result['requests'], result['handshakes'])
+
+
+def _put_many(server, requests, pool_size):
+    """ PUTs requests small objects and returns how many failed """
+    conn = _get_connection(server, pool_size)
+    failed = 0
+    for i in xrange(requests):
+        reply = conn.put(BUCKET_NAME, 'file-%d.css' % i, S3.S3Object(PAYLOAD))
+        if reply.http_response.status != 200:
+            failed += 1
+    conn.close()
+    return failed
+
+
+def bench_connection_pool(server, requests):
+    results = []
+    for label, pool_size in (('new connection per request', 0),
+                             ('keep-alive pool', S3.DEFAULT_POOL_SIZE)):
+        with Stats(server) as stats:
+            failed = _put_many(server, requests, pool_size)
+        result = stats.result('pool: %s' % label, **{'req/s': requests})
+        result['failed'] = failed
+        results.append(result)
+    return results
+
+
+def _make_tree(root, count, seed=0):
+    """
+    Writes count files of TREE_FILES types and sizes under root,
+    FILES_PER_FOLDER per folder. Text files compress like real ones do
+    (somewhat), images don't at all.
+
+    """
+    rand = random.Random(seed)
+    words = ['.class-%d{color:#%06x;margin:%dpx}' % (
+             i, rand.randint(0, 0xffffff), i % 40) for i in range(500)]
+    kinds = []
+    for extension, share, min_size, max_size in TREE_FILES:
+        kinds.extend([(extension, min_size, max_size)] * int(share * 100))
+
+    for i in xrange(count):
+        folder = os.path.join(root, 'd%04d' % (i // FILES_PER_FOLDER))
+        if i % FILES_PER_FOLDER == 0:
+            os.makedirs(folder)
+        extension, min_size, max_size = kinds[i % len(kinds)]
+        size = rand.randint(min_size, max_size)
+        if extension in ('.css', '.js', '.svg'):
+            content = []
+            length = 0
+            while length < size:
+                content.append(rand.choice(words))
+                length += len(content[-1])
+            content = ''.join(content)[:size]
+        else:
+            content = os.urandom(size)
+        filename = os.path.join(folder, 'f%06d%s' % (i, extension))
+        with open(filename, 'wb') as f:
+            f.write(content)
+
+
+def _run_upload(uploader, root, jobs, use_async=False):
+    """ upload_all_to_s3, without its per file output """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return uploader.upload_all_to_s3(root, jobs=jobs, use_async=use_async)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _import_uploader(server):
+    """ upload_static_s3, talking to server (see defaults.S3_ENDPOINT) """
+    os.environ['AWS_S3_ENDPOINT'] = 'localhost:%d' % server.port
+    import upload_static_s3
+    return upload_static_s3
+
+
+def bench_upload(server, uploader, count, jobs, workdir, use_async=False):
+    """
+    Uploads a synthetic tree of count files twice: cold (empty bucket,
+    index and compression cache) and with nothing changed.
+    With use_async, over the non-blocking connections of async_s3.py.
+
+    """
+    import precompress
+    import optimize_images
+
+    root = os.path.join(workdir, 'static-%d' % count)
+    _make_tree(root, count)
+    server.clear(uploader.BUCKET_NAME)
+    uploader.LOCAL_METADATA_FILE = os.path.join(root, 'META.local.json')
+    uploader.LOCAL_INDEX_FILE = os.path.join(root, 'META.local.idx')
+    uploader.LOCAL_MANIFEST_FILE = os.path.join(root, uploader.MANIFEST_FILE)
+    uploader.LOCAL_JOURNAL_FILE = os.path.join(root, 'META.local.journal')
+    uploader.LOCAL_HISTORY_FILE = os.path.join(root, 'META.local.history')
+    precompress.CACHE_DIR = os.path.join(workdir, 'precompress-%d' % count)
+    optimize_images.CACHE_DIR = os.path.join(workdir, 'images-%d' % count)
+
+    results = []
+    for label in ('cold', 'unchanged'):
+        with Stats(server) as stats:
+            report = _run_upload(uploader, root, jobs, use_async)
+        result = stats.result('upload %s %d%s' % (label, count,
+                                                  ' async' if use_async
+                                                  else ''),
+                              **{'files/s': count,
+                                 'MB/s': report.bytes / 1024.0 / 1024})
+        result['uploads'] = report.files
+        result['retries'] = report.retries
+        result['failed'] = len(report.failed)
+        results.append(result)
+    return results
+
+
+def bench_listing(server, bucket):
+    conn = _get_connection(server)
+    with Stats(server) as stats:
+        keys = sum(1 for entry in conn.iter_bucket(bucket))
+    conn.close()
+    return [stats.result('list %d keys' % keys, **{'keys/s': keys})]
+
+
+def bench_streaming_get(server, size_mb, workdir):
+    conn = _get_connection(server)
+    size = size_mb * 1024 * 1024
+    server.put_object(BUCKET_NAME, 'big', os.urandom(1024) * (size // 1024))
+    filename = os.path.join(workdir, 'big')
+
+    results = []
+    for label, threads in (('stream', 1), ('4 segments', 4)):
+        with Stats(server) as stats:
+            conn.get_file(BUCKET_NAME, 'big', filename, resume=False,
+                          threads=threads, segment_size=size // threads)
+        os.remove(filename)
+        results.append(stats.result('get %d MB %s' % (size_mb, label),
+                                    **{'MB/s': size_mb}))
+    with Stats(server) as stats:
+        conn.get(BUCKET_NAME, 'big')
+    results.append(stats.result('get %d MB in memory' % size_mb,
+                                **{'MB/s': size_mb}))
+    conn.close()
+    return results
+
+
+def _sign_one_by_one(generator, bucket, keys):
+    """ What generate_url did for every url, before generate_urls """
+    url_base = S3.CallingFormat.build_url_base(
+        generator.protocol, generator.server, generator.port, bucket,
+        generator.calling_format)
+    urls = []
+    for key in keys:
+        expires = int(time.time() + generator.DEFAULT_EXPIRES_IN)
+        canonical = S3.canonical_string('GET', bucket, key, {}, {}, expires)
+        query_args = {'Signature': S3.encode(generator.aws_secret_access_key,
+                                             canonical),
+                      'Expires': expires,
+                      'AWSAccessKeyId': generator.aws_access_key_id}
+        urls.append('%s/%s?%s' % (url_base, urllib.quote_plus(key),
+                                  S3.query_args_hash_to_string(query_args)))
+    return urls
+
+
+def bench_signing(server, count):
+    generator = S3.QueryStringAuthGenerator('key', 'secret')
+    keys = ['photos/%04d/%06d.jpg' % (i // 1000, i) for i in xrange(count)]
+    results = []
+    for label, sign in (('one by one', _sign_one_by_one),
+                        ('batch', generator.generate_urls),
+                        ('cached', generator.generate_urls)):
+        with Stats(server) as stats:
+            if label == 'one by one':
+                sign(generator, BUCKET_NAME, keys)
+            else:
+                sign('GET', BUCKET_NAME, keys)
+        results.append(stats.result('sign %d urls %s' % (count, label),
+                                    **{'urls/s': count}))
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns a message for every result which is worse than its
+    baseline one (same name) by more than tolerance.
+
+    """
+    baseline = dict((r['name'], r) for r in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(result['name'])
+        if not base:
+            continue
+        for label in THROUGHPUTS:
+            if label in result and label in base and \
+                    result[label] < base[label] * (1 - tolerance):
+                regressions.append('%s: %.1f %s, was %.1f' % (
+                    result['name'], result[label], label, base[label]))
+        if result['handshakes'] > base['handshakes'] * (1 + tolerance):
+            regressions.append('%s: %d handshakes, was %d' % (
+                result['name'], result['handshakes'], base['handshakes']))
+    return regressions
+
+
+def main(args):
+    server = FakeS3Server(latency=args.latency, error_rate=args.error_rate,
+                          seed=0)
+    server.start()
+    uploader = _import_uploader(server)
+    workdir = tempfile.mkdtemp(prefix='benchmark_s3-')
+    results = []
+    benchmarks = args.benchmarks or BENCHMARKS
+    try:
+        if 'pool' in benchmarks:
+            results.extend(bench_connection_pool(server, args.requests))
+        for count in args.sizes:
+            if 'upload' in benchmarks:
+                results.extend(bench_upload(server, uploader, count,
+                                            args.jobs, workdir,
+                                            args.use_async))
+            if 'list' in benchmarks:
+                # what the upload benchmark left there
+                results.extend(bench_listing(server, uploader.BUCKET_NAME))
+        if 'get' in benchmarks:
+            results.extend(bench_streaming_get(server, args.get_size, workdir))
+        if 'sign' in benchmarks:
+            results.extend(bench_signing(server, args.urls))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+    for result in results:
+        _print_result(result)
+    if server.errors:
+        print 'Injected errors: %d of %d requests' % (server.errors,
+                                                     server.requests)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print 'REGRESSIONS against %s:' % args.baseline
+            for regression in regressions:
+                print '    %s' % regression
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark S3.py and the '
+                                                 'static uploader offline')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, among %s (default: all)' %
+                             ', '.join(BENCHMARKS))
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='files in the synthetic static trees')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests of the pool benchmark')
+    parser.add_argument('--get-size', type=int, default=DEFAULT_GET_SIZE,
+                        help='MB of the object to download')
+    parser.add_argument('--urls', type=int, default=DEFAULT_URLS,
+                        help='urls to sign')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='concurrent uploads')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='upload over non-blocking connections')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added by the server to every reply')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests failing with a 500')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline',
+                        help='compare the results to this json file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fraction a result may be worse than '
+                             'its baseline')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    sys.exit(main(args))
@@ -22,17 +22,28 @@ which are used in other scripts under this package:
     #S3 constants:
     STATIC_BUCKET_NAME
     MEDIA_BUCKET_NAME
+    S3_ENDPOINT (empty, unless AWS_S3_ENDPOINT is set)
 
 
 
 Dependencies: AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY on os.environ
 
+To talk to some other S3-compatible server (e.g. a local fake_s3.py),
+set AWS_S3_ENDPOINT=host:port on os.environ. Auth keys are optional then.
+
 """
 import os
+
+#S3-compatible server to use instead of AWS S3 (plain http, path-style)
+S3_ENDPOINT = os.environ.get('AWS_S3_ENDPOINT', '')
+
 try:
     AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
     AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
-except:
+except KeyError:
+    if S3_ENDPOINT:
+        AWS_ACCESS_KEY_ID = AWS_SECRET_ACCESS_KEY = 'local'
+    else:
         print """
         Please, define the following parameters as OS environment variables.
             AWS_ACCESS_KEY_ID
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+A tiny in-memory S3 stand-in, served over plain HTTP/1.1 on localhost.
+
+It understands just enough of the S3 REST API (path calling format)
+to exercise S3.py without AWS credentials or network access:
+
+    PUT /bucket/key     stores the request body
+    GET /bucket/key     returns a stored body (or a Range of it)
+    GET /bucket         lists keys (prefix, marker and max-keys, paged)
+    POST /bucket?delete deletes many keys at once
+    HEAD /bucket        checks a bucket exists (any bucket does)
+    HEAD /bucket/key    checks a key exists
+    DELETE /bucket/key  deletes a key
+
+and multipart uploads: POST ?uploads, PUT ?partNumber&uploadId,
+POST ?uploadId (complete) and DELETE ?uploadId (abort).
+A Content-MD5 header, if sent, is checked against the body,
+and an If-Match header against the ETag of the key.
+
+Requests are not authenticated.
+Keep-alive connections are supported, and the number of accepted
+TCP connections is counted, so benchmarks can report handshakes.
+
+A real bucket is slower and less reliable: latency (seconds) is added
+to every reply, and a fraction error_rate of the requests (at random)
+get a 500 InternalError reply instead.
+
+Usage:
+    server = FakeS3Server(latency=0.02, error_rate=0.01)
+    server.start()
+    conn = S3.AWSAuthConnection('key', 'secret', is_secure=False,
+                                server='localhost', port=server.port,
+                                calling_format=S3.CallingFormat.PATH)
+    ...
+    server.stop()
+
+"""
+import base64
+import bisect
+import hashlib
+import re
+import socket
+import sys
+import random
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from xml.sax.saxutils import escape, unescape
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each reply in one segment, instead of one per header line,
+    # so keep-alive connections don't stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """ Keep benchmarks quiet """
+        pass
+
+    def parse_request(self):
+        """ Counts requests, and injects the server latency and errors """
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.server.should_fail():
+            return True
+        # the body must be read, for the connection to be reused
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self._error(500, 'InternalError')
+        # the reply is buffered, and only flushed after a handled request
+        self.wfile.flush()
+        return False
+
+    def _split_path(self):
+        path = self.path.split('?', 1)[0]
+        parts = path.lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = urllib.unquote_plus(parts[1]) if len(parts) > 1 else ''
+        return bucket, key
+
+    def _query_args(self):
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        return dict(urlparse.parse_qsl(query, keep_blank_values=True))
+
+    def _error(self, status, code):
+        self._reply(status, '<Error><Code>%s</Code></Error>' % code)
+
+    def _reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        """ Returns the request body, or None if its Content-MD5 is wrong """
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        md5 = self.headers.getheader('content-md5')
+        if md5 and md5 != base64.b64encode(hashlib.md5(body).digest()):
+            self._error(400, 'BadDigest')
+            return None
+        return body
+
+    def do_PUT(self):
+        bucket, key = self._split_path()
+        body = self._read_body()
+        if body is None:
+            return
+        args = self._query_args()
+        if 'uploadId' in args:
+            etag = self.server.put_part(args['uploadId'],
+                                        int(args['partNumber']), body)
+            if etag is None:
+                return self._error(404, 'NoSuchUpload')
+        else:
+            etag = self.server.put_object(bucket, key, body)
+        self._reply(200, headers={'ETag': etag})
+
+    def do_GET(self):
+        bucket, key = self._split_path()
+        if not key:
+            return self._list_bucket(bucket)
+        body = self.server.store.get((bucket, key))
+        if body is None:
+            return self._error(404, 'NoSuchKey')
+        etag = self.server.info[(bucket, key)][0]
+        if self.headers.getheader('if-match', etag) != etag:
+            return self._error(412, 'PreconditionFailed')
+        headers = {'ETag': etag}
+        match = re.match(r'bytes=(\d+)-(\d*)$',
+                         self.headers.getheader('range', ''))
+        if not match:
+            return self._reply(200, body, headers)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        if start >= len(body):
+            return self._error(416, 'InvalidRange')
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+        self._reply(206, body[start:end + 1], headers)
+
+    def _list_bucket(self, bucket):
+        args = self._query_args()
+        prefix = args.get('prefix', '')
+        max_keys = int(args.get('max-keys', self.server.max_keys))
+        keys = self.server.list_keys(bucket, prefix, args.get('marker', ''),
+                                     max_keys + 1)
+        is_truncated = len(keys) > max_keys
+
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+               '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+               '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>' %
+               (escape(bucket), escape(prefix), escape(args.get('marker', ''))),
+               '<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>' %
+               (max_keys, is_truncated and 'true' or 'false')]
+        for key in keys[:max_keys]:
+            etag, last_modified, size = self.server.info[(bucket, key)]
+            xml.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                       '<ETag>&quot;%s&quot;</ETag><Size>%d</Size>'
+                       '<StorageClass>STANDARD</StorageClass></Contents>' %
+                       (escape(key), last_modified, etag.strip('"'), size))
+        xml.append('</ListBucketResult>')
+        self._reply(200, ''.join(xml), {'Content-Type': 'application/xml'})
+
+    def do_POST(self):
+        bucket, key = self._split_path()
+        body = self._read_body()
+        if body is None:
+            return
+        args = self._query_args()
+        if 'uploads' in args:
+            upload_id = self.server.create_upload(bucket, key)
+            return self._reply(200, '<InitiateMultipartUploadResult>'
+                               '<Bucket>%s</Bucket><Key>%s</Key>'
+                               '<UploadId>%s</UploadId>'
+                               '</InitiateMultipartUploadResult>' %
+                               (escape(bucket), escape(key), upload_id))
+        if 'uploadId' in args:
+            return self._complete_upload(bucket, key, args['uploadId'], body)
+        if 'delete' not in args:
+            return self._error(400, 'NotImplemented')
+        keys = [unescape(k) for k in re.findall('<Key>(.*?)</Key>', body)]
+        for key in keys:
+            self.server.delete_object(bucket, key)
+        deleted = '' if '<Quiet>true</Quiet>' in body else \
+                ''.join(['<Deleted><Key>%s</Key></Deleted>' % escape(k)
+                         for k in keys])
+        self._reply(200, '<DeleteResult>%s</DeleteResult>' % deleted,
+                    {'Content-Type': 'application/xml'})
+
+    def _complete_upload(self, bucket, key, upload_id, body):
+        parts = [(int(n), unescape(etag)) for n, etag in
+                 re.findall(r'<PartNumber>(\d+)</PartNumber>'
+                            r'<ETag>(.*?)</ETag>', body)]
+        error = None
+        if upload_id not in self.server.uploads:
+            error = 'NoSuchUpload'
+        else:
+            etag = self.server.complete_upload(upload_id, parts)
+            if etag is None:
+                error = 'InvalidPart'
+        if error:
+            # real S3 may also send an error after a 200 status
+            return self._error(200, error)
+        self._reply(200, '<CompleteMultipartUploadResult>'
+                    '<Bucket>%s</Bucket><Key>%s</Key>'
+                    '<ETag>%s</ETag></CompleteMultipartUploadResult>' %
+                    (escape(bucket), escape(key), escape(etag)))
+
+    def do_DELETE(self):
+        bucket, key = self._split_path()
+        args = self._query_args()
+        if 'uploadId' in args:
+            if not self.server.abort_upload(args['uploadId']):
+                return self._error(404, 'NoSuchUpload')
+        else:
+            self.server.delete_object(bucket, key)
+        self._reply(204)
+
+    def do_HEAD(self):
+        bucket, key = self._split_path()
+        if not key:
+            self._reply(200)
+        elif (bucket, key) not in self.server.store:
+            self._reply(404)
+        else:
+            self._reply(200, self.server.store[(bucket, key)],
+                        {'ETag': self.server.info[(bucket, key)][0]})
+
+
+class FakeS3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=0, latency=0.0, error_rate=0.0,
+                 seed=None):
+        HTTPServer.__init__(self, (host, port), FakeS3Handler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0  # injected ones
+        self._random = random.Random(seed)
+        self.store = {}
+        self.info = {}  # (bucket, key) -> (etag, last_modified, size)
+        self.max_keys = 1000
+        self.connections = 0
+        self.uploads = {}  # upload id -> (bucket, key, {part number: body})
+        self._thread = None
+        self._sorted_keys = {}
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        """ Should the current request get an injected error """
+        if not self.error_rate:
+            return False
+        with self._lock:
+            if self._random.random() >= self.error_rate:
+                return False
+            self.errors += 1
+            return True
+
+    def put_object(self, bucket, key, body, etag=None):
+        """ Stores body and returns its ETag """
+        etag = etag or '"%s"' % hashlib.md5(body).hexdigest()
+        last_modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        with self._lock:
+            if (bucket, key) not in self.store:
+                self._sorted_keys.pop(bucket, None)
+            self.store[(bucket, key)] = body
+            self.info[(bucket, key)] = (etag, last_modified, len(body))
+        return etag
+
+    def delete_object(self, bucket, key):
+        with self._lock:
+            if self.store.pop((bucket, key), None) is not None:
+                self._sorted_keys.pop(bucket, None)
+            self.info.pop((bucket, key), None)
+
+    def create_upload(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = (bucket, key, {})
+        return upload_id
+
+    def put_part(self, upload_id, number, body):
+        """ Stores a part and returns its ETag (None if no such upload) """
+        with self._lock:
+            if upload_id not in self.uploads:
+                return None
+            self.uploads[upload_id][2][number] = body
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def complete_upload(self, upload_id, parts):
+        """
+        Stores the object made of the (number, etag) parts of an upload
+        and returns its ETag, or None if a part is missing or has
+        another ETag.
+
+        """
+        with self._lock:
+            bucket, key, bodies = self.uploads[upload_id]
+        digests = []
+        for number, etag in parts:
+            body = bodies.get(number)
+            if body is None:
+                return None
+            digest = hashlib.md5(body)
+            if digest.hexdigest() != etag.strip('"'):
+                return None
+            digests.append(digest.digest())
+        # the ETag of a multipart object is not the md5 of its content
+        etag = '"%s-%d"' % (hashlib.md5(''.join(digests)).hexdigest(),
+                            len(parts))
+        self.put_object(bucket, key, ''.join(bodies[n] for n, _ in parts),
+                        etag)
+        with self._lock:
+            self.uploads.pop(upload_id, None)
+        return etag
+
+    def abort_upload(self, upload_id):
+        with self._lock:
+            return self.uploads.pop(upload_id, None) is not None
+
+    def clear(self, bucket):
+        """ Deletes every key of bucket """
+        with self._lock:
+            for key in [k for k in self.store if k[0] == bucket]:
+                del self.store[key]
+                del self.info[key]
+            self._sorted_keys.pop(bucket, None)
+
+    def list_keys(self, bucket, prefix='', marker='', max_keys=1000):
+        """ Sorted keys of bucket starting with prefix, after marker """
+        with self._lock:
+            keys = self._sorted_keys.get(bucket)
+            if keys is None:
+                keys = sorted(k for b, k in self.store if b == bucket)
+                self._sorted_keys[bucket] = keys
+        if marker >= prefix:
+            start = bisect.bisect_right(keys, marker)
+        else:
+            start = bisect.bisect_left(keys, prefix)
+        found = []
+        for key in keys[start:]:
+            if not key.startswith(prefix) or len(found) == max_keys:
+                break
+            found.append(key)
+        return found
+
+    def get_request(self):
+        """ Counts every accepted connection (i.e. every handshake) """
+        request = HTTPServer.get_request(self)
+        self.connections += 1
+        return request
+
+    def handle_error(self, request, client_address):
+        """ Clients dropping their connections are not errors """
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,390 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Lossless optimization stage of the images uploaded by upload_static_s3.py
+
+PNG and JPEG files are recompressed without changing a single pixel,
+and stripped of the metadata browsers don't use (text chunks, EXIF,
+comments). The EXIF of a jpeg whose Orientation tag rotates (or flips)
+it is kept, as browsers apply it: the report marks those with a *.
+    png   with optipng if installed, which also picks the best row
+          filters; otherwise, by deflating the image data again at
+          zlib's best level (see _optimize_png)
+    jpeg  with jpegtran if installed (optimal Huffman tables);
+          otherwise, jpeg files are left as they are
+Work is spread over a pool of processes (one per CPU by default).
+
+Results are cached on disk (CACHE_DIR), keyed by the sha of the source
+image and the method used (with its version, see METHOD_VERSIONS), so
+every image is only processed once. An
+output which is not smaller than its source is not kept, but the result
+is cached all the same.
+
+It can also be run by itself, to warm up the cache and see the report:
+    E.g.: python optimize_images.py '../../public/static'
+
+
+Dependencies: optipng and jpegtran (optional, packages optipng and
+              libjpeg-turbo-progs)
+
+"""
+import os
+import sys
+import time
+import json
+import zlib
+import struct
+import hashlib
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+from multiprocessing import Pool, cpu_count
+
+CACHE_DIR = os.path.expanduser('~/.cache/static-images')
+CHUNK_SIZE = 64 * 1024
+OPTIPNG_LEVEL = 2  # -o2: optipng's default, a good speed/size tradeoff
+IMAGE_EXTENSIONS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg'}
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+# ancillary png chunks with nothing a browser renders
+PNG_METADATA_CHUNKS = ('tEXt', 'zTXt', 'iTXt', 'tIME', 'eXIf')
+EXIF_ORIENTATION_TAG = 0x0112
+# bumped when the outputs of a method change, so that its cache is redone
+METHOD_VERSIONS = {'jpegtran': 2}  # 2: keeps the EXIF orientation
+
+OPTIPNG = find_executable('optipng')
+JPEGTRAN = find_executable('jpegtran')
+
+
+class Optimized(object):
+    """
+    Optimization result of a source image (with the given sha and size):
+    the path of the cached output (None if it is not smaller than the
+    source), its size and md5, the method used and the seconds it took
+    (0 when it came from the cache). kept_exif is set if the EXIF of the
+    source was kept, for its Orientation tag.
+
+    error is set if the optimizer could not be run: nothing was cached
+    then, so that the next run tries again.
+
+    """
+    def __init__(self, filename, sha, size, method=None):
+        self.filename = filename
+        self.sha = sha
+        self.size = size
+        self.method = method
+        self.path = None
+        self.optimized_size = size
+        self.md5 = None
+        self.seconds = 0.0
+        self.cached = True
+        self.kept_exif = False
+        self.error = None
+
+    @property
+    def saved(self):
+        return self.size - self.optimized_size
+
+
+def can_be_optimized(filename):
+    """ Is filename a PNG/JPEG image """
+    extension = os.path.splitext(filename)[1].lower()
+    return extension in IMAGE_EXTENSIONS
+
+
+def _get_method(filename):
+    """ Name of the optimizer of filename (None if there is none) """
+    kind = IMAGE_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    if kind == 'png':
+        return 'optipng' if OPTIPNG else 'zlib'
+    if kind == 'jpeg' and JPEGTRAN:
+        return 'jpegtran'
+    return None
+
+
+def _cache_path(sha, method, extension):
+    version = METHOD_VERSIONS.get(method)
+    key = '%s%s' % (method, version) if version else method
+    return os.path.join(CACHE_DIR, sha[:2], '%s.%s%s' % (sha, key,
+                                                        extension))
+
+
+def _jpeg_orientation(filename):
+    """
+    EXIF Orientation tag of a jpeg file, from 1 (upright) to 8.
+    Returns None if there is none, or filename is not a valid jpeg.
+
+    """
+    with open(filename, 'rb') as f:
+        if f.read(2) != '\xff\xd8':
+            return None
+        while True:
+            header = f.read(4)
+            if len(header) < 4 or header[0] != '\xff':
+                return None
+            marker, length = struct.unpack('>xBH', header)
+            if marker == 0xda or length < 2:  # image data: no more metadata
+                return None
+            body = f.read(length - 2)
+            if marker == 0xe1 and body.startswith('Exif\0\0'):
+                return _exif_orientation(body[6:])
+
+
+def _exif_orientation(tiff):
+    """ Orientation tag in the first IFD of tiff, the EXIF data """
+    order = {'II': '<', 'MM': '>'}.get(tiff[:2])
+    if order is None or len(tiff) < 8:
+        return None
+    offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    if offset + 2 > len(tiff):
+        return None
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = tiff[offset + 2 + 12 * i:offset + 14 + 12 * i]
+        if len(entry) < 12:
+            return None
+        tag, kind, _, value = struct.unpack(order + 'HHI4s', entry)
+        if tag == EXIF_ORIENTATION_TAG and kind == 3:  # a SHORT
+            return struct.unpack(order + 'H', value[:2])[0]
+    return None
+
+
+def _optimize_png(filename, out):
+    """
+    Writes filename to out with its image data deflated again at zlib's
+    best level (keeping the smaller of two strategies), in a single
+    IDAT chunk, and without metadata chunks. Pixels, row filters and
+    every other chunk are kept as they are.
+
+    Raises ValueError if filename is not a valid png.
+
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('not a png file')
+    chunks = []
+    idat = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        if position + 8 > len(data):
+            raise ValueError('truncated png chunk')
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        if len(body) != length:
+            raise ValueError('truncated png chunk')
+        position += 12 + length
+        if kind == 'IDAT':
+            if not idat:
+                chunks.append(('IDAT', None))  # where the image data goes
+            idat.append(body)
+        elif kind not in PNG_METADATA_CHUNKS:
+            chunks.append((kind, body))
+        if kind == 'IEND':
+            break
+    if not idat:
+        raise ValueError('png file without image data')
+
+    try:
+        pixels = zlib.decompress(''.join(idat))
+    except zlib.error as e:
+        raise ValueError('corrupt png image data: %s' % e)
+    candidates = []
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidates.append(compressor.compress(pixels) + compressor.flush())
+    image_data = min(candidates, key=len)
+
+    out.write(PNG_SIGNATURE)
+    for kind, body in chunks:
+        if body is None:
+            body = image_data
+        out.write(struct.pack('>I4s', len(body), kind))
+        out.write(body)
+        out.write(struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+
+
+def _run_optimizer(method, filename, output_path, keep_exif=False):
+    """
+    Writes the optimized version of filename to output_path, with the
+    EXIF of the source if keep_exif is True (jpegtran only)
+
+    """
+    if method == 'zlib':
+        with open(output_path, 'wb') as out:
+            _optimize_png(filename, out)
+        return
+    if method == 'optipng':
+        command = [OPTIPNG, '-quiet', '-o%d' % OPTIPNG_LEVEL, '-strip', 'all',
+                   '-clobber', '-out', output_path, filename]
+    else:
+        command = [JPEGTRAN, '-copy', 'exif' if keep_exif else 'none',
+                   '-optimize',
+                   '-outfile', output_path, filename]
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull, stderr=devnull)
+
+
+def _file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _load_result(optimized, result_path, output_path):
+    with open(result_path) as f:
+        result = json.load(f)
+    if result['size'] < optimized.size:
+        optimized.path = output_path
+        optimized.optimized_size = result['size']
+        optimized.md5 = result['md5']
+    optimized.kept_exif = result.get('exif', False)
+
+
+def optimize_file(args):
+    """
+    Optimizes a (filename, sha, size) source image with the best method
+    available, unless already cached. Returns an Optimized.
+
+    """
+    filename, sha, size = args
+    method = _get_method(filename)
+    optimized = Optimized(filename, sha, size, method)
+    if method is None:
+        return optimized
+
+    extension = os.path.splitext(filename)[1].lower()
+    output_path = _cache_path(sha, method, extension)
+    result_path = _cache_path(sha, method, '.json')
+    if os.path.exists(result_path):
+        _load_result(optimized, result_path, output_path)
+        return optimized
+
+    start_time = time.time()
+    folder = os.path.dirname(output_path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # made by another worker in the meantime
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=folder)
+    os.close(fd)
+    try:
+        # browsers rotate jpegs by their EXIF orientation
+        keep_exif = method == 'jpegtran' and \
+            _jpeg_orientation(filename) not in (None, 1)
+        try:
+            _run_optimizer(method, filename, tmp_path, keep_exif)
+        except (ValueError, subprocess.CalledProcessError):
+            # not an image the optimizer can handle: nothing to gain, ever
+            result = {'size': size, 'md5': None}
+        else:
+            result = {'size': os.path.getsize(tmp_path),
+                      'md5': _file_md5(tmp_path), 'exif': keep_exif}
+            if result['size'] < size:
+                os.rename(tmp_path, output_path)
+        # the result only shows up once its output is in place
+        with open(tmp_path + '.json', 'w') as f:
+            json.dump(result, f)
+        os.rename(tmp_path + '.json', result_path)
+    except OSError as e:
+        optimized.error = str(e)
+        return optimized
+    finally:
+        for path in (tmp_path, tmp_path + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    _load_result(optimized, result_path, output_path)
+    optimized.cached = False
+    optimized.seconds = time.time() - start_time
+    return optimized
+
+
+def optimize_files(sources, jobs=None):
+    """
+    Optimizes all (filename, sha, size) source images, over a pool of
+    jobs processes (one per CPU by default).
+    Cached ones are not even sent to the pool.
+
+    Returns a dict of filename -> Optimized.
+
+    """
+    results = {}
+    missing = []
+    for source in sources:
+        if _is_cached(source[0], source[1]):
+            results[source[0]] = optimize_file(source)
+        else:
+            missing.append(source)
+
+    if missing:
+        pool = Pool(jobs or cpu_count())
+        try:
+            for optimized in pool.imap_unordered(optimize_file, missing):
+                results[optimized.filename] = optimized
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def _is_cached(filename, sha):
+    method = _get_method(filename)
+    return method is None or os.path.exists(_cache_path(sha, method, '.json'))
+
+
+def print_report(results, home=''):
+    """ Prints the savings and time of each optimized image, and totals """
+    if not results:
+        return
+    print 'Image optimization report (saved = 1 - optimized / original size):'
+    print '    %-50s %10s %10s %7s %9s %9s' % ('file', 'bytes', 'optimized',
+                                               'saved', 'method', 'ms')
+    total_size = total_optimized = total_seconds = kept_exif = 0
+    for filename in sorted(results):
+        o = results[filename]
+        if o.error:
+            status = 'failed: %s' % o.error
+        else:
+            status = 'cached' if o.cached else '%.1f' % (o.seconds * 1000)
+        print '    %-50s %10d %10d %6.1f%% %9s %9s' % (
+            os.path.relpath(filename, home) if home else filename,
+            o.size, o.optimized_size,
+            100.0 * o.saved / o.size if o.size else 0.0,
+            (o.method or '-') + ('*' if o.kept_exif else ''), status)
+        kept_exif += o.kept_exif
+        total_size += o.size
+        total_optimized += o.optimized_size
+        total_seconds += o.seconds
+    print '    %s images, %.1f KB --> %.1f KB, %.3f s optimizing' % (
+        len(results), total_size / 1024.0, total_optimized / 1024.0,
+        total_seconds)
+    if kept_exif:
+        print '    * %s jpeg files keep their EXIF, which rotates them' % \
+            kept_exif
+    if not JPEGTRAN:
+        print '    (jpegtran not found: jpeg files are left as they are)'
+
+
+def _get_sources(folder):
+    """ (filename, sha, size) of every png/jpeg image inside folder """
+    sources = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            filename = os.path.join(root, name)
+            if not can_be_optimized(filename):
+                continue
+            sha = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    sha.update(chunk)
+            sources.append((filename, sha.hexdigest(),
+                            os.path.getsize(filename)))
+    return sources
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1]
+    print_report(optimize_files(_get_sources(folder)), home=folder)
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Precompression stage of the static files uploaded by upload_static_s3.py
+
+Text files (css/js) are compressed with the best ratio available:
+gzip at its max level and, if the brotli module is installed, brotli too.
+Work is spread over a pool of processes (one per CPU by default).
+
+Compressed outputs are cached on disk (CACHE_DIR), keyed by the sha of
+the source file, so a file already compressed by an earlier run (or for
+another path, with the same content) costs nothing but a stat.
+
+It can also be run by itself, to warm up the cache and see the report:
+    E.g.: python precompress.py '../../public/static'
+
+The report lists, per file, the compression ratio (compressed / original
+size) and the time spent. Outputs whose ratio is above WORTH_RATIO save
+next to nothing (or even grow the file): they are not used, and their
+files are flagged.
+
+
+Dependencies: brotli (optional)
+
+"""
+import os
+import sys
+import time
+import hashlib
+import mimetypes
+import tempfile
+from gzip import GzipFile
+from multiprocessing import Pool, cpu_count
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHE_DIR = os.path.expanduser('~/.cache/static-precompress')
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+CHUNK_SIZE = 64 * 1024
+WORTH_RATIO = 0.9  # outputs which don't compress below this are not used
+TEXT_TYPES = ('text/css', 'text/javascript',
+              'application/javascript', 'application/css')
+
+
+class Compressed(object):
+    """
+    Compressed versions of a source file (with the given sha and size):
+    paths of the cached outputs, their sizes and the seconds it took
+    to compress them (0 when they came from the cache).
+
+    A path is None if its output is not worth using (see WORTH_RATIO),
+    and brotli_path also if brotli is not available. Sizes are kept
+    either way, for the report.
+
+    """
+    def __init__(self, filename, sha, size):
+        self.filename = filename
+        self.sha = sha
+        self.size = size
+        self.gzip_path = None
+        self.gzip_size = 0
+        self.brotli_path = None
+        self.brotli_size = 0
+        self.seconds = 0.0
+        self.cached = True
+
+    def ratio(self, compressed_size):
+        return float(compressed_size) / self.size if self.size else 1.0
+
+    def is_worth(self, compressed_size):
+        return self.ratio(compressed_size) <= WORTH_RATIO
+
+
+def can_be_compressed(filename):
+    """ Is filename a Text Type (CSS/JS) """
+    return mimetypes.guess_type(filename)[0] in TEXT_TYPES
+
+
+def _cache_path(sha, extension):
+    return os.path.join(CACHE_DIR, sha[:2], sha + extension)
+
+
+def _write_to_cache(path, filename, compressor_factory):
+    """
+    Streams filename through the compressor made by compressor_factory
+    (given the output file, returns a (write, finish) pair of callables)
+    into path. The output only shows up at path once it is complete.
+
+    """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # made by another worker in the meantime
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write, finish = compressor_factory(out)
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    write(chunk)
+            finish()
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def _gzip_compressor(out):
+    # mtime=0 and no file name: same content, same gzipped bytes
+    zfile = GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL,
+                     fileobj=out, mtime=0)
+    return zfile.write, zfile.close
+
+
+def _brotli_compressor(out):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    return (lambda chunk: out.write(compressor.process(chunk)),
+            lambda: out.write(compressor.finish()))
+
+
+def compress_file(args):
+    """
+    Compresses a (filename, sha, size) source file with every codec
+    available, unless already cached. Returns a Compressed.
+
+    """
+    filename, sha, size = args
+    compressed = Compressed(filename, sha, size)
+    start_time = time.time()
+
+    codecs = [('.gz', _gzip_compressor)]
+    if brotli:
+        codecs.append(('.br', _brotli_compressor))
+    for extension, compressor_factory in codecs:
+        path = _cache_path(sha, extension)
+        if not os.path.exists(path):
+            _write_to_cache(path, filename, compressor_factory)
+            compressed.cached = False
+        size = os.path.getsize(path)
+        if not compressed.is_worth(size):
+            path = None
+        if extension == '.gz':
+            compressed.gzip_path = path
+            compressed.gzip_size = size
+        else:
+            compressed.brotli_path = path
+            compressed.brotli_size = size
+
+    if not compressed.cached:
+        compressed.seconds = time.time() - start_time
+    return compressed
+
+
+def precompress_files(sources, jobs=None):
+    """
+    Compresses all (filename, sha, size) sources, over a pool of jobs
+    processes (one per CPU by default).
+    Cached ones are not even sent to the pool.
+
+    Returns a dict of filename -> Compressed.
+
+    """
+    results = {}
+    missing = []
+    for source in sources:
+        if _is_cached(source[1]):
+            results[source[0]] = compress_file(source)
+        else:
+            missing.append(source)
+
+    if missing:
+        pool = Pool(jobs or cpu_count())
+        try:
+            for compressed in pool.imap_unordered(compress_file, missing):
+                results[compressed.filename] = compressed
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def _is_cached(sha):
+    extensions = ['.gz', '.br'] if brotli else ['.gz']
+    return all(os.path.exists(_cache_path(sha, e)) for e in extensions)
+
+
+def print_report(results, home=''):
+    """ Prints ratio and time of each compressed file, and totals """
+    if not results:
+        return
+    print 'Precompression report (ratio = compressed / original size):'
+    print '    %-50s %10s %7s %7s %9s' % ('file', 'bytes', 'gzip', 'brotli',
+                                          'ms')
+    total_size = total_gzip = total_brotli = total_seconds = 0
+    for filename in sorted(results):
+        c = results[filename]
+        flag = ''
+        if not c.gzip_path:
+            flag = '  <- not worth compressing, sent as is'
+        print '    %-50s %10d %7.3f %7s %9s%s' % (
+            os.path.relpath(filename, home) if home else filename,
+            c.size, c.ratio(c.gzip_size),
+            '%.3f' % c.ratio(c.brotli_size) if brotli else '-',
+            'cached' if c.cached else '%.1f' % (c.seconds * 1000), flag)
+        total_size += c.size
+        total_gzip += c.gzip_size
+        total_brotli += c.brotli_size
+        total_seconds += c.seconds
+    print '    %s files, %.1f KB --> gzip %.1f KB%s, %.3f s compressing' % (
+        len(results), total_size / 1024.0, total_gzip / 1024.0,
+        ', brotli %.1f KB' % (total_brotli / 1024.0) if brotli else '',
+        total_seconds)
+
+
+def _get_sources(folder):
+    """ (filename, sha, size) of every compressible file inside folder """
+    sources = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            filename = os.path.join(root, name)
+            if not can_be_compressed(filename):
+                continue
+            sha = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    sha.update(chunk)
+            sources.append((filename, sha.hexdigest(),
+                            os.path.getsize(filename)))
+    return sources
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1]
+    print_report(precompress_files(_get_sources(folder)), home=folder)
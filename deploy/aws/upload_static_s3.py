@@ -9,9 +9,71 @@ The folder to search for is passed into as an argument.
 The above cmd should walk (recursively) over '../../public/static'
 and upload any file found to the S3 account configured.
 
-
-Dependencies: S3.py (just put in the same folder as this module)
+Uploads run concurrently over a pool of worker threads.
+The number of workers can be changed with --jobs:
+    E.g.: python upload_static_s3.py --jobs 16 '../../public/static'
+
+Only files whose size or mtime changed since the last run are hashed
+again (see LOCAL_INDEX_FILE). To hash every file, pass --rehash-all.
+
+By default, the files to upload are found by comparing local shas with
+the REMOTE_METADATA_FILE kept in the bucket. With --etag-diff, local md5s
+are compared with the ETags of a bucket listing instead, which is what
+is actually there (e.g. after a crashed deploy). Bucket keys with no
+local file are reported, and deleted if --delete-orphans is also given.
+    E.g.: python upload_static_s3.py --etag-diff '../../public/static'
+
+If HASHED_NAMES is True, every file is also published under a
+content-hashed name (css/style.css --> css/style.3fa2c1d4e5f6.css),
+cached for a year as immutable. The plain names are cached for a year
+too: css files still refer to images by them. The map of plain -> hashed
+names is written to LOCAL_MANIFEST_FILE and to the bucket, as
+MANIFEST_FILE, and kept as MANIFEST_HISTORY_PREFIX + the date of the
+run. The bucket is listed on every run to know which hashed names it
+holds: files missing one are uploaded again, and the manifest only
+lists the hashed names in the bucket. It is what
+contrib.storage.ManifestStaticFilesStorage uses to resolve {% static %}
+and {% static_asset %}, and the output of {% compress %} is linked by
+its hashed name through contrib.storage.HashedCompressorFileStorage.
+The hashed names of the last MANIFEST_HISTORY_SIZE manifests are left
+in the bucket, for pages still cached: --delete-orphans only deletes
+the older ones (and their manifests).
+
+Failed requests are retried, with exponential backoff. Files uploaded
+are journaled (LOCAL_JOURNAL_FILE), so that a run which is interrupted
+can be started again and only upload the remaining files.
+The exit status is 1 if any file failed to upload.
+
+With --async, uploads run over non-blocking connections (async_s3.py)
+driven by a single thread instead of the worker pool, so that --jobs can
+be raised to many more connections than threads would be worth, e.g. to
+keep a high-latency link busy:
+    E.g.: python upload_static_s3.py --async --jobs 64 '../../public/static'
+
+To preview a deploy without uploading anything, pass --plan: it prints
+the files which would be uploaded, their raw and compressed sizes, the
+number of requests and an estimated duration. The estimate comes from
+the throughput of the last runs, recorded in LOCAL_HISTORY_FILE.
+    E.g.: python upload_static_s3.py --plan '../../public/static'
+
+Png/jpeg images are losslessly optimized beforehand (see
+optimize_images.py), by the same pool of processes, and uploaded in
+their optimized version if it is smaller.
+
+Css/js files are compressed beforehand (see precompress.py), over a pool
+of processes whose size can be changed with --compress-jobs, and their
+gzip (and brotli, if installed) versions are uploaded next to them
+(style.css --> style.gz.css, style.br.css), unless they are not worth it
+(see precompress.WORTH_RATIO). The manifest lists the gzipped versions
+uploaded (style.gz.css --> style.3fa2c1d4e5f6.gz.css), so that
+{% static_asset %} and {% gzip_static %} only point to those.
+
+
+Dependencies: S3.py, async_s3.py, precompress.py and optimize_images.py
+              (just put them in the same folder as this module)
               defaults.py w/ AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+              src/apps/contrib/static_names.py, the naming rules shared
+              with the site (see STATIC_NAMES_FILE)
 
 
 Todo: Change to depend on Boto API and not S3.py
@@ -19,20 +81,35 @@ Todo: Change to depend on Boto API and not S3.py
 """
 
 import S3
+import async_s3
 import os
 import sys
+import socket
+import httplib
+import random
 import hashlib
 import mimetypes
 import json
+import marshal
 import time
-from gzip import GzipFile
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
-from defaults import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+import argparse
+import threading
+import imp
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from tempfile import SpooledTemporaryFile
+
+from defaults import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_ENDPOINT
 from defaults import STATIC_BUCKET_NAME as BUCKET_NAME
+import precompress
+import optimize_images
+
+# the naming rules of the site, which resolves the names uploaded
+STATIC_NAMES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', '..', 'src', 'apps', 'contrib',
+                                 'static_names.py')
+static_names = imp.load_source('static_names', STATIC_NAMES_FILE)
+HASH_LENGTH = static_names.HASH_LENGTH  # sha digits in a hashed name
 
 #IGNORE_DIRS = ['admin']
 IGNORE_DIRS = []
@@ -43,62 +120,394 @@ EXTRA_FILES = {}
 CACHE_FOLDER_NAME = ''  # should be the same as settings.COMPRESS_OUTPUT_DIR
                         # empty string is a lot easir to handle
 GZIP_ENABLED = True
+OPTIMIZE_IMAGES = True  # upload png/jpeg files losslessly optimized
 REMOTE_METADATA_FILE = 'META.json'
 LOCAL_METADATA_FILE = 'META.local.json'
+LOCAL_INDEX_FILE = 'META.local.idx'  # path -> (size, mtime, sha, md5)
+LOCAL_INDEX_VERSION = 2
+HASHED_NAMES = True  # also publish files under content-hashed names
+MANIFEST_FILE = 'staticfiles-manifest.json'
+LOCAL_MANIFEST_FILE = MANIFEST_FILE  # should match settings.STATIC_MANIFEST_FILE
+MANIFEST_HISTORY_PREFIX = 'manifests/'  # manifests of the former runs
+MANIFEST_HISTORY_SIZE = 5  # former manifests whose hashed names are kept
+LONG_CACHE_CONTROL = 'public,max-age=31536000'
+LOCAL_JOURNAL_FILE = 'META.local.journal'  # files uploaded by an unfinished run
+LOCAL_HISTORY_FILE = 'META.local.history'  # throughput of the last runs
+HISTORY_SIZE = 20  # runs kept in LOCAL_HISTORY_FILE
+FULL_UPLOAD_WARNING = 0.5  # plans uploading more of the files than this warn
+DEFAULT_JOBS = 8  # concurrent uploads
+UPLOAD_RETRIES = 4  # extra attempts for each failed request
+RETRY_BASE_DELAY = 0.5  # seconds, doubled on every retry (with jitter)
+RETRY_MAX_DELAY = 30
+# errors, and S3 replies, which are worth retrying
+RETRYABLE_ERRORS = (socket.error, httplib.HTTPException)
+RETRYABLE_CODES = ('RequestTimeout', 'SlowDown', 'InternalError',
+                   'ServiceUnavailable')
+CHUNK_SIZE = 64 * 1024  # files are read in blocks of this size
+SPOOL_MAX_SIZE = 1024 * 1024  # bigger upload bodies are spooled to disk
+
+_print_lock = threading.Lock()
+
+
+def _log(message):
+    """ Prints a message without interleaving it with other workers """
+    with _print_lock:
+        print message
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadReport(object):
+    """
+    Thread-safe accounting of an upload run:
+    files and bytes sent, retries (and seconds lost to them)
+    and files which failed to upload.
+
+    """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.retry_seconds = 0.0
+        self.optimized_files = 0
+        self.optimized_savings = 0
+        self.failed = []
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add_upload(self, nbytes):
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    def add_retry(self, seconds):
+        """ Accounts a retry, after seconds lost to a failed attempt """
+        with self._lock:
+            self.retries += 1
+            self.retry_seconds += seconds
+
+    def add_optimized(self, saved):
+        """ Accounts an optimized image uploaded, saved bytes smaller """
+        with self._lock:
+            self.optimized_files += 1
+            self.optimized_savings += saved
+
+    def add_failure(self, filename):
+        with self._lock:
+            self.failed.append(filename)
+
+    def summary(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        lines = ['Uploaded %s files, %.1f KB in %.3f s (%.1f KB/s, %.1f files/s)'
+                 % (self.files, self.bytes / 1024.0, elapsed,
+                    self.bytes / 1024.0 / elapsed, self.files / elapsed),
+                 'Retries: %s (%.1f s lost to retries)' % (self.retries,
+                                                          self.retry_seconds)]
+        if self.optimized_files:
+            lines.append('Optimized images: %s, %.1f KB smaller than the '
+                         'originals' % (self.optimized_files,
+                                        self.optimized_savings / 1024.0))
+        if self.failed:
+            lines.append('FAILED to upload %s files:' % len(self.failed))
+            lines.extend(['    %s' % f for f in sorted(self.failed)])
+        return '\n'.join(lines)
+
+
+class UploadPlan(object):
+    """
+    What an upload run would do (see upload_all_to_s3 with plan=True):
+    the files to upload, with their (raw, gzip, brotli) sizes, and the
+    PUT requests and bytes it takes, estimated_seconds included
+    (None if there is no history to go by).
 
+    """
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.files = {}  # path -> (raw, gzip, brotli) sizes
+        self.uploads = 0
+        self.bytes = 0
+        self.orphans = 0
+        self.deletes = 0
+        self.estimated_seconds = None
+        self.history_runs = 0
+
+    def add_file(self, f, sizes, uploads, nbytes):
+        self.files[f] = sizes
+        self.add_upload(uploads, nbytes)
+
+    def add_upload(self, uploads, nbytes):
+        self.uploads += uploads
+        self.bytes += nbytes
+
+    def summary(self):
+        lines = []
+        if self.files:
+            lines.append('Files to upload (raw / gzip / brotli bytes):')
+            lines.extend(['    %-50s %10d %10s %10s' % (
+                f, raw, gzip or '-', brotli or '-')
+                for f, (raw, gzip, brotli) in sorted(self.files.items())])
+        sizes = self.files.values()
+        lines.append('%s of %s files to upload: raw %.1f KB, gzip %.1f KB%s'
+                     % (len(self.files), self.total_files,
+                        sum(s[0] for s in sizes) / 1024.0,
+                        sum(s[1] for s in sizes) / 1024.0,
+                        ', brotli %.1f KB' % (sum(s[2] for s in sizes) /
+                                              1024.0)
+                        if precompress.brotli else ''))
+        lines.append('%s PUT requests, %.1f KB' % (self.uploads,
+                                                   self.bytes / 1024.0))
+        if self.orphans:
+            lines.append('%s orphan keys in the bucket%s' % (
+                self.orphans, ', %s DELETE requests' % self.deletes
+                if self.deletes else ''))
+        if self.estimated_seconds is None:
+            lines.append('No upload history yet: no duration estimate')
+        else:
+            lines.append('Estimated upload time: %.1f s (going by %s past runs)' % (
+                self.estimated_seconds, self.history_runs))
+        if len(self.files) > FULL_UPLOAD_WARNING * self.total_files > 0:
+            lines.append('WARNING: %d%% of the files would be uploaded' % (
+                100.0 * len(self.files) / self.total_files))
+        return '\n'.join(lines)
+
+
+class UploadJournal(object):
+    """
+    On-disk journal (LOCAL_JOURNAL_FILE) of the files uploaded by a run,
+    with the sha they were uploaded with, one "path<TAB>sha" per line.
 
-def _get_connection():
-    conn = S3.AWSAuthConnection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    It is removed once the run uploads the remote metadata file. If the
+    run is interrupted before, the next one skips the files journaled
+    with their current sha.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+        self._file = None
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 2:  # the last line may be cut short
+                        self.done[fields[0]] = fields[1]
+
+    def is_done(self, f, sha):
+        return self.done.get(f) == sha
+
+    def add(self, f, sha):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, 'a')
+            self._file.write('%s\t%s\n' % (f, sha))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def _get_connection(pool_size=S3.DEFAULT_POOL_SIZE):
+    if S3_ENDPOINT:
+        server, port = S3_ENDPOINT.rsplit(':', 1)
+        conn = S3.AWSAuthConnection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY,
+                                    is_secure=False, server=server,
+                                    port=int(port),
+                                    calling_format=S3.CallingFormat.PATH,
+                                    pool_size=pool_size)
+    else:
+        conn = S3.AWSAuthConnection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY,
+                                    pool_size=pool_size)
     if conn.check_bucket_exists(BUCKET_NAME).status != 200:
         print 'Failed to establish connect. Check you auth keys.'
         sys.exit(1)
     return conn
 
 
-def _get(conn, remote_file, bucket_name=BUCKET_NAME):
-    """ Gets a remote file of a bucket using a connection """
-    contents = None
-    try:
-        reply = conn.get(bucket_name, remote_file)
-        contents = reply.body
-        if reply.http_response.status != 200:
-            print 'Failed to fetch current_remote metadata'
-            contents = None
-    except:
-        contents = None
-    return contents
+def _get_async_connection(concurrency):
+    """ An async_s3.AsyncS3Connection, set up as _get_connection """
+    if S3_ENDPOINT:
+        server, port = S3_ENDPOINT.rsplit(':', 1)
+        return async_s3.AsyncS3Connection(
+            AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, is_secure=False,
+            server=server, port=int(port),
+            calling_format=S3.CallingFormat.PATH, concurrency=concurrency)
+    return async_s3.AsyncS3Connection(AWS_ACCESS_KEY_ID,
+                                      AWS_SECRET_ACCESS_KEY,
+                                      concurrency=concurrency)
+
+
+def _get_backoff(attempt):
+    """
+    Seconds to wait before retry number attempt (from 1 on):
+    exponential backoff with full jitter, so that concurrent workers
+    throttled at once don't all come back at once.
+
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY,
+                                 RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def _is_retryable(reply):
+    """ Is an S3 reply an error which may go away by trying again """
+    status = reply.http_response.status
+    return status >= 500 or \
+        any('<Code>%s</Code>' % code in reply.message
+            for code in RETRYABLE_CODES)
+
+
+def _request(send, description, report=None):
+    """
+    Calls send() (an S3 request, returning its reply) and, while it fails
+    with a retryable error, tries again up to UPLOAD_RETRIES times,
+    waiting _get_backoff() seconds before each retry.
+
+    Returns the last reply. If the last attempt failed with an exception,
+    raises it.
+    Retries, and the seconds lost to them, are accounted in report.
+
+    """
+    for attempt in range(UPLOAD_RETRIES + 1):
+        start_time = time.time()
+        try:
+            reply = send()
+            if not _is_retryable(reply):
+                return reply
+            error = reply.message
+        except RETRYABLE_ERRORS as e:
+            if attempt == UPLOAD_RETRIES:
+                raise
+            error = e
+        if attempt == UPLOAD_RETRIES:
+            return reply
+        delay = _get_backoff(attempt + 1)
+        _log('Retrying %s in %.1f s (%s)' % (description, delay, error))
+        time.sleep(delay)
+        if report:
+            report.add_retry(time.time() - start_time)
 
 
-def _put(conn, remote_file, contents, bucket_name=BUCKET_NAME, headers=None):
+def _get(conn, remote_file, bucket_name=BUCKET_NAME):
+    """
+    Gets a remote file of a bucket using a connection.
+    Returns None if there is no such file.
+    Raises UploadError if it could not be fetched.
+
+    """
+    try:
+        reply = _request(lambda: conn.get(bucket_name, remote_file),
+                         'GET %s' % remote_file)
+    except RETRYABLE_ERRORS as e:
+        raise UploadError('Failed to fetch %s: %s' % (remote_file, e))
+    status = reply.http_response.status
+    if status == 404:
+        return None
+    if status != 200:
+        raise UploadError('Failed to fetch %s: %s' % (remote_file,
+                                                      reply.message))
+    return reply.body
+
+
+def _put(conn, remote_file, contents, bucket_name=BUCKET_NAME, headers=None,
+         report=None):
     """
     Put some contents into a remote_file of a bucket usign connection conn.
     Optionally the headers can be specified.
+
+    A PUT failing with a retryable error is tried again
+    (see _request). Returns True if the contents were uploaded.
+
     """
-    error_msg = 'Failed to upload to %s' % remote_file
+    def send():
+        if hasattr(contents, 'seek'):
+            contents.seek(0)
+        return conn.put(bucket_name, remote_file, S3.S3Object(contents),
+                        headers or {})
+
     try:
-        reply = conn.put(bucket_name, remote_file,
-                         S3.S3Object(contents), headers)
-        if reply.http_response.status != 200:
-            print error_msg
-    except:
-        print error_msg
+        reply = _request(send, 'PUT %s' % remote_file, report)
+    except RETRYABLE_ERRORS as e:
+        error = e
+    else:
+        if reply.http_response.status == 200:
+            return True
+        error = reply.message
+    _log('Failed to upload to %s: %s' % (remote_file, error))
+    return False
+
+
+def _put_async(conn, remote_file, body, headers, callback, report=None,
+               bucket_name=BUCKET_NAME):
+    """
+    Same as _put, over an async_s3.AsyncS3Connection: queues the PUT
+    and returns at once. Retries wait on the connection timers.
 
+    callback(uploaded) is called from conn.run() once the contents
+    were uploaded, or the last attempt failed.
 
-def _get_headers(content_type):
+    """
+    def send(attempt, start_time):
+        conn.put(bucket_name, remote_file, body, headers,
+                 callback=lambda reply, error: done(reply, error, attempt,
+                                                    start_time))
+
+    def done(reply, error, attempt, start_time):
+        if error is None:
+            if not _is_retryable(reply):
+                if reply.http_response.status == 200:
+                    return callback(True)
+                error = reply.message
+                attempt = UPLOAD_RETRIES
+            else:
+                error = reply.message
+        elif not isinstance(error, RETRYABLE_ERRORS):
+            attempt = UPLOAD_RETRIES
+        if attempt == UPLOAD_RETRIES:
+            _log('Failed to upload to %s: %s' % (remote_file, error))
+            return callback(False)
+        delay = _get_backoff(attempt + 1)
+        _log('Retrying PUT %s in %.1f s (%s)' % (remote_file, delay, error))
+
+        def retry():
+            if report:
+                report.add_retry(time.time() - start_time)
+            send(attempt + 1, time.time())
+        conn.call_later(delay, retry)
+
+    send(0, time.time())
+
+
+def _get_headers(content_type, hashed=False):
     """
     Get headers for this type of file.
     Also, put the correct content encoding.
 
+    Everything is cached for long, and files under a hashed name,
+    which never change, are also marked immutable.
+
     """
+    cache_control = LONG_CACHE_CONTROL
+    if hashed:
+        cache_control += ',immutable'
     headers = {'x-amz-acl':  'public-read',
                'Content-Type': content_type,
-               'Cache-Control': 'public,max-age=31536000'}
+               'Cache-Control': cache_control}
     return headers
 
 
-def _get_content_type(file_descriptor):
-    """ Guess the content_type, by using its file descriptor """
-    content_type = mimetypes.guess_type(file_descriptor.name)[0]
+def _get_content_type(filename):
+    """ Guess the content_type, by using its file name """
+    content_type = mimetypes.guess_type(filename)[0]
     if not content_type:
         content_type = 'text/plain'
     return content_type
@@ -107,95 +516,271 @@ def _get_content_type(file_descriptor):
 def _file_can_be_compressed(filename):
     """
     Asserts if a given file (w/ name filename) can be compressed.
-    content_type is optional and can speed up assertion.
 
     Should return True if it is a Text Type (CSS/JS)
     """
-    content_type = ''
+    return _get_content_type(filename) in TEXT_TYPES
+
+
+def _get_gzip_name(filename):
+    """
+    Name of the gzipped version of filename.
+    We should not overwrite the original file in the server.
+    We change extensions: style.css --> style.gz.css, for instance
+
+    """
+    return static_names.get_gzip_name(filename)
+
+
+def _get_brotli_name(filename):
+    """ Same as _get_gzip_name: style.css --> style.br.css """
+    root, extension = os.path.splitext(filename)
+    return root + '.br' + extension
+
+
+def _get_hashed_name(filename, sha):
+    """
+    Content-hashed name of filename, whose content has the given sha.
+    E.g.: style.css --> style.3fa2c1d4e5f6.css
+
+    """
+    return static_names.get_hashed_name(filename, sha)
+
+
+class LocalFile(object):
+    """
+    A local file, read from disk in a single pass (see _read_local_file).
+
+    Holds its sha, content type and upload bodies:
+    the original content and, if precompressed, its gzip/brotli versions.
+    The original body is a file object kept in memory up to SPOOL_MAX_SIZE
+    bytes and spooled to a temporary file beyond that. Compressed bodies,
+    and the body of an optimized image, are read straight from the
+    precompress and optimize_images caches.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.content_type = _get_content_type(filename)
+        self.sha = None
+        self.body = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.size = 0
+        self.gzip_body = None
+        self.gzip_size = 0
+        self.brotli_body = None
+        self.brotli_size = 0
+
+    def close(self):
+        self.body.close()
+        if self.gzip_body:
+            self.gzip_body.close()
+        if self.brotli_body:
+            self.brotli_body.close()
+
+
+def _read_local_file(filename, compressed=None, optimized=None):
+    """
+    Reads filename once, in CHUNK_SIZE blocks, and computes from that
+    single read its sha and the upload body.
+
+    compressed, if given, is the precompress.Compressed result of the
+    file, whose cached outputs become the gzip/brotli bodies.
+    optimized, if given, is the optimize_images.Optimized result of the
+    file: if it has a smaller output, that is the body, and the file
+    itself is not even read (its sha is the one it was optimized for).
+
+    Returns a LocalFile. Close it when done.
+
+    """
+    local_file = LocalFile(filename)
+    if optimized and optimized.path:
+        local_file.body.close()
+        local_file.body = open(optimized.path, 'rb')
+        local_file.sha = optimized.sha
+        local_file.size = optimized.optimized_size
+        return local_file
+
+    sha = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                sha.update(chunk)
+                local_file.body.write(chunk)
+
+        local_file.sha = sha.hexdigest()
+        local_file.size = local_file.body.tell()
+        if compressed and compressed.gzip_path:
+            local_file.gzip_body = open(compressed.gzip_path, 'rb')
+            local_file.gzip_size = compressed.gzip_size
+        if compressed and compressed.brotli_path:
+            local_file.brotli_body = open(compressed.brotli_path, 'rb')
+            local_file.brotli_size = compressed.brotli_size
+    except:
+        local_file.close()
+        raise
+    return local_file
+
+
+def _get_file_digests(filename):
+    """
+    Returns the (sha, md5) hex digests of a local file.
+    The md5 is what S3 reports as the ETag of an uploaded file.
+
+    """
+    sha = hashlib.sha1()
+    md5 = hashlib.md5()
     with open(filename, 'rb') as f:
-        content_type = _get_content_type(f)
-    return content_type in TEXT_TYPES
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha.update(chunk)
+            md5.update(chunk)
+    return sha.hexdigest(), md5.hexdigest()
 
 
-def _compress_string(content):
+def _load_local_index():
     """
-    Compress the content string passed.
-    Should be called when gzip is enabled to compress text types.
-    There is no real advantage in using this with images, since most are
-    already nicely compressed by some image processing algorithm.
+    Loads the LOCAL_INDEX_FILE dict of path -> (size, mtime, sha, md5).
+    An index missing, unreadable or of another version is taken as empty.
 
     """
-    zbuf = StringIO()
-    zfile = GzipFile(mode='wb', compresslevel=6, fileobj=zbuf)
-    zfile.write(content)
-    zfile.close()
-    return zbuf.getvalue()
+    try:
+        with open(LOCAL_INDEX_FILE, 'rb') as f:
+            version, index = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return {}
+    if version != LOCAL_INDEX_VERSION:
+        return {}
+    return index
 
 
-def _get_sha_metadata(filename):
-    """ Returns the sha metada of a local file """
-    with open(filename) as f:
-        return hashlib.sha1(f.read()).hexdigest()
+def _save_local_index(index):
+    with open(LOCAL_INDEX_FILE, 'wb') as f:
+        marshal.dump((LOCAL_INDEX_VERSION, index), f)
 
 
-def _build_local_metadata_file(files, home=''):
+def _build_local_metadata_file(files, home='', rehash_all=False):
     """
     Build the metadata local file with
     all sha information about files.
 
     File location is computed based on home kw-argument.
 
+    A file is only hashed again if its size or mtime differs from the
+    ones recorded in the local index, unless rehash_all is True.
+
+    Returns the index: a dict of path -> (size, mtime, sha, md5).
+
     """
-    filepaths = [os.path.join(home, f) for f in files]
-    shas = [_get_sha_metadata(f) for f in filepaths]
-    metadata = dict(zip(files, shas))
+    old_index = {} if rehash_all else _load_local_index()
+    index = {}
+    # a file changed again within the same mtime tick would keep its
+    # signature, so files this recent are not trusted on the next run
+    trust_before = time.time() - 2
+
+    for f in files:
+        stat = os.stat(os.path.join(home, f))
+        signature = (stat.st_size, stat.st_mtime)
+        entry = old_index.get(f)
+        if entry and entry[:2] == signature:
+            digests = entry[2:]
+        else:
+            digests = _get_file_digests(os.path.join(home, f))
+        if stat.st_mtime >= trust_before:
+            signature = (stat.st_size, None)
+        index[f] = signature + digests
+
+    _save_local_index(index)
+    metadata = dict((f, entry[2]) for f, entry in index.items())
 
     with open(LOCAL_METADATA_FILE, 'w') as f:
         f.write(json.dumps(metadata))
+    return index
+
+
+def _get_s3_name(filename):
+    """ Name of the bucket key of a file path relative to the static root """
+    return filename.lstrip('./')
+
+
+def _get_upload(local_file, filename_s3, gzip=False, hashed=False,
+                brotli=False):
+    """
+    Returns the (key, body, size, headers) to upload a LocalFile
+    as filename_s3 (see _upload_local_file).
+
+    """
+    filename_s3 = _get_s3_name(filename_s3)
+    if hashed:
+        filename_s3 = _get_hashed_name(filename_s3, local_file.sha)
+    headers = _get_headers(local_file.content_type, hashed=hashed)
+
+    if gzip:
+        body, size = local_file.gzip_body, local_file.gzip_size
+        headers['Content-Encoding'] = 'gzip'
+        filename_s3 = _get_gzip_name(filename_s3)
+    elif brotli:
+        body, size = local_file.brotli_body, local_file.brotli_size
+        headers['Content-Encoding'] = 'br'
+        filename_s3 = _get_brotli_name(filename_s3)
+    else:
+        body, size = local_file.body, local_file.size
+    headers['Content-Length'] = str(size)
+    return filename_s3, body, size, headers
+
+
+def _upload_local_file(conn, local_file, filename_s3, gzip=False,
+                       report=None, hashed=False, brotli=False):
+    """
+    Uploads a LocalFile to S3 bucket, as filename_s3.
+    If gzip=True, upload its gzipped body instead (see upload_file).
+    If brotli=True, upload its brotli body instead.
+    If hashed=True, upload it under its content-hashed name.
 
+    Returns False if the upload failed, True otherwise.
 
-def upload_file(conn, filename_local, filename_s3, gzip=False):
+    """
+    filename_s3, body, size, headers = _get_upload(
+        local_file, filename_s3, gzip=gzip, hashed=hashed, brotli=brotli)
+    _log('Uploading %s to %s' % (local_file.filename, filename_s3))
+    uploaded = _put(conn, filename_s3, body, headers=headers, report=report)
+    if uploaded and report:
+        report.add_upload(size)
+    return uploaded
+
+
+def upload_file(conn, filename_local, filename_s3, gzip=False, report=None):
     """
     Uploads a file to S3 bucket.
 
     If gzip=True, compress and upload the gzipped version of the file
     instead of the original one.
 
-    If gzip=True and it is not possible to compress,
+    If gzip=True and it is not possible (or not worth it) to compress,
     then quit the upload process (don't upload at all).
 
     So you should always pass the correct gzip info into this function,
     in order to get a upload.
 
-    """
-
-    filename_s3 = filename_s3.lstrip('./')
-
-    file_descriptor = open(filename_local, 'rb')
-    content = file_descriptor.read()
-
-    content_type = _get_content_type(file_descriptor)
-    headers = _get_headers(content_type)
-
-    #should compress if the file is compressable and gzip is enabled
-    can_be_gzipped = _file_can_be_compressed(filename_local)
-    if gzip and can_be_gzipped:
-        content = _compress_string(content)
-        headers['Content-Length'] = str(len(content))
-        headers['Content-Encoding'] = 'gzip'
-        extension = mimetypes.guess_extension(content_type)
-        #we should not overwrite the original file in the server.
-        #We change extensions: style.css --> style.gz.css, for instance
-        filename_s3 = filename_s3.rstrip(extension) + '.gz' + extension
+    Returns False if the upload failed, True otherwise.
+    Successful uploads are accounted in report, if given.
 
+    """
     #if gzip is enabled and it is not compressable, don't upload nothing at all
-    elif gzip and not can_be_gzipped:
-        return
-
-    #upload
-    print 'Uploading %s to %s' % (filename_local, filename_s3)
-    _put(conn, filename_s3, content, headers=headers)
-    file_descriptor.close()
+    if gzip and not _file_can_be_compressed(filename_local):
+        return True
+
+    compressed = None
+    if gzip:
+        sha = _get_file_digests(filename_local)[0]
+        compressed = precompress.compress_file(
+            (filename_local, sha, os.path.getsize(filename_local)))
+        if not compressed.gzip_path:
+            return True
+    local_file = _read_local_file(filename_local, compressed=compressed)
+    try:
+        return _upload_local_file(conn, local_file, filename_s3, gzip=gzip,
+                                  report=report)
+    finally:
+        local_file.close()
 
 
 def _get_file_list(folder):
@@ -204,13 +789,18 @@ def _get_file_list(folder):
     The list element is a string w/ file path relative to folder.
 
     If any file is found with the same name as LOCAL_METADATA_FILE,
+    LOCAL_INDEX_FILE, LOCAL_MANIFEST_FILE, LOCAL_JOURNAL_FILE or
+    LOCAL_HISTORY_FILE,
     then do not append it to the list.
 
     """
     tree = [x for x in os.walk(folder)]
     files = [os.path.join(t[0], y) for t in tree for y in t[2]]
     return [os.path.relpath(x, start=folder)
-                for x in files if x != LOCAL_METADATA_FILE]
+                for x in files
+                if x not in (LOCAL_METADATA_FILE, LOCAL_INDEX_FILE,
+                             LOCAL_MANIFEST_FILE, LOCAL_JOURNAL_FILE,
+                             LOCAL_HISTORY_FILE)]
 
 
 def _fetch_current_remote_metadata(conn):
@@ -224,6 +814,177 @@ def _fetch_current_remote_metadata(conn):
     return metadata
 
 
+def _fetch_remote_etags(conn):
+    """
+    Lists the whole bucket and returns a dict of key -> ETag.
+    The listing is streamed, page by page.
+
+    """
+    return dict((entry.key, entry.etag.strip('"'))
+                for entry in conn.iter_bucket(BUCKET_NAME))
+
+
+def _etag_metadata(files, index, remote_etags, optimized=None,
+                   compressed=None):
+    """
+    Builds (local_metadata, remote_metadata) dicts of path -> md5
+    to be compared by _filter_file_list, from the local index and
+    the bucket ETags. The md5 of an image uploaded optimized is the one
+    of its optimized version, given in the optimized dict of
+    path -> optimize_images.Optimized. Which compressed versions a file
+    should have comes from the compressed dict of
+    path -> precompress.Compressed.
+
+    A file whose other versions (gzipped, hashed) are not all in the
+    bucket is left out of remote_metadata, so that it is uploaded again.
+
+    """
+    local_metadata = dict((f, index[f][3]) for f in files)
+    for f, result in (optimized or {}).items():
+        if result.path:
+            local_metadata[f] = result.md5
+    compressed = compressed or {}
+    remote_metadata = {}
+    for f in files:
+        s3_name = _get_s3_name(f)
+        if s3_name not in remote_etags:
+            continue
+        names = _get_s3_names(f, index[f][2], compressed.get(f))
+        if any(key not in remote_etags for key in names):
+            continue
+        remote_metadata[f] = remote_etags[s3_name]
+    return local_metadata, remote_metadata
+
+
+def _get_s3_names(f, sha, compressed=None):
+    """
+    All the bucket keys published for file path f (with the given sha):
+    plain, hashed and, as enabled, their gzipped (and brotli) versions
+    which compressed (its precompress.Compressed result) has.
+
+    """
+    names = [_get_s3_name(f)]
+    if HASHED_NAMES:
+        names.append(_get_hashed_name(names[0], sha))
+    if compressed:
+        plain_names = list(names)
+        if compressed.gzip_path:
+            names.extend([_get_gzip_name(name) for name in plain_names])
+        if compressed.brotli_path:
+            names.extend([_get_brotli_name(name) for name in plain_names])
+    return names
+
+
+def _get_hashed_s3_names(f, sha, compressed=None):
+    """
+    The content-hashed keys among _get_s3_names(f, sha, compressed):
+    the hashed name and its gzipped (and brotli) versions.
+
+    """
+    hashed = _get_hashed_name(_get_s3_name(f), sha)
+    names = [hashed]
+    if compressed and compressed.gzip_path:
+        names.append(_get_gzip_name(hashed))
+    if compressed and compressed.brotli_path:
+        names.append(_get_brotli_name(hashed))
+    return names
+
+
+def _find_missing_hashed_names(files, index, remote_etags, compressed=None):
+    """
+    Returns the files (but the ignored ones) with any of their hashed
+    keys (see _get_hashed_s3_names) missing from the bucket, going by
+    the remote_etags dict of key -> ETag.
+
+    REMOTE_METADATA_FILE only tells the plain names apart: a file it
+    records may still miss its hashed names, e.g. when it was uploaded
+    before HASHED_NAMES was enabled.
+
+    """
+    compressed = compressed or {}
+    return [f for f in files
+            if not _is_ignored(f)
+            and any(key not in remote_etags
+                    for key in _get_hashed_s3_names(f, index[f][2],
+                                                    compressed.get(f)))]
+
+
+def _get_manifest_history_key():
+    """
+    Bucket key to keep the manifest of this run as, which sorts after
+    the ones of the former runs: manifests/20240131235959.json
+
+    """
+    return '%s%s.json' % (MANIFEST_HISTORY_PREFIX,
+                          time.strftime('%Y%m%d%H%M%S', time.gmtime()))
+
+
+def _fetch_kept_names(conn, remote_etags):
+    """
+    Returns the set of keys which the last MANIFEST_HISTORY_SIZE kept
+    manifests (going by the remote_etags dict of key -> ETag), and the
+    current MANIFEST_FILE, point to: their hashed names, with their
+    brotli versions, and the kept manifests themselves.
+    Raises UploadError if any of them could not be fetched.
+
+    """
+    history = sorted(key for key in remote_etags
+                     if key.startswith(MANIFEST_HISTORY_PREFIX))
+    kept = set(history[-MANIFEST_HISTORY_SIZE:]) \
+        if MANIFEST_HISTORY_SIZE else set()
+    names = set(kept)
+    for key in sorted(kept) + [MANIFEST_FILE]:
+        content = _get(conn, key)
+        for hashed in (json.loads(content) if content else {}).values():
+            names.update([hashed, _get_brotli_name(hashed)])
+    return names
+
+
+def _find_orphans(files, index, remote_etags, compressed=None, kept=None):
+    """
+    Returns the sorted bucket keys which no local file accounts for
+    (neither as the file itself, nor as its gzipped or hashed versions,
+    going by the compressed dict of path -> precompress.Compressed).
+
+    Keys in the kept set (see _fetch_kept_names) are not orphans:
+    pages rendered before the last deploys, still in some cache,
+    link the hashed names of their manifests.
+
+    """
+    known = set([REMOTE_METADATA_FILE, MANIFEST_FILE])
+    known.update([_get_s3_name(f) for f in EXTRA_FILES.values()])
+    known.update(kept or ())
+    compressed = compressed or {}
+    for f in files:
+        known.update(_get_s3_names(f, index[f][2], compressed.get(f)))
+    return sorted(key for key in remote_etags if key not in known)
+
+
+def _delete_orphans(conn, orphans):
+    """
+    Deletes orphans from the bucket, S3.MAX_DELETE_KEYS keys per request.
+    Returns the number of keys which failed to be deleted.
+
+    """
+    failures = 0
+    for i in range(0, len(orphans), S3.MAX_DELETE_KEYS):
+        batch = orphans[i:i + S3.MAX_DELETE_KEYS]
+        try:
+            reply = conn.delete_multiple(BUCKET_NAME, batch)
+        except Exception as e:
+            print 'Failed to delete %s keys: %s' % (len(batch), e)
+            failures += len(batch)
+            continue
+        if reply.http_response.status != 200:
+            print 'Failed to delete %s keys: %s' % (len(batch), reply.message)
+            failures += len(batch)
+            continue
+        for key, code, message in reply.errors:
+            print 'Failed to delete %s: %s %s' % (key, code, message)
+        failures += len(reply.errors)
+    return failures
+
+
 def _fetch_current_local_metadata():
     """
     Fetches the metadata local file LOCAL_METADATA_FILE
@@ -237,6 +998,18 @@ def _fetch_current_local_metadata():
         return json.loads(f.read())
 
 
+def _is_ignored(filename):
+    """
+    Is the file path filename left out of the upload: inside any of
+    the IGNORE_DIRS, or with any of the IGNORE_EXTENSIONS.
+
+    """
+    name = _get_s3_name(filename)
+    if any(name.startswith(x.rstrip('/') + '/') for x in IGNORE_DIRS):
+        return True
+    return any(ext in IGNORE_EXTENSIONS for ext in name.split('.')[1:])
+
+
 def _filter_file_list(files, local_metadata, remote_metadata):
     """
     Based on comparison of local and remote metada dictionaries,
@@ -259,69 +1032,559 @@ def _filter_file_list(files, local_metadata, remote_metadata):
                 and current_remote_sha is not None \
                 and current_local_sha == current_remote_sha
 
-    def _is_inside_ignored_dir(filename):
-        """ Is the filename inside any of the IGNORE_DIRS list """
-        ignore_dirs = ['./' + x for x in IGNORE_DIRS]
-        return any([filename.startswith(x) for x in ignore_dirs])
-
-    def _has_ignored_extension(filename):
-        return any([ext in IGNORE_EXTENSIONS
-                        for ext in filename.split('.')[1:]])
-
     files = [f for f in files
-                if not _is_inside_ignored_dir(f)
-                and not _has_ignored_extension(f)
+                if not _is_ignored(f)
                 and not _is_tracked(f, remote_metadata)]
     return files
 
 
-def upload_all_to_s3(static_root):
+def _upload_asset(conn, static_root, f, report, compressed=None,
+                  journal=None, optimized=None):
     """
-    Walks through all the subfolders in static_root,
-    and uploads everything valid found to S3.
+    Uploads a static asset (path f relative to static_root)
+    and its compressed versions, given as the precompress.Compressed
+    result of the file (None if it is not compressed).
+    An image is uploaded in its optimized version, given as the
+    optimize_images.Optimized result of the file (if any).
+
+    Any failed upload is accounted in report, and so is any error
+    with the file: it must not stop the uploads of the other files.
+    The file is read only once for all uploads.
+
+    If HASHED_NAMES is True, it is also uploaded under its hashed name.
+
+    The hashed and compressed versions go first, and the file itself is only
+    uploaded if those worked: a key with the right ETag means all of them
+    are up to date. Once all are uploaded, the file is added to journal.
+
+    """
+    try:
+        local_file = _read_local_file(os.path.join(static_root, f),
+                                      compressed=compressed,
+                                      optimized=optimized)
+    except Exception as e:
+        _log('Failed to read %s: %s' % (f, e))
+        report.add_failure(f)
+        return
+
+    try:
+        uploaded = True
+        for variant in _get_upload_variants(local_file):
+            uploaded = _upload_local_file(conn, local_file, f, report=report,
+                                          **variant)
+            if not uploaded:
+                break
+    except Exception as e:
+        _log('Failed to upload %s: %s' % (f, e))
+        uploaded = False
+    finally:
+        local_file.close()
+
+    if not uploaded:
+        report.add_failure(f)
+        return
+    if optimized and optimized.path:
+        report.add_optimized(optimized.saved)
+    if journal:
+        journal.add(f, local_file.sha)
 
-    If Gzip is enabled, also tries to compress and upload
-    the compressed version of the static asset.
 
+def _get_upload_variants(local_file):
     """
-    conn = _get_connection()
+    The _upload_local_file keyword arguments of every version of a
+    LocalFile to upload, in order: hashed names first, then compressed
+    bodies, and the file itself last (see _upload_asset).
 
-    files = _get_file_list(static_root)
-    _build_local_metadata_file(files, home=static_root)
+    """
+    variants = []
+    for hashed in ([True, False] if HASHED_NAMES else [False]):
+        #Upload Gzip css/js version if gzip is enabled
+        if local_file.gzip_body:
+            variants.append({'gzip': True, 'hashed': hashed})
+        if local_file.brotli_body:
+            variants.append({'brotli': True, 'hashed': hashed})
+        variants.append({'hashed': hashed})
+    return variants
 
-    local_metadata = _fetch_current_local_metadata()
-    remote_metadata = _fetch_current_remote_metadata(conn)
-    files_to_upload = _filter_file_list(files, local_metadata, remote_metadata)
 
-    start_time = time.time()
-    print 'Upload start: Landing in BUCKET_NAME: %s' % BUCKET_NAME
+def _upload_all_async(conn, static_root, files, report, compressed,
+                      journal=None, optimized=None):
+    """
+    Same as _upload_asset for every file, over conn (an
+    async_s3.AsyncS3Connection) from this thread alone: up to
+    conn.concurrency files are uploaded at the same time, each one
+    running its uploads one after the other, in the same order.
+
+    Returns once every file is done.
+
+    """
+    files = deque(files)
+    optimized = optimized or {}
+
+    def upload_next_file():
+        while files:
+            f = files.popleft()
+            try:
+                local_file = _read_local_file(os.path.join(static_root, f),
+                                              compressed=compressed.get(f),
+                                              optimized=optimized.get(f))
+            except Exception as e:
+                _log('Failed to read %s: %s' % (f, e))
+                report.add_failure(f)
+                continue
+            uploads = [_get_upload(local_file, f, **variant)
+                       for variant in _get_upload_variants(local_file)]
+            return upload_next(f, local_file, deque(uploads))
+
+    def upload_next(f, local_file, uploads):
+        if not uploads:
+            local_file.close()
+            if f in optimized and optimized[f].path:
+                report.add_optimized(optimized[f].saved)
+            if journal:
+                journal.add(f, local_file.sha)
+            return upload_next_file()
+        filename_s3, body, size, headers = uploads.popleft()
+
+        def done(uploaded):
+            if not uploaded:
+                local_file.close()
+                report.add_failure(f)
+                return upload_next_file()
+            report.add_upload(size)
+            upload_next(f, local_file, uploads)
+
+        _log('Uploading %s to %s' % (local_file.filename, filename_s3))
+        _put_async(conn, filename_s3, body, headers, done, report=report)
+
+    for _ in range(conn.concurrency):
+        upload_next_file()
+    conn.run()
+
+
+def _forget_failed_files(failed, remote_metadata):
+    """
+    Rewrites the local metadata file, so that files which failed to upload
+    keep their previous remote sha (or are not tracked at all).
+    Otherwise, they would be taken as up to date on the next run.
+
+    """
+    metadata = _fetch_current_local_metadata()
+    for f in failed:
+        if f in remote_metadata:
+            metadata[f] = remote_metadata[f]
+        else:
+            metadata.pop(f, None)
+
+    with open(LOCAL_METADATA_FILE, 'w') as fd:
+        fd.write(json.dumps(metadata))
+
+
+def _get_present_keys(remote_etags, uploaded, index, failed, compressed=None):
+    """
+    Returns the set of keys which are in the bucket after the run:
+    the ones listed beforehand (remote_etags, a dict of key -> ETag)
+    and the versions of the files uploaded, but the ones which failed.
+
+    """
+    present = set(remote_etags)
+    failed = set(failed)
+    compressed = compressed or {}
+    for f in uploaded:
+        if f not in failed:
+            present.update(_get_s3_names(f, index[f][2], compressed.get(f)))
+    return present
+
+
+def _build_manifest_file(index, present, compressed=None):
+    """
+    Writes LOCAL_MANIFEST_FILE, the json dict of plain -> hashed names,
+    for every file in index (but the ignored ones) whose hashed name is
+    in the present set of bucket keys (see _get_present_keys).
+    The other files are better served from their plain names.
+    The gzipped versions in the compressed dict of
+    path -> precompress.Compressed are listed too, if present.
+
+    """
+    compressed = compressed or {}
+    manifest = {}
+    for f, entry in index.items():
+        if _is_ignored(f):
+            continue
+        name = _get_s3_name(f)
+        hashed = _get_hashed_name(name, entry[2])
+        if hashed not in present:
+            continue
+        manifest[name] = hashed
+        if f in compressed and compressed[f].gzip_path \
+                and _get_gzip_name(hashed) in present:
+            manifest[_get_gzip_name(name)] = _get_gzip_name(hashed)
+    with open(LOCAL_MANIFEST_FILE, 'w') as fd:
+        fd.write(json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def _precompress_files(static_root, files, index, jobs=None):
+    """
+    Compresses the css/js files among files (paths relative to
+    static_root) over a pool of jobs processes, reusing the outputs
+    cached by earlier runs.
+
+    Returns a dict of path -> precompress.Compressed.
+
+    """
+    sources = dict((os.path.join(static_root, f), f) for f in files
+                   if _file_can_be_compressed(f))
+    results = precompress.precompress_files(
+        [(filename, index[f][2], index[f][0])
+         for filename, f in sources.items()], jobs=jobs)
+    return dict((sources[filename], compressed)
+                for filename, compressed in results.items())
+
+
+def _optimize_images(static_root, files, index, jobs=None):
+    """
+    Optimizes the png/jpeg images among files (paths relative to
+    static_root) over a pool of jobs processes, reusing the results
+    cached by earlier runs, and prints the optimization report.
+
+    Returns a dict of path -> optimize_images.Optimized.
+
+    """
+    sources = dict((os.path.join(static_root, f), f) for f in files
+                   if optimize_images.can_be_optimized(f))
+    results = optimize_images.optimize_files(
+        [(filename, index[f][2], index[f][0])
+         for filename, f in sources.items()], jobs=jobs)
+    optimize_images.print_report(results, home=static_root)
+    return dict((sources[filename], optimized)
+                for filename, optimized in results.items())
+
+
+def _load_history():
+    """
+    Loads the runs recorded in LOCAL_HISTORY_FILE (a json dict per line),
+    oldest first. Unreadable lines are skipped.
 
+    """
+    if not os.path.exists(LOCAL_HISTORY_FILE):
+        return []
+    runs = []
+    with open(LOCAL_HISTORY_FILE) as f:
+        for line in f:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                pass
+    return runs
+
+
+def _record_run(report, seconds, jobs, use_async):
+    """
+    Appends the throughput of an upload run to LOCAL_HISTORY_FILE,
+    keeping the last HISTORY_SIZE runs. Runs with no uploads tell
+    nothing about it, so they are not recorded.
+
+    """
+    if not report.files:
+        return
+    runs = _load_history()[-(HISTORY_SIZE - 1):]
+    runs.append({'time': int(time.time()), 'uploads': report.files,
+                 'bytes': report.bytes, 'seconds': round(seconds, 3),
+                 'jobs': jobs, 'async': use_async})
+    with open(LOCAL_HISTORY_FILE, 'w') as f:
+        f.write(''.join(json.dumps(run) + '\n' for run in runs))
+
+
+def _estimate_seconds(uploads, nbytes, runs):
+    """
+    Seconds to make uploads PUTs of nbytes in total, going by runs:
+    fits seconds = uploads * per_upload + bytes * per_byte to them (least
+    squares) or, if they don't tell both costs apart, uses their overall
+    seconds per upload.
+
+    """
+    sxx = sum(float(r['uploads']) ** 2 for r in runs)
+    sxy = sum(float(r['uploads']) * r['bytes'] for r in runs)
+    syy = sum(float(r['bytes']) ** 2 for r in runs)
+    sxt = sum(r['uploads'] * r['seconds'] for r in runs)
+    syt = sum(r['bytes'] * r['seconds'] for r in runs)
+    det = sxx * syy - sxy ** 2
+    if det > 1e-6 * sxx * syy:
+        per_upload = (sxt * syy - syt * sxy) / det
+        per_byte = (syt * sxx - sxt * sxy) / det
+        if per_upload >= 0 and per_byte >= 0:
+            return uploads * per_upload + nbytes * per_byte
+    return uploads * sum(r['seconds'] for r in runs) / \
+        sum(r['uploads'] for r in runs)
+
+
+def _make_plan(files, files_to_upload, index, compressed, optimized, jobs,
+               use_async, orphans=None, delete_orphans=False):
+    """
+    Builds the UploadPlan of uploading files_to_upload (out of files)
+    and their compressed (or optimized) versions, with jobs workers (or
+    connections),
+    and of deleting the orphans keys if delete_orphans is True.
+    The duration estimate goes by the recorded runs made the same way,
+    or by all of them if there are none.
+
+    """
+    plan = UploadPlan(len(files))
+    copies = 2 if HASHED_NAMES else 1
     for f in files_to_upload:
-        #Upload to Bucket
-        upload_file(conn, os.path.join(static_root, f), f)
+        c = compressed.get(f)
+        size = optimized[f].optimized_size if f in optimized else index[f][0]
+        sizes = (size, c.gzip_size if c and c.gzip_path else 0,
+                 c.brotli_size if c and c.brotli_path else 0)
+        versions = 1 + bool(c and c.gzip_path) + bool(c and c.brotli_path)
+        plan.add_file(f, sizes, copies * versions, copies * sum(sizes))
+    for filename_local in EXTRA_FILES:
+        plan.add_upload(1, os.path.getsize(filename_local))
+    # the manifest (and its kept copy) and remote metadata files
+    # (small enough to not count)
+    plan.add_upload(3 if HASHED_NAMES else 1, 0)
+    if orphans:
+        plan.orphans = len(orphans)
+        if delete_orphans:
+            plan.deletes = -(-len(orphans) // S3.MAX_DELETE_KEYS)
+
+    runs = _load_history()
+    same_runs = [r for r in runs
+                 if r.get('jobs') == jobs and r.get('async') == use_async]
+    runs = same_runs or runs
+    if runs:
+        plan.estimated_seconds = _estimate_seconds(plan.uploads, plan.bytes,
+                                                   runs)
+        plan.history_runs = len(runs)
+    return plan
+
+
+def upload_all_to_s3(static_root, jobs=DEFAULT_JOBS, rehash_all=False,
+                     etag_diff=False, delete_orphans=False,
+                     compress_jobs=None, use_async=False, plan=False):
+    """
+    Walks through all the subfolders in static_root,
+    and uploads everything valid found to S3.
 
-        #Upload Gzip css/js version if gzip is enabled
-        can_be_gzipped = _file_can_be_compressed(os.path.join(static_root, f))
-        if GZIP_ENABLED and can_be_gzipped:
-            upload_file(conn, os.path.join(static_root, f), f, gzip=True)
+    If Gzip is enabled, also uploads the compressed versions of the
+    static assets, made beforehand by compress_jobs processes
+    (one per CPU by default, see precompress.py). The same processes
+    optimize the images beforehand, if OPTIMIZE_IMAGES is True.
+
+    Up to jobs files are uploaded at the same time: by as many threads
+    or, if use_async is True, over as many non-blocking connections
+    (see _upload_all_async).
+    If rehash_all is True, the local index is ignored and
+    every file is hashed again.
+
+    If etag_diff is True, files are compared with the ETags of the
+    bucket listing, instead of the remote metadata file.
+    Then, bucket keys with no local file are reported
+    and, if delete_orphans is True, deleted.
+
+    Files uploaded by an interrupted run (see UploadJournal)
+    are not uploaded again.
+    Returns the UploadReport of the run, whose throughput is recorded
+    in LOCAL_HISTORY_FILE.
+
+    If plan is True, nothing is uploaded (nor deleted) and the
+    UploadPlan of the run is returned instead. Files are still
+    precompressed (and optimized), to know their sizes: the real run
+    finds them cached.
+
+    """
+    conn = _get_connection(pool_size=1 if use_async else jobs)
+
+    files = _get_file_list(static_root)
+    index = _build_local_metadata_file(files, home=static_root,
+                                       rehash_all=rehash_all)
+
+    # every file: the manifest lists which ones have a gzipped version
+    # (and, in etag mode, it is what the bucket should hold)
+    compressed = {}
+    if GZIP_ENABLED:
+        compressed = _precompress_files(static_root, files, index,
+                                        jobs=compress_jobs)
+
+    optimized = None
+    remote_etags = {}
+    if etag_diff or HASHED_NAMES:
+        # only the listing tells which hashed names are in the bucket
+        remote_etags = _fetch_remote_etags(conn)
+    if etag_diff:
+        if OPTIMIZE_IMAGES:
+            # what the bucket should hold depends on the optimized images
+            optimized = _optimize_images(static_root, files, index,
+                                         jobs=compress_jobs)
+        local_metadata, remote_metadata = _etag_metadata(files, index,
+                                                         remote_etags,
+                                                         optimized,
+                                                         compressed)
+    else:
+        local_metadata = _fetch_current_local_metadata()
+        remote_metadata = _fetch_current_remote_metadata(conn)
+    files_to_upload = _filter_file_list(files, local_metadata, remote_metadata)
+    if HASHED_NAMES and not etag_diff:
+        pending = set(files_to_upload)
+        files_to_upload.extend(
+            f for f in _find_missing_hashed_names(files, index, remote_etags,
+                                                  compressed)
+            if f not in pending)
+
+    journal = UploadJournal(LOCAL_JOURNAL_FILE)
+    remaining = [f for f in files_to_upload
+                 if not journal.is_done(f, index[f][2])]
+    if len(remaining) < len(files_to_upload):
+        print 'Resuming an interrupted upload: %s of %s files already done' % (
+            len(files_to_upload) - len(remaining), len(files_to_upload))
+    files_to_upload = remaining
+
+    precompress.print_report(dict((f, compressed[f]) for f in files_to_upload
+                                  if f in compressed))
+    if OPTIMIZE_IMAGES and optimized is None:
+        optimized = _optimize_images(static_root, files_to_upload, index,
+                                     jobs=compress_jobs)
+    optimized = optimized or {}
+
+    if plan:
+        orphans = None
+        if etag_diff:
+            orphans = _find_orphans(files, index, remote_etags, compressed,
+                                    _fetch_kept_names(conn, remote_etags))
+        conn.close()
+        return _make_plan(files, files_to_upload, index, compressed,
+                          optimized, jobs, use_async, orphans, delete_orphans)
+
+    report = UploadReport()
+    print 'Upload start: Landing in BUCKET_NAME: %s (%s %s)' % (
+        BUCKET_NAME, jobs, 'connections' if use_async else 'jobs')
+
+    if use_async:
+        async_conn = _get_async_connection(jobs)
+        try:
+            _upload_all_async(async_conn, static_root, files_to_upload,
+                              report, compressed, journal, optimized)
+        except KeyboardInterrupt:
+            journal.close()
+            raise
+        finally:
+            async_conn.close()
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            # a timeout, so that a KeyboardInterrupt gets through
+            pool.map_async(lambda f: _upload_asset(conn, static_root, f,
+                                                   report, compressed.get(f),
+                                                   journal, optimized.get(f)),
+                           files_to_upload, chunksize=1).get(sys.maxint)
+        except KeyboardInterrupt:
+            pool.terminate()
+            journal.close()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    _record_run(report, time.time() - report.start_time, jobs, use_async)
 
     #Extra files
     if EXTRA_FILES:
         print 'Now, uploading extra files outside public/static'
         for filename_local, filename_s3 in EXTRA_FILES.items():
-            upload_file(conn, filename_local, filename_s3)
-
-    end_time = time.time()
-    print 'Upload finished: \
-            Time elapsed: %s s' % round(end_time - start_time, 3)
+            if not upload_file(conn, filename_local, filename_s3,
+                               report=report):
+                report.add_failure(filename_local)
+
+    print 'Upload finished.'
+    print report.summary()
+
+    orphans = None
+    if etag_diff:
+        try:
+            kept = _fetch_kept_names(conn, remote_etags)
+        except UploadError as e:
+            print 'Not looking for orphans: %s' % e
+        else:
+            orphans = _find_orphans(files, index, remote_etags, compressed,
+                                    kept)
+        if orphans:
+            print 'Found %s keys in the bucket with no local file:' % \
+                    len(orphans)
+            for key in orphans:
+                print '    %s' % key
+        if orphans and delete_orphans:
+            failures = _delete_orphans(conn, orphans)
+            print 'Deleted %s orphan keys' % (len(orphans) - failures)
 
     # refresh metadata file on the server
+    if report.failed:
+        # (in etag mode, remote_metadata holds md5s, not shas)
+        _forget_failed_files(report.failed,
+                             {} if etag_diff else remote_metadata)
+    if HASHED_NAMES:
+        print 'Uploading manifest file'
+        present = _get_present_keys(remote_etags, files_to_upload, index,
+                                    report.failed, compressed)
+        _build_manifest_file(index, present, compressed)
+        if not upload_file(conn, LOCAL_MANIFEST_FILE, MANIFEST_FILE):
+            report.add_failure(MANIFEST_FILE)
+        history_key = _get_manifest_history_key()
+        if not upload_file(conn, LOCAL_MANIFEST_FILE, history_key):
+            report.add_failure(history_key)
     print 'Uploading local metadata file'
-    upload_file(conn, LOCAL_METADATA_FILE, REMOTE_METADATA_FILE)
+    if upload_file(conn, LOCAL_METADATA_FILE, REMOTE_METADATA_FILE):
+        # the remote metadata accounts for this run now
+        journal.remove()
+    else:
+        report.add_failure(REMOTE_METADATA_FILE)
+        journal.close()
     print 'Uploading process DONE'
+    if report.failed:
+        print 'FAILED: %s files could not be uploaded' % len(report.failed)
+    conn.close()
+    return report
 
 
 if __name__ == '__main__':
-    static_root = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Upload static files to S3')
+    parser.add_argument('static_root')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help='number of concurrent uploads')
+    parser.add_argument('--rehash-all', action='store_true',
+                        help='ignore the local index and hash every file')
+    parser.add_argument('--etag-diff', action='store_true',
+                        help='compare local files with the bucket ETags')
+    parser.add_argument('--delete-orphans', action='store_true',
+                        help='with --etag-diff, delete bucket keys '
+                             'with no local file')
+    parser.add_argument('--compress-jobs', type=int, default=None,
+                        help='number of compression (and image '
+                             'optimization) processes (default: one per CPU)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='upload over --jobs non-blocking connections, '
+                             'from a single thread')
+    parser.add_argument('--plan', action='store_true',
+                        help='only print what would be uploaded, '
+                             'and an estimate of how long it would take')
+    args = parser.parse_args()
+
+    static_root = args.static_root
     LOCAL_METADATA_FILE = os.path.join(static_root, LOCAL_METADATA_FILE)
-    upload_all_to_s3(static_root)
+    LOCAL_INDEX_FILE = os.path.join(static_root, LOCAL_INDEX_FILE)
+    LOCAL_MANIFEST_FILE = os.path.join(static_root, LOCAL_MANIFEST_FILE)
+    LOCAL_JOURNAL_FILE = os.path.join(static_root, LOCAL_JOURNAL_FILE)
+    LOCAL_HISTORY_FILE = os.path.join(static_root, LOCAL_HISTORY_FILE)
+    try:
+        result = upload_all_to_s3(static_root, jobs=args.jobs,
+                                  rehash_all=args.rehash_all,
+                                  etag_diff=args.etag_diff,
+                                  delete_orphans=args.delete_orphans,
+                                  compress_jobs=args.compress_jobs,
+                                  use_async=args.use_async,
+                                  plan=args.plan)
+    except UploadError as e:
+        print e
+        sys.exit(2)
+    if args.plan:
+        print result.summary()
+        sys.exit(0)
+    sys.exit(1 if result.failed else 0)
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Specs of upload_static_s3.py which need no bucket: uploads go to a
+recording stand-in of S3.AWSAuthConnection.
+
+    E.g.: python -m unittest upload_static_s3_spec
+
+"""
+import __builtin__
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'spec')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'spec')
+
+import upload_static_s3
+import precompress
+
+CSS = 'body { margin: 0; padding: 0; }\n' * 200
+
+
+class RecordingConnection(object):
+    """ Stores the body of every PUT and replies 200 """
+    class Reply(object):
+        class HttpResponse(object):
+            status = 200
+        http_response = HttpResponse()
+        message = ''
+
+    def __init__(self):
+        self.puts = {}
+
+    def put(self, bucket, key, s3_object, headers):
+        self.puts[key] = s3_object.data.read()
+        return self.Reply()
+
+
+class UploadSpec(unittest.TestCase):
+    """ Uploads of files written to a temporary static root """
+
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.cache_dir = precompress.CACHE_DIR
+        precompress.CACHE_DIR = tempfile.mkdtemp()
+        self.log = upload_static_s3._log
+        upload_static_s3._log = lambda message: None
+        self.opened = []
+        self.open = __builtin__.open
+
+    def tearDown(self):
+        __builtin__.open = self.open
+        upload_static_s3._log = self.log
+        shutil.rmtree(precompress.CACHE_DIR)
+        precompress.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.static_root)
+
+    def _write(self, f, content):
+        path = os.path.join(self.static_root, f)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fd:
+            fd.write(content)
+        return path
+
+    def _count_opens(self):
+        def counting_open(name, *args, **kwargs):
+            self.opened.append(os.path.abspath(name))
+            return self.open(name, *args, **kwargs)
+        __builtin__.open = counting_open
+
+    def _index(self, contents):
+        """ (index, compressed) dicts of files with the given contents """
+        index = {}
+        compressed = {}
+        for f, content in contents.items():
+            path = self._write(f, content)
+            sha = upload_static_s3._get_file_digests(path)[0]
+            index[f] = (0, 0, sha, None)
+            compressed[f] = precompress.compress_file(
+                (path, sha, len(content)))
+        return index, compressed
+
+    def _build_manifest(self, index, present, compressed):
+        manifest_file = upload_static_s3.LOCAL_MANIFEST_FILE
+        upload_static_s3.LOCAL_MANIFEST_FILE = os.path.join(
+            self.static_root, 'manifest.json')
+        try:
+            upload_static_s3._build_manifest_file(index, present, compressed)
+            with open(upload_static_s3.LOCAL_MANIFEST_FILE) as f:
+                return json.load(f)
+        finally:
+            upload_static_s3.LOCAL_MANIFEST_FILE = manifest_file
+
+    def _upload(self, f, compressed=None):
+        conn = RecordingConnection()
+        report = upload_static_s3.UploadReport()
+        self._count_opens()
+        upload_static_s3._upload_asset(conn, self.static_root, f, report,
+                                       compressed)
+        __builtin__.open = self.open
+        self.assertEqual(report.failed, [])
+        return conn.puts
+
+
+class SinglePassReadSpec(UploadSpec):
+    """ Every asset is read from disk once, whatever it is uploaded as """
+
+    def test_reads_a_compressed_asset_once_for_all_its_versions(self):
+        path = self._write('css/style.css', CSS)
+        sha = upload_static_s3._get_file_digests(path)[0]
+        compressed = precompress.compress_file((path, sha, len(CSS)))
+
+        puts = self._upload('css/style.css', compressed)
+
+        self.assertEqual(self.opened.count(os.path.abspath(path)), 1)
+        hashed = upload_static_s3._get_hashed_name('css/style.css', sha)
+        gzip_names = [upload_static_s3._get_gzip_name(name)
+                      for name in ('css/style.css', hashed)]
+        for name in ['css/style.css', hashed] + gzip_names:
+            self.assertIn(name, puts)
+        self.assertEqual(puts['css/style.css'], CSS)
+        self.assertEqual(puts[hashed], CSS)
+        for name in gzip_names:
+            self.assertEqual(
+                gzip.GzipFile(fileobj=StringIO(puts[name])).read(), CSS)
+
+    def test_reads_an_uncompressed_asset_once(self):
+        content = '\x89PNG\r\n\x1a\n' + os.urandom(2048)
+        path = self._write('img/logo.png', content)
+
+        puts = self._upload('img/logo.png')
+
+        self.assertEqual(self.opened.count(os.path.abspath(path)), 1)
+        sha = upload_static_s3._get_file_digests(path)[0]
+        hashed = upload_static_s3._get_hashed_name('img/logo.png', sha)
+        self.assertEqual(sorted(puts), sorted(['img/logo.png', hashed]))
+        self.assertEqual(puts['img/logo.png'], content)
+
+
+class FailedFileSpec(UploadSpec):
+    """ An error with a file is accounted, and stops no other upload """
+
+    def test_accounts_an_unexpected_error_as_a_failure(self):
+        class BrokenConnection(RecordingConnection):
+            def put(self, bucket, key, s3_object, headers):
+                raise RuntimeError('broken')
+        self._write('css/style.css', CSS)
+        report = upload_static_s3.UploadReport()
+
+        upload_static_s3._upload_asset(BrokenConnection(), self.static_root,
+                                       'css/style.css', report)
+
+        self.assertEqual(report.failed, ['css/style.css'])
+
+    def test_accounts_an_unreadable_file_as_a_failure(self):
+        report = upload_static_s3.UploadReport()
+
+        upload_static_s3._upload_asset(RecordingConnection(),
+                                       self.static_root, 'css/gone.css',
+                                       report)
+
+        self.assertEqual(report.failed, ['css/gone.css'])
+
+
+class WorthCompressingSpec(UploadSpec):
+    """ Compressed versions which save next to nothing are not used """
+
+    def test_uploads_no_compressed_version_of_an_incompressible_file(self):
+        content = os.urandom(4096)
+        path = self._write('js/random.js', content)
+        sha = upload_static_s3._get_file_digests(path)[0]
+        compressed = precompress.compress_file((path, sha, len(content)))
+        self.assertEqual(compressed.gzip_path, None)
+
+        puts = self._upload('js/random.js', compressed)
+
+        hashed = upload_static_s3._get_hashed_name('js/random.js', sha)
+        self.assertEqual(sorted(puts), sorted(['js/random.js', hashed]))
+
+    def test_lists_only_the_uploaded_gzip_versions_in_the_manifest(self):
+        index, compressed = self._index({
+            'css/style.css': CSS, 'js/random.js': os.urandom(4096)})
+        present = upload_static_s3._get_present_keys(
+            {}, sorted(index), index, [], compressed)
+
+        manifest = self._build_manifest(index, present, compressed)
+
+        hashed = manifest['css/style.css']
+        self.assertEqual(manifest['css/style.gz.css'],
+                         upload_static_s3._get_gzip_name(hashed))
+        self.assertIn('js/random.js', manifest)
+        self.assertNotIn('js/random.gz.js', manifest)
+
+
+class ManifestSpec(UploadSpec):
+    """ The manifest only points to hashed names which are in the bucket """
+
+    def setUp(self):
+        super(ManifestSpec, self).setUp()
+        self.index, self.compressed = self._index({'css/style.css': CSS})
+        self.sha = self.index['css/style.css'][2]
+        self.hashed = upload_static_s3._get_hashed_name('css/style.css',
+                                                        self.sha)
+
+    def test_uploads_the_recorded_files_missing_their_hashed_names(self):
+        remote_etags = {'css/style.css': 'etag', 'css/style.gz.css': 'etag'}
+
+        missing = upload_static_s3._find_missing_hashed_names(
+            sorted(self.index), self.index, remote_etags, self.compressed)
+
+        self.assertEqual(missing, ['css/style.css'])
+
+    def test_leaves_out_the_hashed_names_missing_from_the_bucket(self):
+        present = upload_static_s3._get_present_keys(
+            {'css/style.css': 'etag'}, [], self.index, [], self.compressed)
+
+        manifest = self._build_manifest(self.index, present, self.compressed)
+
+        self.assertEqual(manifest, {})
+
+    def test_leaves_out_the_files_which_failed_to_upload(self):
+        present = upload_static_s3._get_present_keys(
+            {}, ['css/style.css'], self.index, ['css/style.css'],
+            self.compressed)
+
+        manifest = self._build_manifest(self.index, present, self.compressed)
+
+        self.assertEqual(manifest, {})
+
+    def test_lists_the_hashed_names_already_in_the_bucket(self):
+        names = upload_static_s3._get_hashed_s3_names(
+            'css/style.css', self.sha, self.compressed['css/style.css'])
+        present = upload_static_s3._get_present_keys(
+            dict((name, 'etag') for name in names), [], self.index, [],
+            self.compressed)
+
+        manifest = self._build_manifest(self.index, present, self.compressed)
+
+        self.assertEqual(manifest['css/style.css'], self.hashed)
+
+    def test_leaves_out_the_ignored_files(self):
+        index, compressed = self._index({'css/style.css.bak': CSS})
+        present = upload_static_s3._get_present_keys(
+            {}, sorted(index), index, [], compressed)
+
+        manifest = self._build_manifest(index, present, compressed)
+
+        self.assertEqual(manifest, {})
+
+
+class BucketConnection(RecordingConnection):
+    """ Replies to GETs with the given dict of key -> body """
+    class Found(RecordingConnection.Reply):
+        def __init__(self, body):
+            self.body = body
+
+    class NotFound(RecordingConnection.Reply):
+        class HttpResponse(object):
+            status = 404
+        http_response = HttpResponse()
+
+    def __init__(self, bodies):
+        super(BucketConnection, self).__init__()
+        self.bodies = bodies
+
+    def get(self, bucket, key):
+        if key in self.bodies:
+            return self.Found(self.bodies[key])
+        return self.NotFound()
+
+
+class OrphanSpec(unittest.TestCase):
+    """ Hashed names are orphans once no kept manifest points to them """
+
+    def setUp(self):
+        self.history_size = upload_static_s3.MANIFEST_HISTORY_SIZE
+        upload_static_s3.MANIFEST_HISTORY_SIZE = 2
+        self.manifests = {}
+        for day, sha in (('01', 'aaaaaaaaaaaa'), ('02', 'bbbbbbbbbbbb'),
+                         ('03', 'cccccccccccc')):
+            key = '%s201401%s000000.json' % (
+                upload_static_s3.MANIFEST_HISTORY_PREFIX, day)
+            self.manifests[key] = json.dumps(
+                {'css/style.css': 'css/style.%s.css' % sha})
+        self.remote_etags = dict((key, 'etag') for key in self.manifests)
+        for sha in ('aaaaaaaaaaaa', 'bbbbbbbbbbbb', 'cccccccccccc'):
+            self.remote_etags['css/style.%s.css' % sha] = 'etag'
+
+    def tearDown(self):
+        upload_static_s3.MANIFEST_HISTORY_SIZE = self.history_size
+
+    def _find_orphans(self):
+        conn = BucketConnection(self.manifests)
+        kept = upload_static_s3._fetch_kept_names(conn, self.remote_etags)
+        return upload_static_s3._find_orphans([], {}, self.remote_etags,
+                                              kept=kept)
+
+    def test_deletes_the_hashed_names_of_the_older_manifests(self):
+        self.assertEqual(self._find_orphans(),
+                         ['css/style.aaaaaaaaaaaa.css',
+                          'manifests/20140101000000.json'])
+
+    def test_keeps_the_hashed_names_of_the_current_manifest(self):
+        self.manifests[upload_static_s3.MANIFEST_FILE] = json.dumps(
+            {'css/style.css': 'css/style.aaaaaaaaaaaa.css'})
+
+        self.assertEqual(self._find_orphans(),
+                         ['manifests/20140101000000.json'])
+
+    def test_does_not_mistake_other_keys_for_hashed_names(self):
+        self.remote_etags['img/photo.0123456789ab.jpg'] = 'etag'
+
+        self.assertIn('img/photo.0123456789ab.jpg', self._find_orphans())
+
+    def test_sorts_the_manifest_history_keys_by_date(self):
+        key = upload_static_s3._get_manifest_history_key()
+
+        self.assertTrue(key.startswith(
+            upload_static_s3.MANIFEST_HISTORY_PREFIX))
+        self.assertTrue(key > max(self.manifests))
+
+
+if __name__ == '__main__':
+    unittest.main()
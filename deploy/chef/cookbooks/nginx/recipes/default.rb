@@ -34,6 +34,15 @@ cookbook_file "/etc/nginx/nginx.conf" do
   notifies :reload, "service[nginx]"
 end
 
+# rewritten by every deploy (see _swap_gunicorn in fabfile.py)
+cookbook_file "/etc/nginx/gunicorn_upstream.conf" do
+  source "gunicorn_upstream.conf"
+  owner "root"
+  group "root"
+  mode 0644
+  action :create_if_missing
+end
+
 cookbook_file "/etc/nginx/sites-enabled/default" do
   source "default.conf"
   owner "root"
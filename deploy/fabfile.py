@@ -30,6 +30,9 @@ List of major tasks provided in this fabric script:
             restart gunicorn,
             install newest cronjob list)
 
+    rolling_deploy (deploy to several hosts: all updated in parallel,
+                    then restarted in batches, health-checked)
+
     stop (stop gunicorn. Takes website out of service)
     start (Undo stop task. Start gunicorn)
 
@@ -40,7 +43,13 @@ List of major tasks provided in this fabric script:
             Gunicorn,
             Supervisor)
 
-    db_backup (do a db_backup and stores it remotely)
+    db_backup (do a db_backup and stores it remotely,
+               in a deduplicated store: see pg_scripts/pg_chunk_store.py)
+    list_db_backups (list the backups stored remotely)
+    restore_db (recreate the db from a stored or local backup)
+    db_dump (parallel directory-format dumps of every database,
+             for maintenance windows: faster to take and to restore)
+    restore_db_dump (parallel restore of the above)
     fetch_backups (fetch the backups stored remotely to some local folder)
     cleanup_old_backups (cleanup remote folder to store just N latest backups)
 
@@ -49,23 +58,54 @@ ToDo: To create a Rollback task (panic button)
 
 """
 from fabric.api import task, run, local, cd, sudo, lcd, put, get
-from fabric.context_managers import settings
+from fabric.api import execute, parallel, runs_once
+from fabric.context_managers import settings, hide
 from fabric.contrib.files import append, exists
+from fabric.state import output
+from fabric.utils import abort, warn
 
 import os
 import sys
+import json
+import time
+import uuid
+import pipes
+import base64
+import hashlib
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
 
 
 DEPLOY_LOCK_FILE = '/tmp/deploy_running.{0}'.format(os.environ['USER'])
+FETCH_CATALOG_FILE = '.fetch_catalog.json'
+BACKUP_CATALOG_FILE = 'catalog.jsonl'  # see pg_scripts/pg_backup_catalog.py
+BACKUP_STORE_LOCK_FILE = 'store.lock'  # see pg_scripts/pg_chunk_store.py
+FETCH_CHUNK_SIZE = 64 * 1024
+FETCH_SHA1_BATCH = 200  # files per remote sha1sum command
+GUNICORN_PORTS = (8000, 8001)  # one supervisor program each, see etc/
+NGINX_UPSTREAM_FILE = '/etc/nginx/gunicorn_upstream.conf'
+WARMUP_URL = '/'
+WARMUP_REQUESTS = 6  # two for each gunicorn worker
+WARMUP_TRIES = 240  # every 0.5 s, for a new gunicorn to answer
+HEALTH_CHECK_TRIES = 20  # every 0.5 s, for nginx to answer after a swap
+DEPLOY_POOL_SIZE = 10  # hosts updated at once by rolling_deploy
+# south operations which lock or rewrite whole tables, or which break the
+# code still serving while they run (add_column is fine with null=True)
+EXCLUSIVE_MIGRATION_OPERATIONS = ('add_column', 'alter_column',
+                                  'rename_column', 'delete_column',
+                                  'rename_table', 'delete_table',
+                                  'create_index', 'create_unique',
+                                  'delete_unique', 'create_primary_key',
+                                  'execute')
 
 
 @task
 def get_deploy_lock():
-    if exists(DEPLOY_LOCK_FILE):
-        return False
-    run('touch {0}'.format(DEPLOY_LOCK_FILE))
-    return True
+    # noclobber: the file is only created if it doesn't exist, atomically
+    with settings(warn_only=True):
+        return run('set -o noclobber; echo "{0:%Y-%m-%d %H:%M}" > {1}'.format(
+            datetime.now(), DEPLOY_LOCK_FILE)).succeeded
 
 
 @task
@@ -109,9 +149,16 @@ def build_local_vars():
     local_env.etc_root = os.path.join(local_env.deploy_root, 'etc')
     local_env.chef_root = os.path.join(local_env.deploy_root, 'chef')
     local_env.db_backup_root = os.path.join(local_env.project_root, 'backups')
+    #one json line per timed task: db tasks (to follow our recovery-time
+    #objective) and deploys
+    local_env.timings_file = os.path.join(local_env.db_backup_root,
+                                          'timings.log')
     local_env.db_backup_cleanup_script = os.path.join(local_env.deploy_root,
                                                       'pg_scripts',
                                                       'pg_cleanup_backups.py')
+    local_env.db_backup_store_script = os.path.join(local_env.deploy_root,
+                                                    'pg_scripts',
+                                                    'pg_chunk_store.py')
 
     return local_env
 
@@ -131,7 +178,8 @@ def build_remote_vars():
     env.user = node_json.get('user', 'ec2-user')
     env.project_env = node_json.get('environment', 'PROD')
 
-    env.hosts = ['ec2-54-232-126-197.sa-east-1.compute.amazonaws.com']
+    env.hosts = node_json.get(
+        'hosts', ['ec2-54-232-126-197.sa-east-1.compute.amazonaws.com'])
     #key_filename references a local filename, but it is necessary to ssh
     env.key_filename = '~/.ssh/ces27-key.pem'
     #env.forward_agent = True
@@ -154,7 +202,14 @@ def build_remote_vars():
                                          '/var/backups/db/')
     env.db_backup_cleanup_script = '{0}pg_scripts/pg_cleanup_backups.py'.\
             format(env.deploy_root)
+    env.db_backup_store_script = '{0}pg_scripts/pg_chunk_store.py'.\
+            format(env.deploy_root)
+    env.db_backup_catalog_script = '{0}pg_scripts/pg_backup_catalog.py'.\
+            format(env.deploy_root)
+    env.db_dump_root = '{0}dumps/'.format(env.db_backup_root)
     env.db_conf_file = '/var/lib/pgsql/data/postgresql.conf'
+    #sha1 of the migrations, models and settings of the last migrate
+    env.migrations_state_file = '{0}.migrations_state'.format(env.home_root)
 
     return env
 
@@ -210,21 +265,22 @@ def build_essential():
     Also, prepares essential environment profile links
 
     """
-    sudo('yum upgrade -y')
-    sudo('yum groupinstall -y "Development Tools"')
-    sudo('yum groupinstall -y "Development Libraries"')
-    sudo('yum install -y openssl mod_ssl openssl-devel')
-    sudo('yum install -y zlib zlib-devel\
-         libjpeg libjpeg-devel libjpeg-static\
-         freetype freetype-devel')
-
-    sudo('yum install -y ruby ruby-devel rubygems\
-         ruby-docs ruby-ri ruby-irb ruby-rdoc')
-    sudo('gem install chef --no-ri --no-rdoc')
-
-    run('touch {0}'.format(env.profile_file))
-    if exists('~/.bash_profile'):
-        run("echo 'source {0}' >> ~/.bash_profile".format(env.profile_file))
+    _run_batch(['yum upgrade -y',
+                'yum groupinstall -y "Development Tools"',
+                'yum groupinstall -y "Development Libraries"',
+                'yum install -y openssl mod_ssl openssl-devel',
+                'yum install -y pigz',
+                'yum install -y zlib zlib-devel '
+                'libjpeg libjpeg-devel libjpeg-static '
+                'freetype freetype-devel',
+                'yum install -y ruby ruby-devel rubygems '
+                'ruby-docs ruby-ri ruby-irb ruby-rdoc',
+                'gem install chef --no-ri --no-rdoc'], use_sudo=True)
+
+    _run_batch(['touch {0}'.format(env.profile_file),
+                "if [ -e ~/.bash_profile ]; then "
+                "echo 'source {0}' >> ~/.bash_profile; fi".format(
+                    env.profile_file)])
 
 
 @task
@@ -330,9 +386,339 @@ def _soft_deploy(src=True, static=True, req=False, secret=False):
         deploy_static_assets()
 
     if src:
-        supervisorctl('stop', 'gunicorn')
-        manage('syncdb --migrate --noinput')
-        supervisorctl('start', 'gunicorn')
+        timings = []
+        migrate, migrations_hash, pending, exclusive = \
+            _check_migrations(timings)
+        if exclusive or _active_gunicorn_port() is None:
+            _restart_gunicorn(timings, migrate and migrations_hash)
+        else:
+            if migrate:
+                with _timed(timings, 'migrate (online)'):
+                    _migrate(migrations_hash)
+            _swap_gunicorn(timings)
+        _report_timings('soft_deploy', timings, migrated=migrate,
+                        migrations=len(pending),
+                        exclusive_migrations=len(exclusive))
+
+
+def _check_migrations(timings):
+    """
+    (migrate, migrations_hash, pending, exclusive): whether there is
+    anything to migrate (see _migrations_hashes), and if so the pending
+    migrations, and the ones among them needing exclusive access
+    """
+    pending = exclusive = []
+    with _timed(timings, 'check migrations'):
+        applied_hash, migrations_hash = _migrations_hashes()
+        migrate = applied_hash != migrations_hash
+        if migrate:
+            pending = _pending_migrations()
+            exclusive = _exclusive_migrations(pending)
+    if not migrate:
+        print 'No migration, model or settings changes since the last ' \
+              'migrate: not migrating'
+    if exclusive:
+        print 'Migrations needing exclusive access: {0}'.format(
+            ', '.join('/'.join(m) for m in exclusive))
+    return migrate, migrations_hash, pending, exclusive
+
+
+def _migrations_hashes():
+    """
+    (sha1 recorded by the last migrate (None if there is none), sha1
+    of the code deployed which syncdb --migrate depends on: migration
+    modules, models and settings)
+
+    In one remote command, without starting django.
+    """
+    output = run("cat {0} 2>/dev/null || echo none; "
+                 "cd {1} && find . -name '*.py' \\( -path '*/migrations/*' "
+                 "-o -name models.py -o -path './settings/*' \\) | sort | "
+                 "xargs sha1sum | sha1sum".format(
+                     env.migrations_state_file, env.src_root))
+    applied_hash, migrations_hash = [line.split()[0]
+                                     for line in output.splitlines()[-2:]]
+    return (None if applied_hash == 'none' else applied_hash,
+            migrations_hash)
+
+
+def _migrate(migrations_hash):
+    """ syncdb --migrate, recording migrations_hash once it is done """
+    manage('syncdb --migrate --noinput')
+    run('echo {0} > {1}'.format(migrations_hash, env.migrations_state_file))
+
+
+def _pending_migrations():
+    """ (app, migration) of the south migrations not applied yet """
+    pending = []
+    app = None
+    for line in manage('migrate --list').splitlines():
+        line = line.strip()
+        if line.startswith('( )'):
+            pending.append((app, line[3:].strip()))
+        elif line and not line.startswith('('):
+            app = line
+    return pending
+
+
+def _exclusive_migrations(pending):
+    """
+    The pending migrations which use any of the
+    EXCLUSIVE_MIGRATION_OPERATIONS: they can't run while the site is up.
+    """
+    if not pending:
+        return []
+    pattern = r'db\.({0})\('.format('|'.join(EXCLUSIVE_MIGRATION_OPERATIONS))
+    with settings(warn_only=True):
+        output = run("grep -rHE --include='*.py' '{0}' {1}".format(
+            pattern, env.src_root))
+    exclusive = set()
+    for line in output.splitlines():
+        path, _, code = line.partition(':')
+        parts = path.split('/')
+        if len(parts) < 3 or parts[-2] != 'migrations':
+            continue
+        migration = (parts[-3], parts[-1][:-len('.py')])
+        if migration not in pending:
+            continue
+        if 'db.add_column(' in code and 'null=True' in code and \
+                code.count('db.') == 1:
+            continue
+        exclusive.add(migration)
+    return sorted(exclusive)
+
+
+def _active_gunicorn_port():
+    """
+    Port of the gunicorn nginx proxies to, None if nginx can't be
+    switched (the server was provisioned before NGINX_UPSTREAM_FILE)
+    """
+    with settings(warn_only=True):
+        upstream = sudo('cat {0}'.format(NGINX_UPSTREAM_FILE))
+    if upstream.failed:
+        return None
+    for port in GUNICORN_PORTS:
+        if '127.0.0.1:{0} '.format(port) in upstream:
+            return port
+    return None
+
+
+def _warm_up(port, requests=WARMUP_REQUESTS, tries=WARMUP_TRIES):
+    """
+    Waits for the server on port (a new gunicorn) to answer WARMUP_URL
+    (with anything but a server error), then sends it requests more, so
+    that every worker has served. Returns their seconds, None if it
+    never answered.
+    """
+    url = 'http://127.0.0.1:{0}{1}'.format(port, WARMUP_URL)
+    answered = '[ "$code" -ge 200 -a "$code" -lt 500 ]'
+    with settings(warn_only=True):
+        output = run(
+            'for i in $(seq {0}); do '
+            'code=$(curl -s -o /dev/null -w "%{{http_code}}" {1}); '
+            '{2} && break; sleep 0.5; done; {2} || exit 1; '
+            'for i in $(seq {3}); do '
+            'curl -s -o /dev/null -w "%{{time_total}}\\n" {1}; done'.format(
+                tries, url, answered, requests))
+    if output.failed:
+        return None
+    return [float(line) for line in output.split()]
+
+
+def _print_warm_up(port, seconds):
+    print 'gunicorn on {0} warm: responses took {1} ms'.format(
+        port, ', '.join('{0:.0f}'.format(s * 1000) for s in seconds))
+
+
+def _swap_gunicorn(timings):
+    """
+    Restarts gunicorn without dropping a request: a new gunicorn (a new
+    master, preloading the new code) is started on the port not in use,
+    and warmed up. Only then nginx is switched to it, gracefully (its
+    old workers finish their requests), and the old gunicorn is stopped,
+    gracefully too (its workers finish theirs, see etc/supervisord.conf).
+    """
+    old_port = _active_gunicorn_port()
+    new_port = [p for p in GUNICORN_PORTS if p != old_port][0]
+    with _timed(timings, 'start and warm up gunicorn on {0}'.format(
+            new_port)):
+        # it may still be running, with older code
+        supervisorctl('restart', 'gunicorn:gunicorn_{0}'.format(new_port))
+        seconds = _warm_up(new_port)
+    if seconds is None:
+        supervisorctl('stop', 'gunicorn:gunicorn_{0}'.format(new_port))
+        raise Exception('gunicorn on {0} did not answer. The one on {1} '
+                        'is still serving.'.format(new_port, old_port))
+    _print_warm_up(new_port, seconds)
+
+    with _timed(timings, 'switch nginx to {0}'.format(new_port)):
+        sudo('cp {0} {0}.old && '
+             'echo "server 127.0.0.1:{1} fail_timeout=0;" > {0} && '
+             '(nginx -t && service nginx reload || '
+             '(mv {0}.old {0}; exit 1))'.format(NGINX_UPSTREAM_FILE,
+                                                new_port))
+    with _timed(timings, 'stop gunicorn on {0}'.format(old_port)):
+        supervisorctl('stop', 'gunicorn:gunicorn_{0}'.format(old_port))
+
+
+def _restart_gunicorn(timings, migrations_hash=None):
+    """
+    Stops gunicorn, migrates (if given the migrations_hash to record)
+    and starts it again: the site is down until the new gunicorn is
+    warm. For the migrations which need exclusive access to the db
+    (see _exclusive_migrations).
+    """
+    port = _active_gunicorn_port() or GUNICORN_PORTS[0]
+    with _timed(timings, 'downtime: stop, {0}start and warm up'.format(
+            'migrate, ' if migrations_hash else '')):
+        supervisorctl('stop', 'gunicorn:*')
+        if migrations_hash:
+            _migrate(migrations_hash)
+        supervisorctl('start', 'gunicorn:gunicorn_{0}'.format(port))
+        seconds = _warm_up(port)
+    if seconds is not None:
+        _print_warm_up(port, seconds)
+
+
+@task
+@runs_once
+def rolling_deploy(batch_size=1, src=True, static=True, req=False,
+                   secret=False):
+    """
+    Deploys to all of env.hosts (see node.json) without restarting them
+    all at once:
+        - code (with req and secret) and static files are updated on
+          every host in parallel; static files are uploaded once
+        - migrations run once, on the first host (see soft_deploy)
+        - gunicorn is restarted without downtime (see _swap_gunicorn)
+          on batch_size hosts at a time, and nginx on each of them must
+          answer before the next batch starts
+
+    If there are migrations needing exclusive access, gunicorn is
+    stopped on every host while they run instead.
+
+    One deploy lock (on the first host) covers the whole cluster.
+    Every step is timed, on every host.
+    """
+    batch_size = int(batch_size)
+    lock_host = env.hosts[0]
+    if not execute(get_deploy_lock, hosts=[lock_host])[lock_host]:
+        print 'It appears another deploy is currently running. Try again later'
+        return
+    try:
+        _rolling_deploy(batch_size, src, static, req, secret)
+    except Exception as e:
+        print e
+        print 'Some error found. Quitting now.'
+        sys.exit(1)
+    finally:
+        # also when fabric aborts (a failed command on any host)
+        execute(release_deploy_lock, hosts=[lock_host])
+
+
+def _rolling_deploy(batch_size, src, static, req, secret):
+    hosts = list(env.hosts)
+    host_timings = dict((host, []) for host in hosts)
+    timings = []
+
+    def _add_timings(results):
+        for host, steps in results.items():
+            host_timings[host].extend(steps)
+
+    with _timed(timings, 'update {0} hosts'.format(len(hosts))):
+        _add_timings(execute(parallel(pool_size=DEPLOY_POOL_SIZE)(
+            _update_host), src, req, secret, static, hosts=hosts))
+    if static:
+        with _timed(timings, 'upload static assets'):
+            execute(_upload_static_assets, hosts=hosts[:1])
+
+    if src:
+        migrate, migrations_hash, pending, exclusive = execute(
+            _check_migrations, host_timings[hosts[0]], hosts=hosts[:1])[
+                hosts[0]]
+        if exclusive:
+            with _timed(timings, 'downtime: stop, migrate, start'):
+                execute(parallel(pool_size=DEPLOY_POOL_SIZE)(supervisorctl),
+                        'stop', 'gunicorn:*', hosts=hosts)
+                execute(_migrate, migrations_hash, hosts=hosts[:1])
+                _add_timings(execute(parallel(pool_size=DEPLOY_POOL_SIZE)(
+                    _restart_host), hosts=hosts))
+        else:
+            if migrate:
+                with _timed(timings, 'migrate (online)'):
+                    execute(_migrate, migrations_hash, hosts=hosts[:1])
+            for i in range(0, len(hosts), batch_size):
+                batch = hosts[i:i + batch_size]
+                with _timed(timings, 'restart {0}'.format(', '.join(batch))):
+                    _add_timings(execute(parallel(pool_size=batch_size)(
+                        _restart_host), hosts=batch))
+                    unhealthy = [host for host, ok in execute(parallel(
+                        pool_size=batch_size)(_check_health),
+                        hosts=batch).items() if not ok]
+                if unhealthy:
+                    raise Exception('{0} not answering after the restart. '
+                                    '{1} not restarted.'.format(
+                                        ', '.join(unhealthy),
+                                        ', '.join(hosts[i + batch_size:])
+                                        or 'All hosts'))
+
+    _report_host_timings(host_timings)
+    _report_timings('rolling_deploy', timings, batch_size=batch_size,
+                    hosts=dict((host, [[step, round(seconds, 1)]
+                                       for step, seconds in steps])
+                               for host, steps in host_timings.items()))
+
+
+def _update_host(src, req, secret, static):
+    """ The parallel part of rolling_deploy. Returns its timings. """
+    timings = []
+    if src:
+        with _timed(timings, 'update code'):
+            update_src_code(secret=secret)
+    if req:
+        with _timed(timings, 'install requirements'):
+            _install_requirements('{0}requirements/prod.txt'.format(
+                env.project_root))
+    if static:
+        with _timed(timings, 'collect static assets'):
+            _collect_static_assets()
+    return timings
+
+
+def _restart_host():
+    """ Restarts gunicorn with the new code. Returns the timings. """
+    timings = []
+    if _active_gunicorn_port() is None:
+        _restart_gunicorn(timings)
+    else:
+        _swap_gunicorn(timings)
+    return timings
+
+
+def _check_health():
+    """ Does nginx answer (with anything but a server error) """
+    return _warm_up(80, requests=1, tries=HEALTH_CHECK_TRIES) is not None
+
+
+def _report_host_timings(host_timings):
+    """ Prints the timings of each host, side by side """
+    hosts = sorted(host_timings)
+    steps = []
+    for host in hosts:
+        steps.extend(step for step, _ in host_timings[host]
+                     if step not in steps)
+    print 'Timings per host (s):'
+    print '    {0:<40} {1}'.format('', ' '.join(
+        '{0:>12}'.format(host.split('.')[0][-12:]) for host in hosts))
+    for step in steps:
+        print '    {0:<40} {1}'.format(step[:40], ' '.join(
+            '{0:>12}'.format('{0:.1f}'.format(sum(
+                seconds for s, seconds in host_timings[host] if s == step))
+                if step in dict(host_timings[host]) else '-')
+            for host in hosts))
+    print '    {0:<40} {1}'.format('total', ' '.join(
+        '{0:>12.1f}'.format(sum(seconds for _, seconds in host_timings[host]))
+        for host in hosts))
 
 
 @task
@@ -389,19 +775,20 @@ def rebuild_solr_index():
 @task
 def stop():
     """ Stop server """
-    supervisorctl('stop', 'gunicorn')
+    supervisorctl('stop', 'gunicorn:*')
 
 
 @task
 def start():
-    """ Start server """
-    supervisorctl('start', 'gunicorn')
+    """ Start server (the gunicorn nginx proxies to) """
+    supervisorctl('start', 'gunicorn:gunicorn_{0}'.format(
+        _active_gunicorn_port() or GUNICORN_PORTS[0]))
 
 
 @task
 def status():
     """ Complete Status Check of the server """
-    supervisorctl('status', 'gunicorn')
+    supervisorctl('status', 'gunicorn:*')
     service('status', 'nginx')
     service('status', 'postgresql')
     service('status', 'memcached')
@@ -416,17 +803,333 @@ def manage(command, redirect_to=''):
     if redirect_to:
         cmd += ' > {0}'.format(redirect_to)
     with cd('{0}'.format(env.src_root)):
-        run(cmd)
+        return run(cmd)
+
+
+def _run_batch(commands, use_sudo=False):
+    """
+    Runs the shell commands as a single remote script: one ssh round
+    trip (with run, or sudo if use_sudo) instead of one for each.
+    Every command runs in its own subshell, with no stdin, until one
+    fails, which aborts (or warns, with warn_only) like run and sudo.
+
+    Returns (command, exit status, output, seconds) of each command
+    run. Their output is printed as run and sudo do, with the time the
+    batch took (see benchmark_batching for what batching saves).
+    """
+    if not commands:
+        return []
+    marker = '__batch_{0}__'.format(uuid.uuid4().hex)
+    script = ''.join(
+        'printf "\\n{0} {1} start %s\\n" $(date +%s.%N)\n'
+        '( {2}\n) < /dev/null 2>&1\n'
+        'status=$?\n'
+        'printf "\\n{0} {1} end %s %s\\n" $status $(date +%s.%N)\n'
+        '[ $status -eq 0 ] || exit $status\n'.format(marker, i, command)
+        for i, command in enumerate(commands))
+    start_time = time.time()
+    with settings(hide('running', 'stdout'), warn_only=True):
+        result = (sudo if use_sudo else run)(
+            'bash -c "$(echo {0} | base64 -d)"'.format(
+                base64.b64encode(script)))
+    seconds = time.time() - start_time
+
+    results = []
+    lines = None
+    for line in result.splitlines():
+        if line.startswith(marker):
+            _, i, event, value = line.split()[:4]
+            if event == 'start':
+                lines, started = [], float(value)
+                continue
+            if lines and not lines[-1]:  # printf's newline
+                lines.pop()
+            results.append((commands[int(i)], int(value),
+                            '\n'.join(lines),
+                            float(line.split()[4]) - started))
+            lines = None
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:  # cut short (e.g. killed)
+        results.append((commands[len(results)], result.return_code,
+                        '\n'.join(lines), 0.0))
+
+    for command, status, command_output, _ in results:
+        if output.running:
+            print '[{0}] {1}: {2}'.format(env.host_string,
+                                          'sudo' if use_sudo else 'run',
+                                          command)
+        if output.stdout or status:
+            for line in command_output.splitlines():
+                print '[{0}] out: {1}'.format(env.host_string, line)
+    print '[{0}] {1} commands in one round trip: {2:.1f} s ' \
+          '({3:.1f} s running them)'.format(
+              env.host_string, len(results), seconds,
+              sum(r[3] for r in results))
+    if result.failed:
+        message = 'Batched command failed with exit status {0}: {1}'.format(
+            result.return_code,
+            results[-1][0] if results else result)
+        (warn if env.warn_only else abort)(message)
+    return results
+
+
+def _write_file_cmd(path, content):
+    """ Shell command writing content to the remote path (for batches) """
+    return 'echo {0} | base64 -d > {1}'.format(base64.b64encode(content),
+                                               path)
+
+
+@task
+def benchmark_batching(commands=20):
+    """
+    Times that many no-op commands run one by one, then batched (see
+    _run_batch): the difference is what the ssh round trips cost
+    """
+    commands = int(commands)
+    with hide('running', 'stdout'):
+        start_time = time.time()
+        for i in range(commands):
+            run('true')
+        one_by_one = time.time() - start_time
+        start_time = time.time()
+        _run_batch(['true'] * commands)
+        batched = time.time() - start_time
+    print '{0} commands: {1:.2f} s one by one, {2:.2f} s batched, ' \
+          '{3:.0f} ms saved per command'.format(
+              commands, one_by_one, batched,
+              (one_by_one - batched) * 1000 / commands)
+
+
+@contextmanager
+def _timed(timings, step):
+    """ Times the step run inside of it, appending it to timings """
+    start_time = time.time()
+    yield
+    timings.append((step, time.time() - start_time))
+    print '[{0}] {1:.1f} s'.format(step, timings[-1][1])
+
+
+def _report_timings(task_name, timings, **extra):
+    """
+    Prints the timings of a task (a db task, soft_deploy or
+    rolling_deploy) and appends them, with extra (e.g. the dump size),
+    as a json line to local_env.timings_file
+
+    """
+    total = sum(seconds for _, seconds in timings)
+    print '{0} took {1:.1f} s:'.format(task_name, total)
+    for step, seconds in timings:
+        print '    {0:<40} {1:>8.1f} s'.format(step, seconds)
+
+    record = dict(extra, task=task_name, total=round(total, 1),
+                  date=datetime.utcnow().isoformat(),
+                  steps=[[step, round(seconds, 1)]
+                         for step, seconds in timings])
+    folder = os.path.dirname(local_env.timings_file)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(local_env.timings_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def _remote_cpus():
+    return int(run('nproc'))
+
+
+def _gzip_cmd(jobs):
+    """ pigz (block-parallel gzip) over jobs cpus, if installed """
+    with settings(warn_only=True):
+        if run('which pigz').succeeded:
+            return 'pigz -p {0}'.format(jobs)
+    return 'gzip'
+
+
+def _postgres(cmd):
+    """ Runs cmd as the postgres user """
+    return sudo(cmd, user='postgres')
 
 
 @task
 def db_backup():
     """
     Make a potgresql DB backup using plain pg_dumpall.
+
+    The dump is kept in the deduplicated store of backups
+    (see pg_scripts/pg_chunk_store.py), which only writes the chunks
+    of it which changed since the last backups.
     """
-    sudo('su --session-command="pg_dumpall | \
-         gzip > {0}db_$(date +\"\%b-\%d-\%Y_\%H-\%M\").gz" \
-         postgres;'.format(env.db_backup_root))
+    timings = []
+    with _timed(timings, 'pg_dumpall into the store'):
+        sudo('python {0} store {1} su --session-command=pg_dumpall '
+             'postgres'.format(env.db_backup_store_script,
+                               env.db_backup_root))
+    _report_timings('db_backup', timings)
+
+
+@task
+def list_db_backups():
+    """
+    Lists the backups of the remote catalog, oldest first, with their
+    size, compression ratio and dump duration
+    """
+    sudo('python {0} list {1}'.format(env.db_backup_catalog_script,
+                                      env.db_backup_root))
+
+
+def _local_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FETCH_CHUNK_SIZE), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _remote_files(root):
+    """
+    (name -> (size, mtime) of every file inside the remote root,
+     name -> (size, sha1) of the backup files in its catalog, see
+     pg_scripts/pg_backup_catalog.py)
+
+    The dumps of env.db_dump_root, the files being written by a store
+    (tmp*, see pg_scripts/pg_chunk_store.py) and its lock file are not
+    backup files: they are left out.
+    """
+    listing, catalog = [result[2] for result in _run_batch([
+        "find {0} -path {1} -prune -o -type f ! -name 'tmp*' ! -name {2} "
+        "-printf '%P\\t%s\\t%T@\\n'".format(
+            root, env.db_dump_root.rstrip('/'), BACKUP_STORE_LOCK_FILE),
+        'cat {0}{1} 2>/dev/null || true'.format(root, BACKUP_CATALOG_FILE)],
+        use_sudo=True)]
+    files = {}
+    for line in listing.splitlines():
+        if line.strip():
+            name, size, mtime = line.strip().split('\t')
+            files[name] = (int(size), int(float(mtime)))
+    cataloged = {}
+    for line in catalog.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        for name, (size, sha1) in record.get('files', {}).items():
+            cataloged[name] = (size, sha1)
+    return files, cataloged
+
+
+def _remote_sha1s(root, names, cataloged):
+    """
+    name -> sha1 of the given files (name -> size) inside the remote
+    root: from its catalog of backups (cataloged, see _remote_files) if
+    they are there with the same size, computed otherwise
+
+    """
+    sha1s = {}
+    to_hash = []
+    for name, size in names.items():
+        if name in cataloged and cataloged[name][0] == size:
+            sha1s[name] = cataloged[name][1]
+        else:
+            to_hash.append(name)
+    to_hash.sort()
+    results = _run_batch(['cd {0} && sha1sum -- {1}'.format(root, ' '.join(
+        pipes.quote(n) for n in to_hash[i:i + FETCH_SHA1_BATCH]))
+        for i in range(0, len(to_hash), FETCH_SHA1_BATCH)], use_sudo=True)
+    for _, _, output, _ in results:
+        for line in output.splitlines():
+            if line.strip():
+                sha1, name = line.strip().split(None, 1)
+                sha1s[name] = sha1
+    return sha1s
+
+
+def _load_fetch_catalog(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _plan_fetch(remote, cataloged, local_root, catalog):
+    """
+    Compares the remote files (name -> (size, mtime), and the cataloged
+    ones, see _remote_files) with the local copies and the catalog of
+    the last fetch (name -> size, mtime and sha1 of the remote file,
+    mtime of the local copy).
+
+    Returns (fetch, resume, changed, unchanged): names of the files
+    missing locally, of the local ones cut short by an interrupted
+    fetch, and of the ones which differ from the remote file (by size
+    or sha1), and the catalog entries of the ones which don't.
+
+    sha1s are only computed for files whose size matches but which
+    changed since the last fetch, or are not in its catalog (on the
+    remote end, only if they are not in its catalog of backups either).
+    Chunks of the store are named after their content and never change,
+    so their size is enough.
+
+    """
+    fetch, resume, changed, unchanged = [], [], [], {}
+    to_check = []
+    for name, (size, mtime) in remote.items():
+        path = os.path.join(local_root, name)
+        if not os.path.exists(path):
+            fetch.append(name)
+            continue
+        local_size = os.path.getsize(path)
+        local_mtime = int(os.path.getmtime(path))
+        entry = catalog.get(name)
+        if local_size < size:
+            resume.append(name)
+        elif local_size > size:
+            changed.append(name)
+        elif entry and (entry['size'], entry['mtime'],
+                        entry['local_mtime']) == (size, mtime, local_mtime):
+            unchanged[name] = entry
+        elif name.startswith('chunks/'):
+            unchanged[name] = {'size': size, 'mtime': mtime, 'sha1': None,
+                               'local_mtime': local_mtime}
+        else:
+            to_check.append(name)
+
+    if to_check:
+        remote_sha1s = _remote_sha1s(env.db_backup_root, dict(
+            (name, remote[name][0]) for name in to_check), cataloged)
+        for name in to_check:
+            path = os.path.join(local_root, name)
+            sha1 = _local_sha1(path)
+            if sha1 != remote_sha1s.get(name):
+                changed.append(name)
+                continue
+            size, mtime = remote[name]
+            unchanged[name] = {'size': size, 'mtime': mtime, 'sha1': sha1,
+                               'local_mtime': int(os.path.getmtime(path))}
+    return fetch, resume, changed, unchanged
+
+
+def _rsync_from_remote(names, remote_root, local_root):
+    """
+    Transfers the given files from the remote root with rsync over ssh,
+    straight from where they are (it runs under sudo on the remote end).
+
+    Files kept shorter locally (--partial) by an interrupted transfer
+    are resumed from where they were cut (--append-verify: the whole
+    file is checked once complete, and transferred again if it does
+    not match).
+
+    """
+    fd, files_from = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(sorted(names)) + '\n')
+    try:
+        local('rsync -t --partial --append-verify --files-from={0} '
+              '--rsync-path="sudo -n rsync" -e "ssh -p {1} -i {2}" '
+              '{3}@{4}:{5} {6}'.format(
+                  files_from, env.port or 22,
+                  os.path.expanduser(env.key_filename), env.user, env.host,
+                  remote_root, local_root))
+    finally:
+        os.remove(files_from)
 
 
 @task
@@ -435,26 +1138,47 @@ def fetch_backups(post_fetch_cleanup=False):
     Fetches db backup files on the remote server
     to the local db backup folder
 
+    Only the files which are missing locally or differ from the remote
+    ones (by name, size and sha1, see _plan_fetch) are transferred, with
+    rsync, which also resumes interrupted transfers. What was fetched
+    is kept in a catalog (FETCH_CATALOG_FILE in the local backup
+    folder), so files which did not change since are not read again.
+
     By default do a db backup files cleanup
     (local and remote) after fetching files.
     This behaviour can be overriden by passing
     post_fetch_cleanup as False.
 
-    TODO: Improve current fetch_backups to do not overdownload
-    already existent files. Maybe use rsync over plain get.
-
     """
-    if not os.path.exists(local_env.db_backup_root):
-        local('mkdir -p {0}'.format(local_env.db_backup_root))
-
-    #copy backups to tmp dir, set permissions, get and remove tmp dir
-    temp_db_backups_root = '/tmp/db_backups/'
-    sudo('rm -Rf {0} && cp -r {1} {0} && chmod -R a+rx {0}'.\
-         format(temp_db_backups_root,
-                env.db_backup_root.rstrip('/')))
-    get('{0}*'.format(temp_db_backups_root),
-        local_path=local_env.db_backup_root)
-    sudo('rm -Rf {0}'.format(temp_db_backups_root))
+    local_root = local_env.db_backup_root
+    if not os.path.exists(local_root):
+        local('mkdir -p {0}'.format(local_root))
+    catalog_path = os.path.join(local_root, FETCH_CATALOG_FILE)
+    timings = []
+
+    with _timed(timings, 'compare remote and local backups'):
+        remote, cataloged = _remote_files(env.db_backup_root)
+        fetch, resume, changed, catalog = _plan_fetch(
+            remote, cataloged, local_root, _load_fetch_catalog(catalog_path))
+    for name in changed:
+        os.remove(os.path.join(local_root, name))
+    names = fetch + resume + changed
+    print '{0} remote files: {1} new, {2} resumed, {3} changed, ' \
+          '{4} up to date'.format(len(remote), len(fetch), len(resume),
+                                  len(changed), len(catalog))
+    if names:
+        with _timed(timings, 'rsync {0} files'.format(len(names))):
+            _rsync_from_remote(names, env.db_backup_root, local_root)
+    for name in names:
+        path = os.path.join(local_root, name)
+        size, mtime = remote[name]
+        catalog[name] = {'size': size, 'mtime': mtime,
+                         'sha1': _local_sha1(path),
+                         'local_mtime': int(os.path.getmtime(path))}
+    with open(catalog_path, 'w') as f:
+        json.dump(catalog, f)
+    _report_timings('fetch_backups', timings, files=len(names),
+                    size=sum(remote[name][0] for name in names))
 
     if post_fetch_cleanup:
         cleanup_old_backups()
@@ -482,24 +1206,132 @@ def cleanup_old_backups(max_backups=5, clean_local=False):
 
 
 @task
-def restore_db(db_backup_file):
-    if not os.path.exists(db_backup_file):
-        print '%s file does not exist' % db_backup_file
-        return
+def restore_db(db_backup='latest'):
+    """
+    Recreates the db from db_backup: the name of a backup in the remote
+    store (see list_db_backups), 'latest' for the latest one, or a local
+    plain db_<date>.gz dump file.
 
-    remote_tmp = '/tmp/_db_backup_file'
+    Backups of the store are streamed from it straight into psql.
+    """
+    store_cmd = 'python {0} {{0}} {1}'.format(env.db_backup_store_script,
+                                              env.db_backup_root)
+    if os.path.exists(db_backup):
+        remote_tmp = '/tmp/_db_backup_file'
+        put(db_backup, remote_tmp)
+    else:
+        backups = sudo(store_cmd.format('list')).split()
+        if not backups or (db_backup != 'latest' and
+                           db_backup not in backups):
+            print '%s is neither a local file nor a stored backup' % \
+                    db_backup
+            return
 
-    put(db_backup_file, remote_tmp)
     dropdb_cmd = "dropdb {1}".format("db-user", "db")
     createdb_cmd = "createdb -O {0} -w {1}".format("db-user", "db")
 
     def _sudo_su_session_cmd(cmd, user='postgres'):
         run('sudo su --session-command="{0}" {1};'.format(cmd, user))
 
+    timings = []
     # recreate (drop+create) db
-    _sudo_su_session_cmd("{0}; {1};".format(dropdb_cmd, createdb_cmd))
-    # applies db_backup_file
-    _sudo_su_session_cmd("gunzip -c {0} | psql db;".format(remote_tmp))
+    with _timed(timings, 'recreate db'):
+        _sudo_su_session_cmd("{0}; {1};".format(dropdb_cmd, createdb_cmd))
+    # applies db_backup
+    with _timed(timings, 'replay {0}'.format(db_backup)):
+        if os.path.exists(db_backup):
+            _sudo_su_session_cmd("{0} -dc {1} | psql db;".format(
+                _gzip_cmd(_remote_cpus()), remote_tmp))
+        else:
+            name = '' if db_backup == 'latest' else db_backup
+            run('set -o pipefail; sudo {0} {1} | '
+                'sudo su --session-command="psql db" postgres'.format(
+                    store_cmd.format('restore'), name))
+    _report_timings('restore_db', timings)
+
+    print 'Restore complete. You may also need to rebuild search indexes.'
+
+
+@task
+def db_dump(jobs=None, keep=2):
+    """
+    Dumps every database in directory format (pg_dump -Fd), with jobs
+    parallel workers (one per remote cpu by default), into
+    env.db_dump_root/dump_<date>/<database>/, plus the roles and
+    tablespaces (pg_dumpall --globals-only) into globals.sql.gz.
+
+    pg_dump writes the table data files uncompressed, and pigz then
+    compresses them block-parallel (so big tables use every cpu too)
+    into the .dat.gz files pg_restore reads. Only the keep latest dumps
+    are kept. Every step is timed (see local_env.timings_file).
+
+    Dumps are much bigger than db_backup ones (nothing is deduplicated),
+    but much faster to take and to restore (see restore_db_dump).
+    """
+    jobs = int(jobs or _remote_cpus())
+    gzip_cmd = _gzip_cmd(jobs)
+    dump_root = '{0}dump_{1:%Y-%m-%d_%H-%M}/'.format(env.db_dump_root,
+                                                     datetime.now())
+    timings = []
+
+    sudo('mkdir -p {0} && chown postgres {0}'.format(dump_root))
+    databases = _postgres('psql -Atc "SELECT datname FROM pg_database '
+                          'WHERE datallowconn AND NOT datistemplate '
+                          'AND datname <> \'postgres\'"').split()
+    with _timed(timings, 'globals'):
+        _postgres('set -o pipefail; pg_dumpall --globals-only | '
+                  '{0} > {1}globals.sql.gz'.format(gzip_cmd, dump_root))
+    for database in databases:
+        with _timed(timings, 'pg_dump -j {0} {1}'.format(jobs, database)):
+            _postgres('pg_dump -Fd -j {0} -Z 0 -f {1}{2} {2}'.format(
+                jobs, dump_root, database))
+        with _timed(timings, 'compress {0}'.format(database)):
+            _postgres('find {0}{1} -name "*.dat" | '
+                      'xargs -r -n 1 {2}'.format(dump_root, database,
+                                                 gzip_cmd))
+    size = int(sudo('du -sb {0} | cut -f1'.format(dump_root)))
+
+    # a dump only counts once complete: older ones may go now
+    sudo('ls -1d {0}dump_* | sort | head -n -{1} | xargs -r rm -rf'.format(
+        env.db_dump_root, int(keep)))
+    _report_timings('db_dump', timings, jobs=jobs, size=size,
+                    databases=len(databases))
+
+
+@task
+def restore_db_dump(dump='latest', jobs=None):
+    """
+    Recreates every database of a db_dump (the name of its folder
+    in env.db_dump_root, or 'latest') with pg_restore -j, jobs parallel
+    workers (one per remote cpu by default). Roles are created first,
+    from its globals.sql.gz (the ones which exist already just fail).
+    Every step is timed (see local_env.timings_file).
+    """
+    jobs = int(jobs or _remote_cpus())
+    dumps = sudo('ls -1 {0}'.format(env.db_dump_root)).split()
+    dumps = sorted(d for d in dumps if d.startswith('dump_'))
+    if dump == 'latest' and dumps:
+        dump = dumps[-1]
+    if dump not in dumps:
+        print 'No dump named {0} in {1}'.format(dump, env.db_dump_root)
+        return
+    dump_root = '{0}{1}/'.format(env.db_dump_root, dump)
+    databases = [d for d in sudo('ls -1 {0}'.format(dump_root)).split()
+                 if d != 'globals.sql.gz']
+    timings = []
+
+    with _timed(timings, 'globals'):
+        _postgres('gzip -dc {0}globals.sql.gz | psql -q postgres'.format(
+            dump_root))
+    for database in databases:
+        with _timed(timings, 'recreate {0}'.format(database)):
+            _postgres('dropdb --if-exists {0} && '
+                      'createdb -T template0 {0}'.format(database))
+        with _timed(timings, 'pg_restore -j {0} {1}'.format(jobs, database)):
+            _postgres('pg_restore -j {0} -d {1} {2}{1}'.format(
+                jobs, database, dump_root))
+    _report_timings('restore_db_dump', timings, jobs=jobs, dump=dump,
+                    databases=len(databases))
 
     print 'Restore complete. You may also need to rebuild search indexes.'
 
@@ -541,9 +1373,16 @@ def service(action, program):
 
 @task
 def deploy_static_assets():
+    _collect_static_assets()
+    _upload_static_assets()
+
+
+def _collect_static_assets():
     manage('collectstatic --noinput')
     manage('compress')
 
+
+def _upload_static_assets():
     upload_script = '/'.join([t.rstrip('/') for t in (env.deploy_root,
                                                       'aws',
                                                       'upload_static_s3.py')])
@@ -575,21 +1414,19 @@ def update_supervisor():
     file_name = 'supervisord.conf'
     with open(os.path.join(local_env.etc_root, file_name)) as fd:
         config = fd.read().format(**context)
-    run('mkdir -p {0} && rm -f {1}'.format(env.etc_root,
-                                           env.supervisord_file))
-    append(env.supervisord_file, config)
+    _run_batch(['mkdir -p {0}'.format(env.etc_root),
+                _write_file_cmd(env.supervisord_file, config)])
 
     #supervisor is gonna be managed by upstart (/etc/init/)
     file_name = 'supervisor_upstart.conf'
     with open(os.path.join(local_env.etc_root, file_name)) as f:
         config = f.read().format(**context)
-        append('/tmp/{0}'.format(file_name), config)
-    sudo('mv /tmp/{0} /etc/init/supervisor.conf'.format(file_name))
 
     #supervisor restart
-    if 'run' in sudo('status supervisor'):
-        sudo('stop supervisor')
-    sudo('start supervisor')
+    _run_batch([_write_file_cmd('/etc/init/supervisor.conf', config),
+                'if status supervisor | grep -q run; then '
+                'stop supervisor; fi',
+                'start supervisor'], use_sudo=True)
 
 
 @task
@@ -740,20 +1577,19 @@ def swapon():
 
     """
     swapfile = '/var/swapfile'
-    sudo('dd if=/dev/zero of={0} bs=1M count=1024'.format(swapfile))
-    sudo('chmod 600 {0}'.format(swapfile))
-    sudo('mkswap {0}'.format(swapfile))
-    sudo('echo {0} none swap defaults 0 0 '.format(swapfile) + \
-         ' | tee -a /etc/fstab')
-    sudo('swapon -a')
-    # print report
-    run('cat /etc/fstab')
-    run('df -h')
+    _run_batch(['dd if=/dev/zero of={0} bs=1M count=1024'.format(swapfile),
+                'chmod 600 {0}'.format(swapfile),
+                'mkswap {0}'.format(swapfile),
+                'echo {0} none swap defaults 0 0 '.format(swapfile) + \
+                ' | tee -a /etc/fstab',
+                'swapon -a',
+                # print report
+                'cat /etc/fstab',
+                'df -h'], use_sudo=True)
 
 
 @task
 def swapoff():
     """ Reverses back the above function (disables swapping) """
     swapfile = '/var/swapfile'
-    sudo('swapoff -a')
-    sudo('rm -f {0}'.format(swapfile))
+    _run_batch(['swapoff -a', 'rm -f {0}'.format(swapfile)], use_sudo=True)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+"""
+Catalog of the db backups inside of backup_root (backup_root/catalog.jsonl)
+
+One JSON line per backup, appended by the job which takes it:
+    name      db_<date>
+    kind      'store' (a backup of pg_chunk_store.py) or 'gz' (a plain
+              gzipped pg_dumpall)
+    created   ISO date of the backup
+    size      bytes of the dump (None if unknown)
+    stored    bytes it added on disk (for the store: its new chunks)
+    ratio     size / stored (None if unknown)
+    sha1      of the dump (None if unknown)
+    seconds   the dump took (None if unknown)
+    files     relative path -> [size, sha1] of the files of the backup
+              (not the chunks of the store, named after their content)
+
+Deleted backups are recorded as {"name": ..., "deleted": <date>} lines,
+and the catalog is rewritten without them once they are half of it.
+Lines which cannot be read are skipped (and reported), so that a bad
+line never stops a cleanup.
+
+    list BACKUP_ROOT
+
+"""
+import sys
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+
+CATALOG_FILE = 'catalog.jsonl'
+CHUNK_SIZE = 64 * 1024
+
+
+def catalog_path(backup_root):
+    return os.path.join(backup_root, CATALOG_FILE)
+
+
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextmanager
+def _locked(backup_root):
+    """ The catalog file, opened for appending, locked for the block """
+    if not os.path.isdir(backup_root):
+        os.makedirs(backup_root)
+    with open(catalog_path(backup_root), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(f):
+    """ (backups, deleted lines) of an open catalog, oldest first """
+    f.seek(0)
+    backups = {}
+    deleted = 0
+    for number, line in enumerate(f, 1):
+        try:
+            record = json.loads(line)
+            name = record['name']
+        except (ValueError, TypeError, KeyError):
+            sys.stderr.write('Skipping line %s of the catalog: %r\n' % (
+                number, line[:80]))
+            continue
+        if 'deleted' in record:
+            backups.pop(name, None)
+            deleted += 1
+        else:
+            backups[name] = record
+    return sorted(backups.values(), key=lambda r: r['created']), deleted
+
+
+def load(backup_root):
+    """ Records of the backups in the catalog, oldest first """
+    if not os.path.exists(catalog_path(backup_root)):
+        return []
+    with _locked(backup_root) as f:
+        return _read(f)[0]
+
+
+def add(backup_root, record):
+    """ Appends the record of a new backup to the catalog """
+    with _locked(backup_root) as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def remove(backup_root, names):
+    """
+    Records that the backups names are deleted, and rewrites the catalog
+    without the deleted ones once they are half of it.
+
+    """
+    with _locked(backup_root) as f:
+        now = datetime.now().isoformat()
+        for name in names:
+            f.write(json.dumps({'name': name, 'deleted': now}) + '\n')
+        f.flush()
+        backups, deleted = _read(f)
+        if deleted >= len(backups):
+            # same inode, still locked: no append can get lost
+            f.truncate(0)
+            f.write(''.join(json.dumps(r) + '\n' for r in backups))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+if __name__ == '__main__':
+    action, backup_root = sys.argv[1:3]
+    if action == 'list':
+        for r in load(backup_root):
+            print '%-24s %-5s %10s %10s %7s %8s' % (
+                r['name'], r['kind'],
+                '-' if r['size'] is None else
+                '%.1f MB' % (r['size'] / 1048576.0),
+                '%.1f MB' % (r['stored'] / 1048576.0),
+                '-' if r['ratio'] is None else '%.1fx' % r['ratio'],
+                '-' if r['seconds'] is None else '%.1f s' % r['seconds'])
+    else:
+        print 'Unknown action %s' % action
+        sys.exit(2)
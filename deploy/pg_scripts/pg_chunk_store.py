@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+"""
+Deduplicated store of db backups (pg_dumpall output) inside of backup_root
+
+Every dump is split into content-defined chunks, and each unique chunk
+is stored once, compressed (backup_root/chunks/). A backup is just the
+manifest of its chunks (backup_root/manifests/db_<date>.manifest), so
+the store grows with the daily changes, not with the size of the db.
+Every backup stored is also added to the catalog of backups (see
+pg_backup_catalog.py).
+
+Stores and gcs of the same backup_root take turns, on the lock of
+backup_root/LOCK_FILE: a gc never sees the chunks of a backup whose
+manifest is not saved yet.
+
+Chunk boundaries are picked at line ends, by a hash of the line alone,
+so an insert or a change in a dump only affects the chunks around it:
+the boundaries before and after it are found again, and the chunks
+there are the same as in the dump before.
+
+    store BACKUP_ROOT [COMMAND ...]
+        stores the output of COMMAND (or stdin) as a new backup.
+        With a COMMAND, the backup is only kept if it exits with 0.
+    restore BACKUP_ROOT [NAME]
+        writes a backup (the latest one by default) to stdout
+    list BACKUP_ROOT
+    gc BACKUP_ROOT
+        deletes the chunks no backup refers to anymore
+
+    E.g.: python pg_chunk_store.py store /var/backups/db/ pg_dumpall
+          python pg_chunk_store.py restore /var/backups/db/ | psql db
+
+"""
+import sys
+import os
+import json
+import zlib
+import fcntl
+import time
+import hashlib
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+
+import pg_backup_catalog
+
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
+GC_GRACE_SECONDS = 24 * 3600  # chunks this recent may be in use by a store
+NAME_FORMAT = 'db_%b-%d-%Y_%H-%M'  # same as the plain .gz backups
+MANIFEST_EXTENSION = '.manifest'
+LOCK_FILE = 'store.lock'
+
+
+class StoreError(Exception):
+    pass
+
+
+def _chunks_root(backup_root):
+    return os.path.join(backup_root, 'chunks')
+
+
+def _manifests_root(backup_root):
+    return os.path.join(backup_root, 'manifests')
+
+
+def manifest_path(backup_root, name):
+    return os.path.join(_manifests_root(backup_root),
+                        name + MANIFEST_EXTENSION)
+
+
+def _chunk_path(backup_root, sha):
+    return os.path.join(_chunks_root(backup_root), sha[:2], sha)
+
+
+@contextmanager
+def _locked(backup_root):
+    """ Holds the exclusive lock of the store for the block """
+    if not os.path.isdir(backup_root):
+        os.makedirs(backup_root)
+    with open(os.path.join(backup_root, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_atomically(path, data):
+    """ Writes data to path, which only shows up once complete """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # made by someone else in the meantime
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def split_chunks(stream):
+    """
+    Yields the content-defined chunks of a stream.
+
+    A chunk ends after a line whose crc32 falls under a threshold
+    proportional to the line length, so boundaries show up every
+    AVG_CHUNK_SIZE bytes on average, whatever the lines are like.
+    Chunks are at least MIN_CHUNK_SIZE (unless last) and at most
+    MAX_CHUNK_SIZE bytes (a longer line is cut there).
+
+    """
+    chunk = []
+    size = 0
+    for line in stream:
+        chunk.append(line)
+        size += len(line)
+        if size >= MAX_CHUNK_SIZE:
+            data = ''.join(chunk)
+            while len(data) >= MAX_CHUNK_SIZE:
+                yield data[:MAX_CHUNK_SIZE]
+                data = data[MAX_CHUNK_SIZE:]
+            chunk = [data] if data else []
+            size = len(data)
+        elif size >= MIN_CHUNK_SIZE and zlib.crc32(line) & 0xffffffff < \
+                (len(line) << 32) // AVG_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def store(backup_root, stream, name=None):
+    """
+    Stores stream as the backup name (db_<now> by default) and
+    returns its manifest, with the stats of the chunks written.
+
+    Chunks already stored are not written again, just touched (see
+    GC_GRACE_SECONDS). The caller holds _locked(backup_root) until the
+    manifest is saved, so that no gc deletes them in the meantime.
+
+    """
+    name = name or datetime.now().strftime(NAME_FORMAT)
+    start_time = time.time()
+    sha = hashlib.sha1()
+    chunks = []
+    new_chunks = new_bytes = stored_bytes = 0
+    for chunk in split_chunks(stream):
+        sha.update(chunk)
+        chunk_sha = hashlib.sha1(chunk).hexdigest()
+        chunks.append([chunk_sha, len(chunk)])
+        path = _chunk_path(backup_root, chunk_sha)
+        if os.path.exists(path):
+            os.utime(path, None)
+            continue
+        data = zlib.compress(chunk, COMPRESS_LEVEL)
+        _write_atomically(path, data)
+        new_chunks += 1
+        new_bytes += len(chunk)
+        stored_bytes += len(data)
+
+    manifest = {'name': name, 'created': datetime.now().isoformat(),
+                'size': sum(size for _, size in chunks),
+                'sha1': sha.hexdigest(), 'chunks': chunks}
+    return manifest, {'new_chunks': new_chunks, 'new_bytes': new_bytes,
+                      'stored_bytes': stored_bytes,
+                      'seconds': time.time() - start_time}
+
+
+def save_manifest(backup_root, manifest):
+    _write_atomically(manifest_path(backup_root, manifest['name']),
+                      json.dumps(manifest))
+
+
+def catalog_record(backup_root, manifest, stats=None):
+    """
+    Record of a saved backup for the catalog (see pg_backup_catalog.py),
+    with the stats of its store, if known.
+
+    """
+    path = manifest_path(backup_root, manifest['name'])
+    stored = os.path.getsize(path)
+    if stats:
+        stored += stats['stored_bytes']
+    return {'name': manifest['name'], 'kind': 'store',
+            'created': manifest['created'], 'size': manifest['size'],
+            'stored': stored,
+            'ratio': round(float(manifest['size']) / stored, 1)
+            if stats else None,
+            'sha1': manifest['sha1'],
+            'seconds': round(stats['seconds'], 1) if stats else None,
+            'files': {os.path.relpath(path, backup_root):
+                      [os.path.getsize(path),
+                       pg_backup_catalog.file_sha1(path)]}}
+
+
+def load_manifest(backup_root, name):
+    path = manifest_path(backup_root, name)
+    if not os.path.exists(path):
+        raise StoreError('No backup named %s in %s' % (name, backup_root))
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_backups(backup_root):
+    """ Names of the backups in the store, oldest first """
+    folder = _manifests_root(backup_root)
+    if not os.path.isdir(folder):
+        return []
+    names = [f[:-len(MANIFEST_EXTENSION)] for f in os.listdir(folder)
+             if f.endswith(MANIFEST_EXTENSION)]
+    return sorted(names, key=lambda n: datetime.strptime(n, NAME_FORMAT))
+
+
+def restore(backup_root, name, out):
+    """
+    Writes the backup name (the latest one if None) to out, chunk by
+    chunk. Raises StoreError if a chunk is missing or corrupt.
+
+    """
+    if name is None:
+        names = list_backups(backup_root)
+        if not names:
+            raise StoreError('No backups in %s' % backup_root)
+        name = names[-1]
+    manifest = load_manifest(backup_root, name)
+    sha = hashlib.sha1()
+    for chunk_sha, size in manifest['chunks']:
+        try:
+            with open(_chunk_path(backup_root, chunk_sha), 'rb') as f:
+                chunk = zlib.decompress(f.read())
+        except (IOError, zlib.error) as e:
+            raise StoreError('Chunk %s of %s is unreadable: %s' % (
+                chunk_sha, name, e))
+        if hashlib.sha1(chunk).hexdigest() != chunk_sha:
+            raise StoreError('Chunk %s of %s is corrupt' % (chunk_sha, name))
+        sha.update(chunk)
+        out.write(chunk)
+    if sha.hexdigest() != manifest['sha1']:
+        raise StoreError('Backup %s does not match its checksum' % name)
+
+
+def gc(backup_root):
+    """
+    Deletes the chunks which no backup refers to, unless written (or
+    reused) in the last GC_GRACE_SECONDS. Returns (chunks, bytes) freed.
+    Waits for the store running, if any (see _locked).
+
+    """
+    with _locked(backup_root):
+        return _gc(backup_root)
+
+
+def _gc(backup_root):
+    """ gc, once the lock is held """
+    used = set()
+    for name in list_backups(backup_root):
+        used.update(sha for sha, _ in load_manifest(backup_root,
+                                                    name)['chunks'])
+    chunks_root = _chunks_root(backup_root)
+    if not os.path.isdir(chunks_root):
+        return 0, 0
+    keep_after = time.time() - GC_GRACE_SECONDS
+    freed = freed_bytes = 0
+    for folder in os.listdir(chunks_root):
+        for sha in os.listdir(os.path.join(chunks_root, folder)):
+            path = os.path.join(chunks_root, folder, sha)
+            if sha in used:
+                continue
+            stat = os.stat(path)
+            if stat.st_mtime > keep_after:
+                continue
+            os.remove(path)
+            freed += 1
+            freed_bytes += stat.st_size
+    return freed, freed_bytes
+
+
+def _store_command(backup_root, command):
+    """ Stores the output of command (stdin if empty) as a new backup """
+    process = None
+    stream = sys.stdin
+    if command:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        stream = process.stdout
+    with _locked(backup_root):
+        manifest, stats = store(backup_root, stream)
+        if process and process.wait() != 0:
+            # the chunks are left to gc: a dump cut short is no backup
+            raise StoreError(
+                '%s failed with exit status %s: backup not saved' % (
+                    ' '.join(command), process.returncode))
+        save_manifest(backup_root, manifest)
+        pg_backup_catalog.add(backup_root,
+                              catalog_record(backup_root, manifest, stats))
+    print 'Stored %s: %.1f MB in %s chunks, %s new (%.1f MB, %.1f MB ' \
+          'compressed) in %.1f s' % (
+              manifest['name'], manifest['size'] / 1048576.0,
+              len(manifest['chunks']), stats['new_chunks'],
+              stats['new_bytes'] / 1048576.0,
+              stats['stored_bytes'] / 1048576.0, stats['seconds'])
+
+
+if __name__ == '__main__':
+    action, backup_root = sys.argv[1:3]
+    try:
+        if action == 'store':
+            _store_command(backup_root, sys.argv[3:])
+        elif action == 'restore':
+            restore(backup_root, (sys.argv[3:] or [None])[0], sys.stdout)
+        elif action == 'list':
+            for name in list_backups(backup_root):
+                print name
+        elif action == 'gc':
+            freed, freed_bytes = gc(backup_root)
+            print 'Deleted %s chunks (%.1f MB)' % (freed,
+                                                   freed_bytes / 1048576.0)
+        else:
+            print 'Unknown action %s' % action
+            sys.exit(2)
+    except StoreError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
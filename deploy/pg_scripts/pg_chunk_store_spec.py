@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Specs of pg_chunk_store.py, over a store in a temporary backup_root.
+
+    E.g.: python -m unittest pg_chunk_store_spec
+
+"""
+import os
+import time
+import fcntl
+import random
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import pg_chunk_store
+
+
+def _dump(rows, seed=0):
+    """ Lines looking like the COPY data of a pg_dumpall """
+    rng = random.Random(seed)
+    return ''.join('%s\t%s\t%s\n' % (i, rng.getrandbits(64),
+                                     'x' * rng.randint(10, 200))
+                   for i in range(rows))
+
+
+class ChunkStoreSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_root)
+
+    def _store(self, data, name):
+        with pg_chunk_store._locked(self.backup_root):
+            manifest, stats = pg_chunk_store.store(self.backup_root,
+                                                   StringIO(data), name)
+            pg_chunk_store.save_manifest(self.backup_root, manifest)
+        return manifest, stats
+
+    def _restore(self, name):
+        out = StringIO()
+        pg_chunk_store.restore(self.backup_root, name, out)
+        return out.getvalue()
+
+    def _chunk_paths(self):
+        root = pg_chunk_store._chunks_root(self.backup_root)
+        return set(os.path.join(folder, f)
+                   for folder, _, files in os.walk(root) for f in files)
+
+
+class SplitChunksSpec(ChunkStoreSpec):
+
+    def test_splits_a_stream_into_chunks_of_the_whole_of_it(self):
+        data = _dump(20000)
+
+        chunks = list(pg_chunk_store.split_chunks(StringIO(data)))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(pg_chunk_store.MIN_CHUNK_SIZE <= len(chunk) <=
+                            pg_chunk_store.MAX_CHUNK_SIZE)
+
+    def test_finds_the_same_boundaries_around_an_insert(self):
+        lines = StringIO(_dump(20000)).readlines()
+        changed = lines[:10000] + ['inserted\trow\n'] + lines[10000:]
+
+        before = list(pg_chunk_store.split_chunks(iter(lines)))
+        after = list(pg_chunk_store.split_chunks(iter(changed)))
+
+        self.assertEqual(len(set(after) - set(before)), 1)
+
+
+class StoreSpec(ChunkStoreSpec):
+
+    def test_restores_what_was_stored(self):
+        data = _dump(20000)
+
+        self._store(data, 'db_Jan-01-2014_00-00')
+
+        self.assertEqual(self._restore('db_Jan-01-2014_00-00'), data)
+
+    def test_writes_only_the_new_chunks_of_a_similar_dump(self):
+        lines = StringIO(_dump(20000)).readlines()
+        self._store(''.join(lines), 'db_Jan-01-2014_00-00')
+        lines[10000] = 'changed\trow\n'
+
+        stats = self._store(''.join(lines), 'db_Jan-02-2014_00-00')[1]
+
+        self.assertEqual(stats['new_chunks'], 1)
+        self.assertEqual(self._restore(None), ''.join(lines))
+
+    def test_refuses_to_restore_a_corrupt_chunk(self):
+        manifest = self._store(_dump(100), 'db_Jan-01-2014_00-00')[0]
+        path = pg_chunk_store._chunk_path(self.backup_root,
+                                          manifest['chunks'][0][0])
+        with open(path, 'wb') as f:
+            f.write('corrupt')
+
+        self.assertRaises(pg_chunk_store.StoreError, self._restore, None)
+
+
+class GcSpec(ChunkStoreSpec):
+
+    def setUp(self):
+        super(GcSpec, self).setUp()
+        self.grace = pg_chunk_store.GC_GRACE_SECONDS
+        pg_chunk_store.GC_GRACE_SECONDS = 0
+
+    def tearDown(self):
+        pg_chunk_store.GC_GRACE_SECONDS = self.grace
+        super(GcSpec, self).tearDown()
+
+    def test_deletes_only_the_chunks_no_backup_refers_to(self):
+        kept = _dump(20000, seed=1)
+        self._store(kept, 'db_Jan-01-2014_00-00')
+        self._store(_dump(20000, seed=2), 'db_Jan-02-2014_00-00')
+        used = self._chunk_paths()
+        os.remove(pg_chunk_store.manifest_path(self.backup_root,
+                                               'db_Jan-02-2014_00-00'))
+        time.sleep(0.01)
+
+        freed = pg_chunk_store.gc(self.backup_root)[0]
+
+        self.assertTrue(freed > 0)
+        self.assertEqual(len(self._chunk_paths()), len(used) - freed)
+        self.assertEqual(self._restore('db_Jan-01-2014_00-00'), kept)
+
+    def test_leaves_the_recent_chunks_alone(self):
+        pg_chunk_store.GC_GRACE_SECONDS = 3600
+        self._store(_dump(100), 'db_Jan-01-2014_00-00')
+        os.remove(pg_chunk_store.manifest_path(self.backup_root,
+                                               'db_Jan-01-2014_00-00'))
+
+        self.assertEqual(pg_chunk_store.gc(self.backup_root), (0, 0))
+
+    def test_waits_for_the_store_running(self):
+        with pg_chunk_store._locked(self.backup_root):
+            with open(os.path.join(self.backup_root,
+                                   pg_chunk_store.LOCK_FILE)) as f:
+                self.assertRaises(IOError, fcntl.flock, f,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+if __name__ == '__main__':
+    unittest.main()
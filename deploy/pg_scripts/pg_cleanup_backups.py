@@ -5,43 +5,100 @@ Clean up old backup files
 inside of backup_root
 to retain a max of max_backup_files
 
+Both plain db_<date>.gz dumps and the backups of the deduplicated
+store (see pg_chunk_store.py) count, and the chunks of the store no
+backup left refers to are deleted.
+
+Backups are picked from the catalog of backups (see
+pg_backup_catalog.py), oldest first. Backups missing from it (e.g.
+taken before it) are added first, dated by their name, or by their
+file if the name has no date.
+
 """
 import sys
 import os
 from datetime import datetime
 
+import pg_chunk_store
+import pg_backup_catalog
+
 
 def extract_creation_date(filename):
+    """ Date in a db_<date>.gz file name, or None """
+    date_string = os.path.basename(filename).split('.')[0][len('db_'):]
     try:
-        date_string = filename.split('db_')[1].split('.gz')[0]
-    except:
-        print 'Failed to match filename with "db_<datetime_string>.gz"'
-        sys.exit(1)
+        return datetime.strptime(date_string, '%b-%d-%Y_%H-%M')
+    except ValueError:
+        return None
 
-    return datetime.strptime(date_string, '%b-%d-%Y_%H-%M')
 
+def _gz_record(backup_root, filename):
+    """ Catalog record of a plain db_<date>.gz backup """
+    path = os.path.join(backup_root, filename)
+    created = extract_creation_date(filename) or \
+        datetime.fromtimestamp(os.path.getmtime(path))
+    size = os.path.getsize(path)
+    return {'name': filename.split('.')[0], 'kind': 'gz',
+            'created': created.isoformat(), 'size': None, 'stored': size,
+            'ratio': None, 'sha1': None, 'seconds': None,
+            'files': {filename: [size, pg_backup_catalog.file_sha1(path)]}}
 
-def cleanup(backup_root, max_backup_files):
-    files = [os.path.join(backup_root, f) for f in os.listdir(backup_root)]
 
-    #Just have at most max_backup_files files on this folder -> nothing to do
-    if len(files) <= max_backup_files:
-        print 'There are %s files on %s. Nothing to do.' % (len(files),
-                                                            backup_root)
-        return
+def update_catalog(backup_root):
+    """
+    Adds the backups missing from the catalog, and removes the ones
+    whose files are gone. Returns the backups, oldest first.
+
+    """
+    backups = pg_backup_catalog.load(backup_root)
+    cataloged = set()
+    gone = []
+    for record in backups:
+        cataloged.update(record['files'])
+        if not all(os.path.exists(os.path.join(backup_root, path))
+                   for path in record['files']):
+            gone.append(record['name'])
 
-    creation_dates = [extract_creation_date(f) for f in files]
+    missing = [_gz_record(backup_root, f) for f in os.listdir(backup_root)
+               if f.startswith('db_') and f.endswith('.gz') and
+               f not in cataloged]
+    for name in pg_chunk_store.list_backups(backup_root):
+        path = pg_chunk_store.manifest_path(backup_root, name)
+        if os.path.relpath(path, backup_root) not in cataloged:
+            missing.append(pg_chunk_store.catalog_record(
+                backup_root, pg_chunk_store.load_manifest(backup_root, name)))
+    for record in missing:
+        print 'Adding %s to the catalog' % record['name']
+        pg_backup_catalog.add(backup_root, record)
+    if gone:
+        print 'Removing %s from the catalog: files gone' % ', '.join(gone)
+        pg_backup_catalog.remove(backup_root, gone)
+    return pg_backup_catalog.load(backup_root) if missing or gone \
+        else backups
 
-    #sort
-    files_creation_dates = zip(files, creation_dates)
-    files_creation_dates = sorted(files_creation_dates,
-                                  key=lambda e: e[1], reverse=True)
+
+def cleanup(backup_root, max_backup_files):
+    backups = update_catalog(backup_root)
+
+    #Just have at most max_backup_files backups on this folder -> nothing to do
+    if len(backups) <= max_backup_files:
+        print 'There are %s backups on %s. Nothing to do.' % (len(backups),
+                                                              backup_root)
+        return
 
     #delete
-    files_to_delete = [f[0] for f in files_creation_dates[max_backup_files:]]
-    for f in files_to_delete:
-        print 'Deleting %s' % f
-        os.remove(f)
+    backups_to_delete = backups[:len(backups) - max_backup_files]
+    for record in backups_to_delete:
+        for path in record['files']:
+            print 'Deleting %s' % path
+            os.remove(os.path.join(backup_root, path))
+    pg_backup_catalog.remove(backup_root,
+                             [r['name'] for r in backups_to_delete])
+
+    freed, freed_bytes = pg_chunk_store.gc(backup_root)
+    if freed:
+        print 'Deleted %s unused chunks (%.1f MB)' % (freed,
+                                                      freed_bytes / 1048576.0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.utils.cache import patch_vary_headers
+
+
+class StaticGzipVaryMiddleware(object):
+    """
+    Adds Vary: Accept-Encoding to the responses whose static urls depend
+    on the browser gzip support (see contrib.templatetags.static_assets),
+    so that caches (ours included) keep one version per encoding.
+
+    Must come after UpdateCacheMiddleware in settings.MIDDLEWARE_CLASSES.
+
+    """
+    def process_response(self, request, response):
+        if getattr(request, 'static_gzip_varied', False):
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
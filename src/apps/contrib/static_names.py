@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Names the static assets are published under, by
+deploy/aws/upload_static_s3.py (which loads this very file) and
+resolved by contrib.storage: keep it free of django imports.
+
+"""
+import os
+
+HASH_LENGTH = 12  # sha digits in a hashed name
+
+
+def get_gzip_name(name):
+    """ style.css --> style.gz.css """
+    root, extension = os.path.splitext(name)
+    return root + '.gz' + extension
+
+
+def get_hashed_name(name, sha):
+    """ style.css --> style.3fa2c1d4e5f6.css, for content with sha """
+    root, extension = os.path.splitext(name)
+    return '%s.%s%s' % (root, sha[:HASH_LENGTH], extension)
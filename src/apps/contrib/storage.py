@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Static files storages aware of the content-hashed names published
+by deploy/aws/upload_static_s3.py
+
+"""
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from compressor.storage import CompressorFileStorage
+from contrib.static_names import get_gzip_name, get_hashed_name
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ManifestStaticFilesStorage(StaticFilesStorage):
+    """
+    Resolves static paths to their content-hashed names
+    (css/style.css --> css/style.3fa2c1d4e5f6.css),
+    which can be cached forever by browsers.
+
+    The plain -> hashed names map is the json manifest written by the
+    uploader, at settings.STATIC_MANIFEST_FILE. It is read again whenever
+    the file changes, so a static deploy needs no server restart.
+    Paths missing from the manifest (or no manifest at all, as in
+    development) keep their plain names.
+    The manifest also lists the gzipped versions uploaded
+    (css/style.gz.css --> css/style.3fa2c1d4e5f6.gz.css), see has_gzip.
+
+    Used by the {% static %} template tag, once set as
+    settings.STATICFILES_STORAGE.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(ManifestStaticFilesStorage, self).__init__(*args, **kwargs)
+        self.manifest_file = getattr(settings, 'STATIC_MANIFEST_FILE', None)
+        self._manifest = {}
+        self._manifest_mtime = None
+        self._gzip_names = set()
+
+    def get_manifest(self):
+        if not self.manifest_file:
+            return {}
+        try:
+            mtime = os.stat(self.manifest_file).st_mtime
+        except OSError:
+            return {}
+        if mtime != self._manifest_mtime:
+            try:
+                with open(self.manifest_file) as f:
+                    self._manifest = json.load(f)
+            except ValueError:  # caught while being written
+                return self._manifest
+            self._manifest_mtime = mtime
+            self._gzip_names = set()
+            for name, hashed in self._manifest.items():
+                if get_gzip_name(name) in self._manifest:
+                    self._gzip_names.update([name, hashed])
+        return self._manifest
+
+    def has_gzip(self, name):
+        """ Was a gzipped version of name (plain or hashed) uploaded """
+        self.get_manifest()
+        return name.replace('\\', '/') in self._gzip_names
+
+    def hashed_name(self, name):
+        """ Content-hashed name of name, or name itself if unknown """
+        return self.get_manifest().get(name.replace('\\', '/'), name)
+
+    def url(self, name):
+        return super(ManifestStaticFilesStorage, self).url(
+            self.hashed_name(name))
+
+
+class HashedCompressorFileStorage(CompressorFileStorage):
+    """
+    Storage of the {% compress %} output files, linked by their
+    content-hashed names (css/4d2c9e0a1b3f.css -->
+    css/4d2c9e0a1b3f.3fa2c1d4e5f6.css), under which the uploader
+    publishes them, cached forever.
+
+    The hash is taken from the file itself, not from the manifest:
+    with COMPRESS_OFFLINE, the output is rendered during the deploy,
+    before the upload writes the new manifest.
+    Files missing locally keep their plain names.
+
+    Used by {% compress %}, once set as settings.COMPRESS_STORAGE.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(HashedCompressorFileStorage, self).__init__(*args, **kwargs)
+        self._shas = {}
+
+    def file_sha(self, name):
+        """ sha1 of the file name, or None if there is no such file """
+        path = self.path(name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if self._shas.get(name, (None,))[0] != mtime:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    sha.update(chunk)
+            self._shas[name] = (mtime, sha.hexdigest())
+        return self._shas[name][1]
+
+    def url(self, name):
+        sha = self.file_sha(name)
+        if sha:
+            name = get_hashed_name(name, sha)
+        return super(HashedCompressorFileStorage, self).url(name)
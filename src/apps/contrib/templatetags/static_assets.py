@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Template tags to serve the precompressed (gzipped) versions of the
+css/js static assets, uploaded by deploy/aws/upload_static_s3.py
+next to the original ones (style.css --> style.gz.css),
+to the browsers which support them.
+
+    {% load static_assets %}
+
+    <link href="{% static_asset 'css/style.css' %}" rel="stylesheet">
+
+    {% gzip_static %}
+        {% compress css %}...{% endcompress %}
+    {% endgzip_static %}
+
+Both need the request in the template context
+(django.core.context_processors.request) and only change anything if
+settings.STATIC_GZIP_ENABLED is True. With
+contrib.storage.ManifestStaticFilesStorage, only the files the manifest
+lists a gzipped version for are pointed to it (the uploader skips the
+ones which don't compress). Responses which used them must
+carry a Vary: Accept-Encoding header, which
+contrib.middleware.StaticGzipVaryMiddleware takes care of.
+
+"""
+import re
+
+from django import template
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from contrib.storage import get_gzip_name
+
+register = template.Library()
+
+GZIP_EXTENSIONS = ('.css', '.js')
+_ACCEPTS_GZIP_RE = re.compile(r'(?:^|,)\s*gzip\s*(?:;\s*q=(?P<q>[0-9.]+))?',
+                              re.IGNORECASE)
+
+
+def accepts_gzip(request):
+    """ Does the request advertise gzip support (with a non-zero quality) """
+    match = _ACCEPTS_GZIP_RE.search(request.META.get('HTTP_ACCEPT_ENCODING',
+                                                     ''))
+    if not match:
+        return False
+    try:
+        return float(match.group('q') or 1) > 0
+    except ValueError:
+        return False
+
+
+def _has_gzip(name):
+    """
+    Was a gzipped version of the static file name (plain or hashed)
+    uploaded. Storages which can't tell are trusted to have it.
+
+    """
+    has_gzip = getattr(staticfiles_storage, 'has_gzip', None)
+    return has_gzip(name) if has_gzip else True
+
+
+def _use_gzip(context):
+    """
+    Should static urls rendered in this context point to gzipped files.
+    Either way, flags the request for a Vary: Accept-Encoding header.
+
+    """
+    request = context.get('request')
+    if request is None or not getattr(settings, 'STATIC_GZIP_ENABLED', False):
+        return False
+    request.static_gzip_varied = True
+    return accepts_gzip(request)
+
+
+@register.simple_tag(takes_context=True)
+def static_asset(context, path):
+    """
+    Url of the static file path, as {% static %} would render it,
+    but pointing to its gzipped version if the browser supports it.
+
+    """
+    url = staticfiles_storage.url(path)
+    if path.endswith(GZIP_EXTENSIONS) and _use_gzip(context) and \
+            _has_gzip(path):
+        return get_gzip_name(url)
+    return url
+
+
+class GzipStaticNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        output = self.nodelist.render(context)
+        if not _use_gzip(context):
+            return output
+        return _rewrite_static_urls(output, settings.STATIC_URL)
+
+
+def _rewrite_static_urls(html, static_url):
+    """
+    Points every css/js href/src under static_url in html
+    to its gzipped version, if there is one.
+
+    """
+    pattern = r'''(?P<attr>(?:href|src)=["'])''' \
+              r'''(?P<url>%s(?P<name>[^"'?#]+?))(?P<ext>%s)(?=["'?#])''' % (
+                  re.escape(static_url),
+                  '|'.join(re.escape(e) for e in GZIP_EXTENSIONS))
+
+    def rewrite(match):
+        if not _has_gzip(match.group('name') + match.group('ext')):
+            return match.group(0)
+        return match.expand(r'\g<attr>\g<url>.gz\g<ext>')
+    return re.sub(pattern, rewrite, html)
+
+
+@register.tag
+def gzip_static(parser, token):
+    """
+    Renders its content pointing the css/js files under STATIC_URL to
+    their gzipped versions, if the browser supports them.
+    Works on the output of {% compress %}, even if compressed offline.
+
+    """
+    nodelist = parser.parse(('endgzip_static',))
+    parser.delete_first_token()
+    return GzipStaticNode(nodelist)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Specifications of the gzipped static assets: the static_assets
+template tags and the StaticGzipVaryMiddleware
+
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from contrib.tests import assert_equals
+from contrib.middleware import StaticGzipVaryMiddleware
+from contrib.storage import ManifestStaticFilesStorage
+from contrib.templatetags import static_assets
+from contrib.templatetags.static_assets import accepts_gzip
+
+GZIP_STATIC = Template(
+    '{% load static_assets %}{% gzip_static %}'
+    '<link href="/static/css/style.css" rel="stylesheet">'
+    '<script src="/static/js/script.js"></script>'
+    '<img src="/static/img/logo.png">'
+    '<script src="http://cdn.example.com/js/jquery.js"></script>'
+    '{% endgzip_static %}')
+
+
+def _get(accept_encoding=None):
+    extra = {}
+    if accept_encoding is not None:
+        extra['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    return RequestFactory().get('/', **extra)
+
+
+class AcceptsGzipSpec(TestCase):
+
+    def it_accepts_gzip_when_listed(self):
+        assert_equals(True, accepts_gzip(_get('gzip, deflate')))
+        assert_equals(True, accepts_gzip(_get('deflate, GZIP')))
+
+    def it_accepts_gzip_with_a_non_zero_quality(self):
+        assert_equals(True, accepts_gzip(_get('gzip;q=0.5, identity')))
+
+    def it_refuses_gzip_with_a_zero_quality(self):
+        assert_equals(False, accepts_gzip(_get('gzip;q=0, deflate')))
+        assert_equals(False, accepts_gzip(_get('gzip; q=0.0')))
+
+    def it_refuses_gzip_when_not_listed(self):
+        assert_equals(False, accepts_gzip(_get('deflate, br')))
+        assert_equals(False, accepts_gzip(_get('x-gzip')))
+        assert_equals(False, accepts_gzip(_get()))
+
+
+@override_settings(STATIC_URL='/static/', STATIC_GZIP_ENABLED=True)
+class GzipStaticSpec(TestCase):
+
+    def it_points_css_and_js_under_static_url_to_their_gzip_versions(self):
+        html = GZIP_STATIC.render(Context({'request': _get('gzip')}))
+        assert '"/static/css/style.gz.css"' in html
+        assert '"/static/js/script.gz.js"' in html
+
+    def it_leaves_other_files_and_other_hosts_alone(self):
+        html = GZIP_STATIC.render(Context({'request': _get('gzip')}))
+        assert '"/static/img/logo.png"' in html
+        assert '"http://cdn.example.com/js/jquery.js"' in html
+
+    def it_leaves_the_urls_alone_without_gzip_support(self):
+        html = GZIP_STATIC.render(Context({'request': _get('gzip;q=0')}))
+        assert '"/static/css/style.css"' in html
+        assert '"/static/js/script.js"' in html
+
+    def it_flags_the_request_as_varied(self):
+        request = _get('deflate')
+        GZIP_STATIC.render(Context({'request': request}))
+        assert_equals(True, request.static_gzip_varied)
+
+    @override_settings(STATIC_GZIP_ENABLED=False)
+    def it_does_nothing_when_disabled(self):
+        request = _get('gzip')
+        html = GZIP_STATIC.render(Context({'request': request}))
+        assert '"/static/css/style.css"' in html
+        assert not hasattr(request, 'static_gzip_varied')
+
+
+@override_settings(STATIC_URL='/static/', STATIC_GZIP_ENABLED=True)
+class GzipStaticManifestSpec(TestCase):
+    """ Only the files the manifest lists a gzipped version for """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        storage = ManifestStaticFilesStorage()
+        storage.manifest_file = os.path.join(self.folder, 'manifest.json')
+        with open(storage.manifest_file, 'w') as f:
+            json.dump({'css/style.css': 'css/style.3fa2c1d4e5f6.css',
+                       'css/style.gz.css': 'css/style.3fa2c1d4e5f6.gz.css',
+                       'js/script.js': 'js/script.9b8a7c6d5e4f.js'}, f)
+        self.storage = static_assets.staticfiles_storage
+        static_assets.staticfiles_storage = storage
+
+    def tearDown(self):
+        static_assets.staticfiles_storage = self.storage
+        shutil.rmtree(self.folder)
+
+    def it_points_to_the_gzip_versions_uploaded(self):
+        html = GZIP_STATIC.render(Context({'request': _get('gzip')}))
+        assert '"/static/css/style.gz.css"' in html
+
+    def it_leaves_the_files_with_no_gzip_version_alone(self):
+        html = GZIP_STATIC.render(Context({'request': _get('gzip')}))
+        assert '"/static/js/script.js"' in html
+
+    def it_knows_the_gzip_versions_of_hashed_names(self):
+        html = Template(
+            '{% load static_assets %}{% gzip_static %}'
+            '<link href="/static/css/style.3fa2c1d4e5f6.css">'
+            '<script src="/static/js/script.9b8a7c6d5e4f.js"></script>'
+            '{% endgzip_static %}').render(
+                Context({'request': _get('gzip')}))
+        assert '"/static/css/style.3fa2c1d4e5f6.gz.css"' in html
+        assert '"/static/js/script.9b8a7c6d5e4f.js"' in html
+
+    def it_resolves_static_asset_to_the_hashed_gzip_version(self):
+        html = Template(
+            "{% load static_assets %}{% static_asset 'css/style.css' %} "
+            "{% static_asset 'js/script.js' %}").render(
+                Context({'request': _get('gzip')}))
+        assert_equals('/static/css/style.3fa2c1d4e5f6.gz.css '
+                      '/static/js/script.9b8a7c6d5e4f.js', html)
+
+
+class StaticGzipVaryMiddlewareSpec(TestCase):
+
+    def it_varies_on_accept_encoding_when_gzip_was_considered(self):
+        request = _get('gzip')
+        request.static_gzip_varied = True
+        response = StaticGzipVaryMiddleware().process_response(
+            request, HttpResponse())
+        assert_equals('Accept-Encoding', response['Vary'])
+
+    def it_keeps_the_other_vary_headers(self):
+        request = _get('gzip')
+        request.static_gzip_varied = True
+        response = HttpResponse()
+        response['Vary'] = 'Cookie'
+        StaticGzipVaryMiddleware().process_response(request, response)
+        assert_equals('Cookie, Accept-Encoding', response['Vary'])
+
+    def it_leaves_other_responses_alone(self):
+        response = StaticGzipVaryMiddleware().process_response(
+            _get('gzip'), HttpResponse())
+        assert not response.has_header('Vary')
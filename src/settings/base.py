@@ -60,6 +60,10 @@ MEDIA_URL = '/media/'
 STATIC_ROOT = os.path.join(PUBLIC_ROOT, 'static')  # collect to this directory
 STATIC_URL = '/static/'  # serve them from this URL
 #ADMIN_MEDIA_PREFIX = STATIC_URL + 'admin/'
+#plain -> content-hashed names map, written by deploy/aws/upload_static_s3.py
+STATIC_MANIFEST_FILE = os.path.join(STATIC_ROOT, 'staticfiles-manifest.json')
+#point css/js to their precompressed versions (only uploaded to S3)
+STATIC_GZIP_ENABLED = False
 #search them from this directories
 STATICFILES_DIRS = [
     os.path.join(PROJECT_ROOT, 'static'),
@@ -85,6 +85,10 @@ AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
 
 #Static settings
 STATIC_URL = 'http://ces27.s3-sa-east-1.amazonaws.com/'
+#{% static %} resolves to the content-hashed (immutable) names
+STATICFILES_STORAGE = 'contrib.storage.ManifestStaticFilesStorage'
+#{% static_asset %} and {% gzip_static %} serve the .gz.css/.gz.js versions
+STATIC_GZIP_ENABLED = True
 
 #Media (user-uploaded content) settings (S3)
 MEDIA_URL = 'http://ces27.s3-sa-east-1.amazonaws.com/'
@@ -99,6 +103,8 @@ IMAGEKIT_DEFAULT_IMAGE_CACHE_BACKEND = 'imagekit.imagecache.NonValidatingImageCa
 COMPRESS_URL = STATIC_URL
 COMPRESS_ROOT = STATIC_ROOT
 COMPRESS_OFFLINE = True
+#link the {% compress %} output by its content-hashed (immutable) name
+COMPRESS_STORAGE = 'contrib.storage.HashedCompressorFileStorage'
 ###############################################
 
 
@@ -113,6 +119,7 @@ FORCE_WWW = False
 #Bazooka caching approach: Cache the entire site.
 MIDDLEWARE_CLASSES = (
     'django.middleware.cache.UpdateCacheMiddleware', #Always first
+    'contrib.middleware.StaticGzipVaryMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',